@@ -0,0 +1,314 @@
+import logging
+import uuid
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from anomaly.sketch import DDSketch
+from load_traces.utils.compact_schema import DICTIONARY_TYPE, trace_id_columns
+from load_traces.utils.table_writer import live_files, write_merged, write_table
+
+DEFAULT_ANOMALY_DIR = "data"
+# Every latency baseline is kept per value of these columns, plus the configured tag columns
+KEY_COLUMNS = ('serviceName', 'operationName')
+DAY_US = 86_400_000_000
+# Columns of a flagged span besides its key; latencyScore is the share of the baseline at or below its duration
+FLAGGED_SCHEMA = pa.schema([
+    ('spanID', pa.uint64()),
+    *((name, pa.uint64()) for name in trace_id_columns()),
+    ('startTime', pa.timestamp('us')),
+    ('duration', pa.int64()),
+    ('latencyThreshold', pa.float64()),
+    ('latencyScore', pa.float64()),
+])
+
+
+def _day(day_number: int) -> str:
+    return datetime.fromtimestamp(day_number * 86_400, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _day_number(day: str) -> int:
+    return int(datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()) // 86_400
+
+
+def _key_values(batch: pa.RecordBatch, key_columns: tuple[str, ...]) -> list[np.ndarray]:
+    """Return every key column of a batch as an object array of strings, with None for nulls and missing columns."""
+    values = []
+    for name in key_columns:
+        if name in batch.schema.names:
+            values.append(pc.cast(batch.column(name), pa.string()).to_numpy(zero_copy_only=False))
+        else:
+            values.append(np.full(batch.num_rows, None, dtype=object))
+    return values
+
+
+def _group_rows(key_values: list[np.ndarray], num_rows: int) -> Iterator[tuple[tuple, np.ndarray]]:
+    """Yield every distinct key of the rows, with the rows that have it, in order of first appearance."""
+    groups = np.zeros(num_rows, dtype=np.int64)
+    for values in key_values:
+        codes, uniques = pd.factorize(values)
+        groups, _ = pd.factorize(groups * (len(uniques) + 1) + codes + 1)
+    order = np.argsort(groups, kind='stable')
+    for rows in np.split(order, np.cumsum(np.bincount(groups))[:-1]) if num_rows else []:
+        yield tuple(values[rows[0]] for values in key_values), rows
+
+
+def _run_name() -> str:
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def _write_part(table: pa.Table, partition_dir: Path, part_name: str) -> None:
+    """Write a new Parquet file under a temporary name and rename it when complete."""
+    partition_dir.mkdir(parents=True, exist_ok=True)
+    write_table(table, partition_dir / part_name)
+
+
+class LatencyDetector:
+    """
+    Online latency anomaly scoring of the spans of one trace target.
+
+    A `DDSketch` of span durations is kept per key, the (serviceName, operationName) of the span plus the values
+    of the configured `tag_*` columns, and per UTC day of `startTime`. The baseline of a span is the merge of the
+    sketches of its key over the `window_days` days up to the day of the span, so it rolls forward a day at a
+    time, and the span is flagged when its duration is above the `quantile` of its baseline, once the baseline
+    holds at least `min_count` spans.
+
+    Spans scored by `observe` only join the sketches when `commit` is called, after their batch has been written;
+    `rollback` drops them, so a failed cycle that is fetched again is not counted twice. `commit` saves the
+    sketches of the committed spans as a new `date=YYYY-MM-DD/sketch-<run>.parquet` file per day under
+    `state_dir` and the flagged spans as new `date=YYYY-MM-DD/part-<run>.parquet` files under `anomalies_dir`.
+    Once a later day has spans, the sketch files of a day are merged into one (see `_compact`), so a past day
+    keeps a single file. The state is rebuilt by merging the sketch files of the window, so no span is ever
+    read again to rebuild a baseline. Memory is bounded by the number of keys times `window_days`
+    sketches of at most `max_bins` counts.
+    """
+
+    def __init__(self, state_dir: Path | str, anomalies_dir: Path | str, key_tags: Iterable[str] = (),
+                 quantile: float = 0.99, window_days: int = 7, min_count: int = 100,
+                 relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.state_dir = Path(state_dir)
+        self.anomalies_dir = Path(anomalies_dir)
+        self.key_columns = KEY_COLUMNS + tuple(f"tag_{tag}" for tag in key_tags)
+        self.quantile = quantile
+        self.window_days = window_days
+        self.min_count = min_count
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._days: dict[int, dict[tuple, DDSketch]] = {}
+        self._pending: dict[int, dict[tuple, DDSketch]] = {}
+        self._flagged: list[pa.Table] = []
+        self._baselines: dict[tuple, DDSketch | None] = {}
+        self._load()
+
+    @classmethod
+    def from_config(cls, config: dict, base_dir: Path, target_name: str) -> "LatencyDetector | None":
+        """
+        Create the detector of a trace target from the `anomaly` section of config.yml, or return None if
+        `anomaly.dir` is null. Its sketches are kept under `<dir>/sketches/<target>` and its flagged spans
+        written to `<dir>/anomalies/<target>`.
+        """
+        anomaly_config = config.get("anomaly") or {}
+        anomaly_dir = anomaly_config.get("dir", DEFAULT_ANOMALY_DIR)
+        if not anomaly_dir:
+            return None
+        return cls(
+            base_dir / anomaly_dir / "sketches" / target_name,
+            base_dir / anomaly_dir / "anomalies" / target_name,
+            key_tags=anomaly_config.get("key_tags") or (),
+            quantile=anomaly_config.get("quantile", 0.99),
+            window_days=anomaly_config.get("window_days", 7),
+            min_count=anomaly_config.get("min_count", 100),
+            relative_accuracy=anomaly_config.get("relative_accuracy", 0.01),
+            max_bins=anomaly_config.get("max_bins", 2048),
+        )
+
+    def _read_sketches(self, path: Path) -> list[tuple[tuple, DDSketch]] | None:
+        """Return the key and sketch of every row of a sketch file, or None if its relative accuracy differs."""
+        table = pq.read_table(path)
+        relative_accuracy = float(table.schema.metadata[b'relative_accuracy'])
+        if relative_accuracy != self.relative_accuracy:
+            logging.warning(f"Skipping {path}: its sketches have relative accuracy {relative_accuracy}, "
+                            f"not {self.relative_accuracy}.")
+            return None
+        keys = zip(*(table.column(name).to_pylist() if name in table.schema.names else [None] * table.num_rows
+                     for name in self.key_columns))
+        return [(key, DDSketch.from_counts(offset, counts, zero_count, self.relative_accuracy, self.max_bins))
+                for key, offset, zero_count, counts in zip(keys, table.column('offset').to_pylist(),
+                                                           table.column('zero_count').to_pylist(),
+                                                           table.column('counts').to_numpy(zero_copy_only=False))]
+
+    def _compact(self, partition_dir: Path) -> None:
+        """
+        Merge the sketch files of one day into a single new file.
+
+        The files are replaced with `write_merged`, so an interrupted merge never counts spans twice. Files of
+        another relative accuracy are left as they are.
+        """
+        sketches: dict[tuple, DDSketch] = {}
+        merged = []
+        for path in live_files(sorted(partition_dir.glob('*.parquet'))):
+            day_sketches = self._read_sketches(path)
+            if day_sketches is None:
+                continue
+            merged.append(path)
+            for key, sketch in day_sketches:
+                if key in sketches:
+                    sketches[key].merge(sketch)
+                else:
+                    sketches[key] = sketch
+        if len(merged) < 2:
+            return
+        write_merged(self._sketch_table(sketches), partition_dir / f"sketch-{_run_name()}.parquet", merged)
+        logging.info(f"Merged {len(merged)} sketch files of {partition_dir}.")
+
+    def _load(self) -> None:
+        partition_days = {_day_number(path.name.removeprefix('date=')): path for path in self.state_dir.glob('date=*')}
+        latest_day = max(partition_days, default=0)
+        first_day = latest_day - self.window_days + 1
+        files = 0
+        for day, partition_dir in sorted(partition_days.items()):
+            if day < latest_day:
+                self._compact(partition_dir)
+            if day < first_day:
+                continue
+            for path in live_files(sorted(partition_dir.glob('*.parquet'))):
+                day_sketches = self._read_sketches(path)
+                if day_sketches is None:
+                    continue
+                for key, sketch in day_sketches:
+                    self._merge_into(self._days, day, key, sketch)
+                files += 1
+        logging.info(f"Latency baselines of {len(self._days)} days loaded from {files} files of {self.state_dir}.")
+
+    def _merge_into(self, days: dict[int, dict[tuple, DDSketch]], day: int, key: tuple, sketch: DDSketch) -> None:
+        sketches = days.setdefault(day, {})
+        if key in sketches:
+            sketches[key].merge(sketch)
+        else:
+            sketches[key] = sketch
+
+    def baseline(self, key: tuple, day: int) -> DDSketch | None:
+        """Return the merged sketch of the committed spans of `key` in the `window_days` days up to `day`, if any."""
+        if (key, day) not in self._baselines:
+            baseline = None
+            for window_day in range(day - self.window_days + 1, day + 1):
+                sketch = self._days.get(window_day, {}).get(key)
+                if sketch is None:
+                    continue
+                if baseline is None:
+                    baseline = sketch.copy()
+                else:
+                    baseline.merge(sketch)
+            self._baselines[key, day] = baseline
+        return self._baselines[key, day]
+
+    def score(self, batch: pa.RecordBatch) -> int:
+        """
+        Flag the spans of a batch above the baseline quantile of their key, and count them into pending sketches.
+
+        Returns:
+            int: The number of spans flagged.
+        """
+        durations = np.asarray(pc.fill_null(batch.column('duration'), 0)).astype(np.float64)
+        start = batch.column('startTime').cast(pa.int64())
+        valid = np.asarray(pc.and_(pc.is_valid(start), pc.is_valid(batch.column('duration'))))
+        days = np.asarray(pc.fill_null(start, 0)) // DAY_US
+        key_values = _key_values(batch, self.key_columns)
+        flagged_rows, thresholds, scores = [], [], []
+        for key, rows in _group_rows(key_values, batch.num_rows):
+            rows = rows[valid[rows]]
+            row_days = days[rows]
+            for day in np.unique(row_days):
+                day_rows = rows[row_days == day]
+                baseline = self.baseline(key, int(day))
+                if baseline is not None and baseline.count >= self.min_count:
+                    threshold = baseline.quantile(self.quantile)
+                    above = day_rows[durations[day_rows] > threshold]
+                    flagged_rows.append(above)
+                    thresholds.append(np.full(len(above), threshold))
+                    scores.append(baseline.cdf(durations[above]))
+                sketch = DDSketch(self.relative_accuracy, self.max_bins)
+                sketch.add(durations[day_rows])
+                self._merge_into(self._pending, int(day), key, sketch)
+
+        flagged = np.concatenate(flagged_rows) if flagged_rows else np.zeros(0, dtype=np.int64)
+        if len(flagged):
+            order = np.argsort(flagged)
+            indices = pa.array(flagged[order])
+            arrays = {name: batch.column(name).take(indices) for name in FLAGGED_SCHEMA.names[:5]}
+            arrays['latencyThreshold'] = pa.array(np.concatenate(thresholds)[order])
+            arrays['latencyScore'] = pa.array(np.concatenate(scores)[order])
+            table = pa.Table.from_pydict(arrays, schema=FLAGGED_SCHEMA)
+            for name, values in zip(self.key_columns, key_values):
+                key_type = DICTIONARY_TYPE if name in KEY_COLUMNS else pa.string()
+                table = table.append_column(name, pa.array(values[flagged[order]], type=pa.string()).cast(key_type))
+            names = FLAGGED_SCHEMA.names
+            self._flagged.append(table.select(names[:3] + list(self.key_columns) + names[3:]))
+        return len(flagged)
+
+    def observe(self, batches: Iterable[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+        """Score every batch with `score` as it passes through, and yield it unchanged."""
+        for batch in batches:
+            flagged = self.score(batch)
+            if flagged:
+                logging.info(f"{flagged} of {batch.num_rows} spans above the p{self.quantile * 100:g} latency baseline.")
+            yield batch
+
+    def _sketch_table(self, sketches: dict[tuple, DDSketch]) -> pa.Table:
+        keys = list(sketches)
+        counts = [sketch.to_counts() for sketch in sketches.values()]
+        lengths = np.array([len(bucket_counts) for _, bucket_counts, _ in counts], dtype=np.int32)
+        values = np.concatenate([bucket_counts for _, bucket_counts, _ in counts]) if counts else []
+        arrays = {name: pa.array([key[i] for key in keys], type=pa.string())
+                  for i, name in enumerate(self.key_columns)}
+        arrays['offset'] = pa.array([offset for offset, _, _ in counts], type=pa.int64())
+        arrays['zero_count'] = pa.array([zero_count for _, _, zero_count in counts], type=pa.int64())
+        arrays['counts'] = pa.ListArray.from_arrays(pa.array(np.concatenate([[0], np.cumsum(lengths)]), pa.int32()),
+                                                    pa.array(values, type=pa.int64()))
+        return pa.table(arrays).replace_schema_metadata({'relative_accuracy': str(self.relative_accuracy)})
+
+    def commit(self) -> int:
+        """
+        Add the pending sketches to the baselines and save them and the flagged spans as new files.
+
+        The sketch files of the days before the latest day with spans are then merged, the day that was the
+        latest until now and past days that received late spans.
+
+        Returns:
+            int: The number of flagged spans written.
+        """
+        run = _run_name()
+        previous_day = max(self._days, default=None)
+        for day, sketches in self._pending.items():
+            _write_part(self._sketch_table(sketches), self.state_dir / f"date={_day(day)}", f"sketch-{run}.parquet")
+            for key, sketch in sketches.items():
+                self._merge_into(self._days, day, key, sketch)
+        flagged = pa.concat_tables(self._flagged) if self._flagged else None
+        if flagged is not None:
+            dates = pc.strftime(flagged.column('startTime'), format='%Y-%m-%d')
+            for date in pc.unique(dates).to_pylist():
+                _write_part(flagged.filter(pc.equal(dates, date)), self.anomalies_dir / f"date={date}",
+                            f"part-{run}.parquet")
+        latest_day = max(self._days, default=0)
+        past_days = {day for day in self._pending if day < latest_day}
+        if previous_day is not None and previous_day < latest_day:
+            past_days.add(previous_day)
+        for day in sorted(past_days):
+            self._compact(self.state_dir / f"date={_day(day)}")
+        # Only the window of the latest day is kept; spans of older days are scored against what remains
+        first_day = latest_day - self.window_days + 1
+        self._days = {day: sketches for day, sketches in self._days.items() if day >= first_day}
+        self._baselines.clear()
+        self.rollback()
+        return flagged.num_rows if flagged is not None else 0
+
+    def rollback(self) -> None:
+        """Drop the spans scored since the last commit."""
+        self._pending.clear()
+        self._flagged.clear()
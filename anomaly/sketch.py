@@ -0,0 +1,127 @@
+import math
+
+import numpy as np
+
+
+class DDSketch:
+    """
+    A mergeable quantile sketch with relative-error guarantees (DDSketch, Masson et al., VLDB 2019).
+
+    Positive values are counted in logarithmic buckets: bucket i holds the values in (gamma^(i-1), gamma^i],
+    with gamma = (1 + relative_accuracy) / (1 - relative_accuracy), so every quantile is estimated within
+    `relative_accuracy` of a value of that rank. Zero and negative values are counted apart. The buckets are a
+    dense array of counts starting at bucket `offset`; when it grows past `max_bins`, the lowest buckets are
+    collapsed into one, which only costs accuracy on the low quantiles. The memory use is fixed, and two
+    sketches with the same `relative_accuracy` merge by adding their counts, so sketches of parallel workers or
+    of past days combine into one without looking at the values again.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"relative_accuracy must be between 0 and 1, got {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0
+
+    @classmethod
+    def from_counts(cls, offset: int, counts: np.ndarray, zero_count: int = 0, relative_accuracy: float = 0.01,
+                    max_bins: int = 2048) -> "DDSketch":
+        """Rebuild a sketch from the bucket counts returned by `to_counts`."""
+        sketch = cls(relative_accuracy, max_bins)
+        sketch.zero_count = int(zero_count)
+        sketch._add_counts(int(offset), np.asarray(counts, dtype=np.int64))
+        return sketch
+
+    def to_counts(self) -> tuple[int, np.ndarray, int]:
+        """Return the offset, the bucket counts without leading and trailing empty buckets, and the zero count."""
+        nonzero = np.flatnonzero(self.counts)
+        if not len(nonzero):
+            return 0, np.zeros(0, dtype=np.int64), self.zero_count
+        return self.offset + int(nonzero[0]), self.counts[nonzero[0]:nonzero[-1] + 1], self.zero_count
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + int(self.counts.sum())
+
+    def bucket_indexes(self, values: np.ndarray) -> np.ndarray:
+        """Return the bucket of every positive value."""
+        return np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+
+    def bucket_values(self, indexes: np.ndarray) -> np.ndarray:
+        """Return the estimate of the values of buckets: the point within `relative_accuracy` of both bounds."""
+        return 2 * self.gamma ** np.asarray(indexes, dtype=np.float64) / (self.gamma + 1)
+
+    def add(self, values: np.ndarray) -> None:
+        """Count an array of values at once; NaN values are skipped."""
+        values = np.asarray(values, dtype=np.float64)
+        positive = values > 0
+        self.zero_count += int((values <= 0).sum())
+        if positive.any():
+            indexes = self.bucket_indexes(values[positive])
+            low = int(indexes.min())
+            self._add_counts(low, np.bincount(indexes - low))
+
+    def _add_counts(self, offset: int, counts: np.ndarray) -> None:
+        if not len(counts):
+            return
+        if not len(self.counts):
+            self.offset, self.counts = offset, counts.astype(np.int64)
+        else:
+            low = min(self.offset, offset)
+            high = max(self.offset + len(self.counts), offset + len(counts))
+            merged = np.zeros(high - low, dtype=np.int64)
+            merged[self.offset - low:self.offset - low + len(self.counts)] += self.counts
+            merged[offset - low:offset - low + len(counts)] += counts
+            self.offset, self.counts = low, merged
+        excess = len(self.counts) - self.max_bins
+        if excess > 0:
+            self.counts[excess] += self.counts[:excess].sum()
+            self.counts = self.counts[excess:]
+            self.offset += excess
+
+    def merge(self, other: "DDSketch") -> None:
+        """
+        Add the counts of another sketch to this one.
+
+        Raises:
+            ValueError: If the sketches were built with a different relative accuracy.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Cannot merge a sketch of relative accuracy {other.relative_accuracy} "
+                             f"into one of {self.relative_accuracy}")
+        self.zero_count += other.zero_count
+        self._add_counts(other.offset, other.counts)
+
+    def copy(self) -> "DDSketch":
+        sketch = DDSketch(self.relative_accuracy, self.max_bins)
+        sketch.offset, sketch.counts, sketch.zero_count = self.offset, self.counts.copy(), self.zero_count
+        return sketch
+
+    def quantile(self, q: float) -> float:
+        """Return the estimated `q`-quantile (0 <= q <= 1) of the counted values, or NaN if the sketch is empty."""
+        count = self.count
+        if not count:
+            return math.nan
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side='right'))
+        return float(self.bucket_values(self.offset + min(index, len(self.counts) - 1)))
+
+    def cdf(self, values: np.ndarray) -> np.ndarray:
+        """Return the estimated share of the counted values at or below each of `values` (NaN if empty)."""
+        values = np.asarray(values, dtype=np.float64)
+        count = self.count
+        if not count:
+            return np.full(len(values), np.nan)
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        positive = values > 0
+        buckets = np.zeros(len(values), dtype=np.int64)
+        buckets[positive] = self.bucket_indexes(values[positive]) - self.offset + 1
+        buckets = np.clip(buckets, 0, len(self.counts))
+        below = np.where(positive, self.zero_count + cumulative[buckets], np.where(values == 0, self.zero_count, 0))
+        return below / count
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pyarrow as pa
+
+DEFAULT_ARCHIVE_DIR = "data/raw"
+# The index is rewritten by every fetch, so it is local state outside the DVC-tracked data directory;
+# only the immutable blobs are published
+DEFAULT_INDEX_PATH = "state/raw_index.sqlite"
+JAEGER = "jaeger"
+LOKI = "loki"
+# Request parameters that hold the time window of a response; the rest make up its query
+WINDOW_PARAMS = ("start", "end")
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    source TEXT NOT NULL,
+    query TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (source, query, start, end, sha256)
+);
+CREATE INDEX IF NOT EXISTS responses_window ON responses (source, start);
+"""
+
+_codec = pa.Codec("zstd")
+
+
+@dataclass(frozen=True)
+class ArchivedResponse:
+    """The index entry of one archived response: what was asked, for which window, and where the body is."""
+    source: str
+    query: dict
+    start: int
+    end: int
+    sha256: str
+    size: int
+
+
+def blob_path(root: Path | str, sha256: str) -> Path:
+    """Return the path of the blob of a response body under the archive root."""
+    return Path(root) / "blobs" / sha256[:2] / f"{sha256}.zst"
+
+
+def read_blob(root: Path | str, sha256: str, size: int) -> bytes:
+    """Return the decompressed body of an archived response; `size` is its uncompressed size from the index."""
+    return _codec.decompress(blob_path(root, sha256).read_bytes(), decompressed_size=size, asbytes=True)
+
+
+def split_params(params: dict) -> tuple[dict, int, int]:
+    """Split the parameters of a Jaeger or Loki request into its query (without None values) and its window."""
+    query = {key: value for key, value in params.items() if key not in WINDOW_PARAMS and value is not None}
+    return query, int(params["start"]), int(params["end"])
+
+
+class RawArchive:
+    """
+    A content-addressed archive of the raw Jaeger and Loki responses.
+
+    Every response body is stored once, zstd-compressed, under the SHA-256 of its content
+    (`blobs/<2 hex>/<sha256>.zst`, written under a temporary name and renamed). A SQLite index at `index_path`
+    maps (source, query, time window) to the bodies, so the datasets can be rebuilt from the archive without
+    querying Jaeger or Loki again. `from_config` puts the index in `state/raw_index.sqlite`, outside the
+    published data; without `index_path` it is `index.sqlite` in the archive, where older archives kept it.
+    Windows are in the units of the source: microseconds for Jaeger, nanoseconds for Loki. `put()` may be
+    called from several threads.
+    """
+
+    def __init__(self, root: Path | str, index_path: Path | str | None = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        legacy_path = self.root / "index.sqlite"
+        self.index_path = Path(index_path) if index_path is not None else legacy_path
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.index_path.exists() and legacy_path.exists():
+            logging.info(f"Moving the raw archive index {legacy_path} to {self.index_path}.")
+            legacy_path.replace(self.index_path)
+        self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.conn.executescript(INDEX_SCHEMA)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, base_dir: Path) -> "RawArchive | None":
+        """Open the archive of the `archive` section of config.yml, or return None if `archive.dir` is null."""
+        archive_config = config.get("archive") or {}
+        archive_dir = archive_config.get("dir", DEFAULT_ARCHIVE_DIR)
+        index_path = archive_config.get("index_path", DEFAULT_INDEX_PATH)
+        return cls(base_dir / archive_dir, base_dir / index_path) if archive_dir else None
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put(self, source: str, params: dict, body: bytes) -> str:
+        """
+        Archive the body of one response to a request with `params`, and index it.
+
+        Returns:
+            str: The SHA-256 of the body.
+        """
+        sha256 = hashlib.sha256(body).hexdigest()
+        path = blob_path(self.root, sha256)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(_codec.compress(body, asbytes=True))
+            tmp_path.replace(path)
+        query, start, end = split_params(params)
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source, json.dumps(query, sort_keys=True), start, end, sha256, len(body),
+                 datetime.now(timezone.utc).isoformat(timespec="seconds")),
+            )
+            self.conn.commit()
+        return sha256
+
+    def find(self, source: str, query: dict | None = None, start: int | None = None,
+             end: int | None = None) -> list[ArchivedResponse]:
+        """
+        Return the archived responses of `source` whose window overlaps [start, end), oldest window first.
+
+        Only responses whose query has the given `query` values are returned; a None value matches a
+        parameter that was not sent.
+        """
+        sql = "SELECT query, start, end, sha256, size FROM responses WHERE source = ?"
+        args: list = [source]
+        if end is not None:
+            sql += " AND start < ?"
+            args.append(end)
+        if start is not None:
+            sql += " AND end > ?"
+            args.append(start)
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY start, end", args).fetchall()
+        responses = []
+        for query_json, row_start, row_end, sha256, size in rows:
+            row_query = json.loads(query_json)
+            if all(row_query.get(key) == value for key, value in (query or {}).items()):
+                responses.append(ArchivedResponse(source, row_query, row_start, row_end, sha256, size))
+        logging.debug(f"{len(responses)} archived {source} responses match {query} in {start}-{end}.")
+        return responses
+
+    def read(self, response: ArchivedResponse) -> bytes:
+        """Return the decompressed body of an archived response."""
+        return read_blob(self.root, response.sha256, response.size)
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from archive.raw_archive import JAEGER, LOKI, ArchivedResponse, RawArchive, read_blob
+from load_logs.log_store import entry_key, write_log_batch
+from load_logs.loki_client import _page_entries
+from load_logs.parse_logs import parse_log_lines
+from load_traces.utils.compact_schema import trace_id_columns, trace_id_keys
+from load_traces.utils.flatten_spans import iter_span_batches, write_span_batches_parquet
+from load_traces.utils.span_dataset import append_spans
+from load_traces.utils.trace_targets import TraceTarget
+
+
+def _ensure_empty(directory: Path) -> None:
+    if directory.exists() and any(directory.iterdir()):
+        raise FileExistsError(f"{directory} is not empty, replay into a new directory.")
+
+
+def _chunks(responses: list[ArchivedResponse], start: int, end: int, chunk: int) -> dict[int, list[ArchivedResponse]]:
+    """Group the responses by the chunks of `chunk` units from `start` that their window overlaps."""
+    chunks: dict[int, list[ArchivedResponse]] = {}
+    for response in responses:
+        first = (max(response.start, start) - start) // chunk
+        last = (min(response.end, end) - 1 - start) // chunk
+        for index in range(first, last + 1):
+            chunks.setdefault(index, []).append(response)
+    return chunks
+
+
+def _replay_trace_chunk(root: str, responses: list[ArchivedResponse], part_path: str, batch_size: int) -> int:
+    """Flatten the unique traces of some archived Jaeger responses into a Parquet file; runs in a worker process."""
+    def traces():
+        seen_trace_ids = set()
+        for response in responses:
+            for trace in json.loads(read_blob(root, response.sha256, response.size)).get('data') or []:
+                trace_id = trace.get('traceID')
+                if trace_id not in seen_trace_ids:
+                    seen_trace_ids.add(trace_id)
+                    yield trace
+
+    return write_span_batches_parquet(iter_span_batches(traces(), batch_size=batch_size), part_path)
+
+
+def replay_traces(
+        archive: RawArchive,
+        target: TraceTarget,
+        dataset_dir: Path,
+        start_us: int | None = None,
+        end_us: int | None = None,
+        max_workers: int | None = None,
+        chunk_hours: int = 24,
+        batch_size: int = 50_000
+) -> int:
+    """
+    Rebuild the span dataset of a target from the archived Jaeger responses, without querying Jaeger.
+
+    The responses are split into chunks of `chunk_hours` by their window, and the chunks are decompressed,
+    parsed and flattened in parallel worker processes. The chunk files are then appended to the dataset in
+    time order, dropping traces an earlier chunk already had, as the fetcher does.
+
+    Args:
+        archive (RawArchive): The raw response archive.
+        target (TraceTarget): The target whose responses are replayed.
+        dataset_dir (Path): The span dataset to write; it must be empty or missing.
+        start_us (int, optional): The start of the replayed range, in microseconds. Defaults to None, the whole archive.
+        end_us (int, optional): The end of the replayed range, in microseconds. Defaults to None, the whole archive.
+        max_workers (int, optional): The number of worker processes. Defaults to None, one per CPU.
+        chunk_hours (int, optional): The time span of the responses replayed by one worker task. Defaults to 24.
+        batch_size (int, optional): The number of spans per Parquet row group. Defaults to 50000.
+
+    Returns:
+        int: The number of spans written.
+
+    Raises:
+        FileExistsError: If `dataset_dir` already holds files.
+    """
+    _ensure_empty(dataset_dir)
+    responses = archive.find(JAEGER, {"service": target.service, "operation": target.operation}, start_us, end_us)
+    if not responses:
+        logging.warning(f"No archived Jaeger responses of {target.name}.")
+        return 0
+    start_us = start_us if start_us is not None else responses[0].start
+    end_us = end_us if end_us is not None else max(response.end for response in responses)
+    # A response is replayed by the chunk its window starts in
+    chunks: dict[int, list[ArchivedResponse]] = {}
+    for response in responses:
+        index = (max(response.start, start_us) - start_us) // (chunk_hours * 3_600_000_000)
+        chunks.setdefault(index, []).append(response)
+
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    seen_trace_ids = pa.array([], pa.binary(16))
+    spans_written = 0
+    with tempfile.TemporaryDirectory(prefix=".replay-", dir=dataset_dir.parent) as work_dir, \
+            ProcessPoolExecutor(max_workers=max_workers) as executor:
+        part_paths = [str(Path(work_dir) / f"chunk-{index:06d}.parquet") for index in sorted(chunks)]
+        futures = [
+            executor.submit(_replay_trace_chunk, str(archive.root), chunks[index], part_path, batch_size)
+            for index, part_path in zip(sorted(chunks), part_paths)
+        ]
+        for future, part_path in zip(futures, part_paths):
+            if not future.result():
+                continue
+            table = pq.read_table(part_path)
+            trace_ids = trace_id_keys(*(table.column(name) for name in trace_id_columns()))
+            duplicate = pc.is_in(trace_ids, value_set=seen_trace_ids)
+            if pc.any(duplicate).as_py():
+                table = table.filter(pc.invert(duplicate))
+                pq.write_table(table, part_path)
+            seen_trace_ids = pa.concat_arrays([seen_trace_ids, pc.unique(trace_ids)])
+            if table.num_rows:
+                spans_written += sum(append_spans(part_path, dataset_dir).values())
+    logging.info(f"Replayed {len(responses)} Jaeger responses of {target.name} into {spans_written} spans.")
+    return spans_written
+
+
+def _replay_log_chunk(root: str, responses: list[ArchivedResponse], start_ns: int, end_ns: int,
+                      logs_dir: str) -> int:
+    """Parse the unique log entries of [start_ns, end_ns) into a Parquet batch; runs in a worker process."""
+    seen_keys = set()
+    entries = []
+    for response in responses:
+        page = json.loads(read_blob(root, response.sha256, response.size))
+        for timestamp_ns, line in _page_entries(page, response.query.get("direction", "forward")):
+            if start_ns <= timestamp_ns < end_ns:
+                key = entry_key(timestamp_ns, line)
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    entries.append((timestamp_ns, line))
+    if not entries:
+        return 0
+    entries.sort(key=lambda entry: entry[0])
+    logs_df = parse_log_lines([line for _, line in entries])
+    write_log_batch(Path(logs_dir), logs_df, entries[0][0], entries[-1][0])
+    return len(entries)
+
+
+def replay_logs(
+        archive: RawArchive,
+        query: str,
+        logs_dir: Path,
+        start_ns: int | None = None,
+        end_ns: int | None = None,
+        max_workers: int | None = None,
+        chunk_hours: int = 1
+) -> int:
+    """
+    Rebuild the log batches of a LogQL query from the archived Loki responses, without querying Loki.
+
+    The range is split into chunks of `chunk_hours`, each parsed and written as one Parquet batch by a
+    worker process. A worker reads every response whose window overlaps its chunk and keeps the entries
+    inside it, de-duplicated as the collector does, so overlapping fetches yield each entry once.
+
+    Args:
+        archive (RawArchive): The raw response archive.
+        query (str): The LogQL query whose responses are replayed.
+        logs_dir (Path): The logs directory to write; it must be empty or missing.
+        start_ns (int, optional): The start of the replayed range, in nanoseconds. Defaults to None, the whole archive.
+        end_ns (int, optional): The end of the replayed range, in nanoseconds. Defaults to None, the whole archive.
+        max_workers (int, optional): The number of worker processes. Defaults to None, one per CPU.
+        chunk_hours (int, optional): The time span of one log batch. Defaults to 1.
+
+    Returns:
+        int: The number of log entries written.
+
+    Raises:
+        FileExistsError: If `logs_dir` already holds files.
+    """
+    _ensure_empty(logs_dir)
+    responses = archive.find(LOKI, {"query": query}, start_ns, end_ns)
+    if not responses:
+        logging.warning("No archived Loki responses of the query.")
+        return 0
+    start_ns = start_ns if start_ns is not None else responses[0].start
+    end_ns = end_ns if end_ns is not None else max(response.end for response in responses)
+    chunk_ns = chunk_hours * 3_600_000_000_000
+    chunks = _chunks(responses, start_ns, end_ns, chunk_ns)
+
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_replay_log_chunk, str(archive.root), chunks[index], start_ns + index * chunk_ns,
+                            min(start_ns + (index + 1) * chunk_ns, end_ns), str(logs_dir))
+            for index in sorted(chunks)
+        ]
+        entries_written = sum(future.result() for future in futures)
+    logging.info(f"Replayed {len(responses)} Loki responses into {entries_written} log entries "
+                 f"using {max_workers or os.cpu_count()} processes.")
+    return entries_written
@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the batched log parser against the per-entry parsers it replaced.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/bench_parse_logs.py [n_lines ...]
+"""
+import json
+import sys
+import time
+
+import pandas as pd
+
+from benchmarks.generators import make_loki_lines
+from load_logs.parse_logs import parse_log_lines
+
+
+def legacy_parse_logs_to_dataframe(log_entries: list[str]) -> pd.DataFrame:
+    """The per-entry parser of logs_to_ds_collector.py before the batched parser."""
+    parsed_log_entries = []
+    for log_entry in log_entries:
+        entry_dict = json.loads(log_entry)
+        parsed_log_entries.append({**entry_dict, "time": pd.to_datetime(entry_dict["time"], unit='ms')})
+    return pd.DataFrame(parsed_log_entries)
+
+
+def legacy_parse_log_entries(log_entries: list[str]) -> pd.DataFrame:
+    """The per-entry parser of main_logs.py before the batched parser."""
+    parsed_log_entries = []
+    for log_entry in log_entries:
+        entry_dict = json.loads(log_entry)
+        parsed_entry = {
+            "level": entry_dict.get("level", ""),
+            "message": entry_dict.get("message", ""),
+            "time": entry_dict.get("time", 0)
+        }
+        for key, value in entry_dict.items():
+            if key not in ["level", "message", "time"]:
+                parsed_entry[f"add_{key}"] = value
+        parsed_log_entries.append(parsed_entry)
+    df_logs = pd.DataFrame(parsed_log_entries)
+    df_logs.set_index('time', inplace=True)
+    df_logs.index = pd.to_datetime(df_logs.index, unit='ms')
+    return df_logs
+
+
+def timed(func, *args, **kwargs) -> float:
+    """Return the wall time of one call, in seconds."""
+    started = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def main(sizes: list[int]) -> None:
+    cases = [
+        ("collector", legacy_parse_logs_to_dataframe, lambda lines: parse_log_lines(lines)),
+        ("main_logs", legacy_parse_log_entries,
+         lambda lines: parse_log_lines(lines, extra_prefix="add_").set_index("time")),
+    ]
+    print(f"{'lines':>9} {'entry point':<11} {'legacy s':>9} {'batched s':>9} {'speedup':>8}")
+    for n in sizes:
+        lines = make_loki_lines(n)
+        for name, legacy, batched in cases:
+            legacy_s = timed(legacy, lines)
+            batched_s = timed(batched, lines)
+            print(f"{n:>9} {name:<11} {legacy_s:>9.2f} {batched_s:>9.2f} {legacy_s / batched_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000])
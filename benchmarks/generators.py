@@ -0,0 +1,148 @@
+"""
+Seeded generators of synthetic Jaeger traces and Loki log lines.
+
+Both generators are lazy and deterministic: trace `i` and log entry `k` are generated from the seed and their
+index alone, so a stub server can answer any time window without holding the whole day in memory, and runs
+are comparable across commits.
+"""
+import json
+import random
+
+DAY_US = 86_400 * 1_000_000
+LEVELS = ["info", "info", "info", "warn", "error", "debug"]
+OPERATIONS = ["/upload", "/upload", "/upload", "s3.put_object", "db.insert", "auth.check", "thumbnail.render"]
+# Tags every span has, and optional ones that appear on some spans only (dynamic tag sets)
+COMMON_TAGS = [("span.kind", "string"), ("otel.library.name", "string")]
+OPTIONAL_TAGS = [
+    ("http.status_code", "int64"), ("http.method", "string"), ("http.url", "string"),
+    ("error", "bool"), ("upload.size_bytes", "int64"), ("upload.ratio", "float64"),
+    ("db.statement", "string"), ("retry", "bool"), ("payload", "binary"),
+]
+MEAN_SPANS_PER_TRACE = 5
+
+
+MASK_64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    """splitmix64 finaliser: spreads consecutive integers over all 64 bits, like random IDs."""
+    value = (value + 0x9E3779B97F4A7C15) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+def span_id(trace_index: int, span_index: int) -> str:
+    """Return the deterministic hex span ID of a span."""
+    return f"{_mix64(trace_index << 8 | span_index):016x}"
+
+
+def trace_id(trace_index: int) -> str:
+    """Return the deterministic 128-bit hex trace ID of a trace."""
+    return f"{_mix64(trace_index << 1):016x}{_mix64(trace_index << 1 | 1):016x}"
+
+
+def _tag_value(rng: random.Random, key: str, type_: str):
+    if type_ == "bool":
+        return rng.random() < 0.1
+    if type_ == "int64":
+        return rng.choice([200, 200, 200, 201, 404, 500]) if key == "http.status_code" else rng.randint(1, 50_000_000)
+    if type_ == "float64":
+        return rng.random()
+    if type_ == "binary":
+        return "AAECAwQ="
+    return rng.choice(["server", "client", "internal"]) if key == "span.kind" else f"{key}-{rng.randint(0, 50)}"
+
+
+class JaegerTraceGenerator:
+    """Traces spread evenly over one day from `start_us`, with about `n_spans` spans in total."""
+
+    def __init__(self, n_spans: int, seed: int = 42, start_us: int = 1_714_521_600_000_000):
+        self.seed = seed
+        self.start_us = start_us
+        self.n_traces = max(1, n_spans // MEAN_SPANS_PER_TRACE)
+        self.step_us = DAY_US // self.n_traces
+
+    def trace_start(self, index: int) -> int:
+        return self.start_us + index * self.step_us
+
+    def trace_indices(self, start_us: int, end_us: int) -> range:
+        """Return the indices of the traces whose root span starts in [start_us, end_us]."""
+        first = max(0, -(-(start_us - self.start_us) // self.step_us))
+        last = min(self.n_traces - 1, (end_us - self.start_us) // self.step_us)
+        return range(first, last + 1)
+
+    def trace(self, index: int) -> dict:
+        """Return trace `index` as a Jaeger /api/traces object."""
+        rng = random.Random(self.seed * 1_000_003 + index)
+        start = self.trace_start(index)
+        spans = []
+        n_spans = rng.randint(1, 2 * MEAN_SPANS_PER_TRACE - 1)
+        for span_index in range(n_spans):
+            tags = [{"key": key, "type": type_, "value": _tag_value(rng, key, type_)} for key, type_ in COMMON_TAGS]
+            tags += [
+                {"key": key, "type": type_, "value": _tag_value(rng, key, type_)}
+                for key, type_ in OPTIONAL_TAGS if rng.random() < 0.4
+            ]
+            references = [] if span_index == 0 else [{
+                "refType": "CHILD_OF", "traceID": trace_id(index), "spanID": span_id(index, rng.randrange(span_index)),
+            }]
+            spans.append({
+                "traceID": trace_id(index),
+                "spanID": span_id(index, span_index),
+                "operationName": OPERATIONS[0] if span_index == 0 else rng.choice(OPERATIONS),
+                "references": references,
+                "startTime": start + span_index * rng.randint(10, 500),
+                "duration": rng.randint(100, 2_000_000),
+                "tags": tags,
+                "processID": "p1",
+            })
+        return {"traceID": trace_id(index), "spans": spans,
+                "processes": {"p1": {"serviceName": "sr-api", "tags": []}}}
+
+    def traces(self, start_us: int, end_us: int, limit: int | None = None) -> list[dict]:
+        indices = self.trace_indices(start_us, end_us)
+        if limit is not None:
+            indices = indices[:limit]
+        return [self.trace(index) for index in indices]
+
+
+class LokiLogGenerator:
+    """Log entries spread evenly over one day from `start_ns`, logged by the spans of a trace generator."""
+
+    def __init__(self, n_entries: int, traces: JaegerTraceGenerator, seed: int = 42):
+        self.seed = seed
+        self.n_entries = n_entries
+        self.traces = traces
+        self.start_ns = traces.start_us * 1000
+        self.step_ns = DAY_US * 1000 // max(1, n_entries)
+
+    def entry(self, index: int) -> tuple[int, str]:
+        """Return entry `index` as a (timestamp in nanoseconds, JSON line) pair."""
+        rng = random.Random(self.seed * 7_000_003 + index)
+        timestamp_ns = self.start_ns + index * self.step_ns
+        trace_index = index * self.traces.n_traces // self.n_entries
+        line = {
+            "level": rng.choice(LEVELS),
+            "message": f"request handled in {rng.randint(1, 5000)}ms",
+            "time": timestamp_ns // 1_000_000,
+            "span_id": span_id(trace_index, 0),
+            "trace_id": trace_id(trace_index),
+            "status": rng.choice([200, 200, 201, 400, 500]),
+        }
+        if rng.random() < 0.1:
+            line["error"] = "upload failed"
+        return timestamp_ns, json.dumps(line)
+
+    def entries(self, start_ns: int, end_ns: int, limit: int, direction: str = "forward") -> list[tuple[int, str]]:
+        """Return up to `limit` entries of [start_ns, end_ns), oldest first for forward, newest first otherwise."""
+        first = max(0, -(-(start_ns - self.start_ns) // self.step_ns))
+        last = min(self.n_entries, -(-(end_ns - self.start_ns) // self.step_ns))
+        indices = range(first, last) if direction == "forward" else range(last - 1, first - 1, -1)
+        return [self.entry(index) for index in indices[:limit]]
+
+
+def make_loki_lines(n: int, seed: int = 42) -> list[str]:
+    """Generate `n` synthetic sr-api log lines, as Loki returns them."""
+    logs = LokiLogGenerator(n, JaegerTraceGenerator(n, seed), seed)
+    return [logs.entry(index)[1] for index in range(n)]
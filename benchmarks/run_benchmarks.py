@@ -0,0 +1,240 @@
+"""
+Reproducible end-to-end benchmark of the trace, log and enrichment pipelines.
+
+Every scenario serves one seeded synthetic day of Jaeger traces and Loki logs from local stub servers and runs
+the pipelines against them:
+
+    traces: sliced fetch -> flatten -> daily Parquet -> append to the span dataset
+    logs:   parallel paged fetch -> batched parse -> Parquet log batch
+    enrich: out-of-core enrichment, then a first incremental enrichment with a new span index
+
+Each scenario runs in a fresh process, so its peak RSS is its own. Wall time, rows in and out, throughput and
+peak RSS are recorded per stage and written, with the commit they were measured on, to a JSON file.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/run_benchmarks.py [--sizes 10000 100000 1000000] [--output results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import psutil
+
+from benchmarks.generators import JaegerTraceGenerator
+from benchmarks.stub_servers import stub_servers
+from enrich.out_of_core import enrich_spans_out_of_core
+from enrich.span_index import enrich_incremental
+from load_logs.log_store import write_log_batch
+from load_logs.loki_client import SR_API_QUERY, fetch_range_parallel
+from load_logs.parse_logs import parse_log_lines
+from load_traces.utils.fetch_jaeger_traces import iter_jaeger_traces_sliced
+from load_traces.utils.flatten_spans import iter_span_batches, write_span_batches_parquet
+from load_traces.utils.span_dataset import append_spans
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+class PeakRSS:
+    """Sample the resident set size of this process in a background thread and keep the maximum."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+class StageRecorder:
+    """Collect the measurements of the stages of one scenario."""
+
+    def __init__(self):
+        self.stages: list[dict] = []
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None):
+        """Time a stage; the block sets `record['rows_out']` (and may set other fields) on the yielded record."""
+        record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        with PeakRSS() as rss:
+            started = time.perf_counter()
+            yield record
+            record["seconds"] = time.perf_counter() - started
+        record["peak_rss_mb"] = round(rss.peak / 2 ** 20, 1)
+        rows = record["rows_out"] if record["rows_out"] is not None else record["rows_in"]
+        record["rows_per_second"] = round(rows / record["seconds"]) if rows and record["seconds"] else None
+        record["seconds"] = round(record["seconds"], 3)
+        self.stages.append(record)
+        print(f"  {name:<28} {record['seconds']:>9.2f} s {record['rows_per_second'] or 0:>10} rows/s "
+              f"{record['peak_rss_mb']:>9.1f} MB", flush=True)
+
+
+class TimedIterator:
+    """Wrap an iterator and accumulate the time spent producing its items, and their total `size` if given."""
+
+    def __init__(self, iterable, size=None):
+        self._iterator = iter(iterable)
+        self._size = size
+        self.seconds = 0.0
+        self.items = 0
+        self.units = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            item = next(self._iterator)
+        finally:
+            self.seconds += time.perf_counter() - started
+        self.items += 1
+        if self._size is not None:
+            self.units += self._size(item)
+        return item
+
+
+def _local_date_string(timestamp_us: int) -> str:
+    """Format a timestamp the way get_date_strings does, in local time, for iter_jaeger_traces_sliced."""
+    return datetime.fromtimestamp(timestamp_us / 1e6).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def run_scenario(n_spans: int, seed: int, work_dir: Path) -> dict:
+    """Run every stage of one scenario of about `n_spans` spans and as many log lines, in `work_dir`."""
+    recorder = StageRecorder()
+    day = JaegerTraceGenerator(n_spans, seed)
+    start_us, end_us = day.start_us, day.start_us + 86_400 * 1_000_000
+    backup_folder = datetime.fromtimestamp(start_us / 1e6, timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
+    backup_dir = work_dir / "backups" / backup_folder
+    backup_dir.mkdir(parents=True)
+    logs_dir = work_dir / "logs"
+    started = time.perf_counter()
+
+    with stub_servers(n_spans, n_spans, seed) as (jaeger_url, loki_url):
+        with recorder.stage("traces_fetch_flatten_write") as record:
+            stage_started = time.perf_counter()
+            traces = TimedIterator(iter_jaeger_traces_sliced(
+                jaeger_url, "sr-api", _local_date_string(start_us), _local_date_string(end_us),
+                limit=1000, operation="/upload", slice_minutes=60, max_workers=8,
+            ), size=lambda trace: len(trace.get("spans", [])))
+            batches = TimedIterator(iter_span_batches(traces))
+            parquet_path = backup_dir / "daily_upload_spans.parquet"
+            record["rows_out"] = write_span_batches_parquet(batches, parquet_path)
+            record["rows_in"] = traces.units
+            record["traces_in"] = traces.items
+            record["fetch_seconds"] = round(traces.seconds, 3)
+            record["flatten_seconds"] = round(batches.seconds - traces.seconds, 3)
+            record["write_seconds"] = round(time.perf_counter() - stage_started - batches.seconds, 3)
+            record["bytes_out"] = parquet_path.stat().st_size
+
+        with recorder.stage("spans_append", rows_in=record["rows_out"]) as record:
+            record["rows_out"] = sum(append_spans(parquet_path, work_dir / "spans").values())
+
+        with recorder.stage("logs_fetch") as record:
+            results = fetch_range_parallel(loki_url, start_us * 1000, end_us * 1000, SR_API_QUERY, max_workers=8)
+            entries = [entry for result in results for entry in result.entries]
+            record["rows_out"] = len(entries)
+            record["truncated_ranges"] = sum(result.truncated for result in results)
+
+    with recorder.stage("logs_parse", rows_in=len(entries)) as record:
+        logs_df = parse_log_lines([line for _, line in entries])
+        record["rows_out"] = len(logs_df)
+
+    with recorder.stage("logs_write", rows_in=len(logs_df)) as record:
+        part_path = write_log_batch(logs_dir, logs_df, entries[0][0], entries[-1][0])
+        record["rows_out"] = len(logs_df)
+        record["bytes_out"] = part_path.stat().st_size
+    del entries, logs_df
+
+    with recorder.stage("enrich_out_of_core") as record:
+        record["rows_out"] = enrich_spans_out_of_core(work_dir / "backups", logs_dir, work_dir / "enriched")
+
+    with recorder.stage("enrich_incremental") as record:
+        summary = enrich_incremental(work_dir / "backups", logs_dir, work_dir / "enriched_incremental",
+                                     work_dir / "span_index.sqlite")
+        record["rows_in"] = summary["new_spans"]
+
+    total_seconds = time.perf_counter() - started
+    return {
+        "spans": n_spans,
+        "seed": seed,
+        "total_seconds": round(total_seconds, 3),
+        "peak_rss_mb": round(max(stage["peak_rss_mb"] for stage in recorder.stages), 1),
+        "stages": recorder.stages,
+    }
+
+
+def _run_in_child(n_spans: int, seed: int, results: multiprocessing.Queue) -> None:
+    with tempfile.TemporaryDirectory(prefix="bench-") as work_dir:
+        results.put(run_scenario(n_spans, seed, Path(work_dir)))
+
+
+def _git(*args: str) -> str | None:
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(sizes: list[int], seed: int, output: Path | None) -> Path:
+    commit = _git("rev-parse", "HEAD")
+    report = {
+        "commit": commit,
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scenarios": [],
+    }
+    for n_spans in sizes:
+        print(f"Scenario of {n_spans} spans:", flush=True)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_in_child, args=(n_spans, seed, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Scenario of {n_spans} spans failed with exit code {process.exitcode}.")
+        report["scenarios"].append(results.get())
+
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{(commit or 'unknown')[:8]}.json"
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipelines against seeded local Jaeger and Loki stubs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Spans per scenario.")
+    parser.add_argument("--seed", type=int, default=42, help="The seed of the synthetic data.")
+    parser.add_argument("--output", type=Path, default=None, help="The JSON results file.")
+    args = parser.parse_args()
+    main(args.sizes, args.seed, args.output)
@@ -0,0 +1,76 @@
+"""
+Local HTTP stubs of the Jaeger /api/traces and Loki query_range endpoints, backed by the seeded generators.
+
+Each stub runs in its own process, so the work of generating and serialising responses is not counted in
+the time and memory of the pipeline under test.
+"""
+import json
+import multiprocessing
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.generators import JaegerTraceGenerator, LokiLogGenerator
+
+JAEGER_PATH = "/api/traces"
+LOKI_PATH = "/loki/api/v1/query_range"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers Jaeger and Loki queries from the generators attached to the server."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == JAEGER_PATH:
+            limit = int(params["limit"]) if "limit" in params else None
+            traces = self.server.traces.traces(int(params["start"]), int(params["end"]) - 1, limit)
+            body = {"data": traces, "total": 0, "limit": 0, "offset": 0, "errors": None}
+        elif url.path == LOKI_PATH:
+            entries = self.server.logs.entries(
+                int(params["start"]), int(params["end"]), int(params.get("limit", 100)),
+                params.get("direction", "backward"),
+            )
+            values = [[str(timestamp_ns), line] for timestamp_ns, line in entries]
+            stream = {"stream": {"container_name": "/sr-api"}, "values": values}
+            body = {"status": "success", "data": {"resultType": "streams", "result": [stream] if values else []}}
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(n_spans: int, n_log_entries: int, seed: int, ports: multiprocessing.Queue) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.traces = JaegerTraceGenerator(n_spans, seed)
+    server.logs = LokiLogGenerator(n_log_entries, server.traces, seed)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+@contextmanager
+def stub_servers(n_spans: int, n_log_entries: int, seed: int = 42):
+    """
+    Run the Jaeger and Loki stubs in a child process for the duration of the block.
+
+    Yields:
+        tuple[str, str]: The Jaeger /api/traces URL and the Loki query_range URL.
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(n_spans, n_log_entries, seed, ports), daemon=True)
+    process.start()
+    try:
+        base_url = f"http://127.0.0.1:{ports.get(timeout=30)}"
+        yield base_url + JAEGER_PATH, base_url + LOKI_PATH
+    finally:
+        process.terminate()
+        process.join()
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+# The catalog is local state, rewritten by every run, so it lives outside the DVC-tracked data directory
+DEFAULT_CATALOG_PATH = "state/catalog.sqlite"
+DEFAULT_DATA_DIR = "data"
+# The first of these columns a file has gives its time range: startTime for spans, time for logs
+TIME_COLUMNS = ("startTime", "time")
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    min_time INTEGER,
+    max_time INTEGER,
+    schema_hash TEXT NOT NULL,
+    source_query TEXT,
+    size INTEGER NOT NULL,
+    written_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_window ON files (kind, min_time, max_time);
+"""
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    """What the catalog knows about one data file; times are in microseconds, None if the file has no time column."""
+    path: Path
+    kind: str
+    rows: int
+    min_time: int | None
+    max_time: int | None
+    schema_hash: str
+    source_query: dict | None
+    size: int
+
+    def overlaps(self, start_us: int | None, end_us: int | None) -> bool:
+        """Return True if the file may hold rows of [start_us, end_us); files without a time range always may."""
+        if self.min_time is None or self.max_time is None:
+            return True
+        return (start_us is None or self.max_time >= start_us) and (end_us is None or self.min_time < end_us)
+
+
+def date_to_us(date: str) -> int:
+    """Convert a "YYYY-MM-DD" UTC date to a Unix timestamp in microseconds."""
+    return int(datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1_000_000)
+
+
+def schema_hash(schema: pa.Schema) -> str:
+    """Return a short hash of the column names and types of a schema, ignoring its metadata."""
+    return hashlib.sha256(schema.remove_metadata().to_string().encode()).hexdigest()[:16]
+
+
+def _time_range_us(column: pa.Array | pa.ChunkedArray) -> tuple[int | None, int | None]:
+    if not pa.types.is_timestamp(column.type):
+        column = pa.array(pd.to_datetime(column.to_pandas(), errors="coerce"))
+    min_max = pc.min_max(column.cast(pa.timestamp("us")).cast(pa.int64()))
+    return min_max["min"].as_py(), min_max["max"].as_py()
+
+
+def _parquet_stats(path: Path) -> tuple[int, int | None, int | None, pa.Schema]:
+    """Return the rows, time range and schema of a Parquet file from its footer; the data is only read without statistics."""
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    metadata = parquet_file.metadata
+    time_column = next((name for name in TIME_COLUMNS if name in schema.names), None)
+    if time_column is None:
+        return metadata.num_rows, None, None, schema
+    field_type = schema.field(time_column).type
+    index = parquet_file.schema.names.index(time_column) if pa.types.is_timestamp(field_type) else -1
+    statistics = [metadata.row_group(group).column(index).statistics if index >= 0 else None
+                  for group in range(metadata.num_row_groups)]
+    if statistics and all(stats is not None and stats.has_min_max for stats in statistics):
+        units = {"s": 1_000_000, "ms": 1_000, "us": 1, "ns": 0.001}[field_type.unit]
+        return (metadata.num_rows, int(min(stats.min_raw for stats in statistics) * units),
+                int(max(stats.max_raw for stats in statistics) * units), schema)
+    return (metadata.num_rows, *_time_range_us(pq.read_table(path, columns=[time_column]).column(time_column)), schema)
+
+
+def _csv_stats(path: Path) -> tuple[int, int | None, int | None, pa.Schema]:
+    """Return the rows, time range and schema of a CSV file, reading only its time column."""
+    schema = pa_csv.open_csv(path).schema
+    time_column = next((name for name in TIME_COLUMNS if name in schema.names), None)
+    include_columns = [time_column] if time_column else [schema.names[0]]
+    table = pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(include_columns=include_columns))
+    if time_column is None:
+        return table.num_rows, None, None, schema
+    return (table.num_rows, *_time_range_us(table.column(time_column)), schema)
+
+
+class DataCatalog:
+    """
+    A persistent catalog of the span and log files written under the data directory.
+
+    For every file it records the path (relative to the data directory `root`), its kind (daily, backup,
+    spans, logs, ...), row count, time range of `startTime` or `time`, a hash of its schema and the query it
+    was fetched with. Writers record a file right after renaming it into place, each in one SQLite transaction,
+    so the catalog never lists a partial file; readers select the files of a time window from it without
+    opening or even stat-ing the others. Files written without the catalog are recorded on first use by
+    `prune`, from the Parquet footer or the time column of a CSV. Methods may be called from several threads.
+    """
+
+    def __init__(self, path: Path | str, root: Path | str = DEFAULT_DATA_DIR):
+        self.path = Path(path)
+        self.root = Path(root).resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Catalogs used to be kept in the data directory itself; the first open moves them out
+        legacy_path = self.root / self.path.name
+        if not self.path.exists() and legacy_path.exists():
+            logging.info(f"Moving the data catalog {legacy_path} to {self.path}.")
+            legacy_path.replace(self.path)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.executescript(CATALOG_SCHEMA)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, base_dir: Path) -> "DataCatalog":
+        """Open the catalog at `catalog.path` of config.yml, `state/catalog.sqlite` by default."""
+        catalog_config = config.get("catalog") or {}
+        return cls(base_dir / catalog_config.get("path", DEFAULT_CATALOG_PATH), base_dir / DEFAULT_DATA_DIR)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _key(self, path: Path | str) -> str:
+        return Path(os.path.relpath(Path(path).resolve(), self.root)).as_posix()
+
+    def _entry(self, row: tuple) -> CatalogEntry:
+        path, kind, rows, min_time, max_time, file_schema_hash, source_query, size = row
+        return CatalogEntry(self.root / path, kind, rows, min_time, max_time, file_schema_hash,
+                            json.loads(source_query) if source_query else None, size)
+
+    def record(self, path: Path | str, kind: str, source_query: dict | None = None) -> CatalogEntry:
+        """Record a complete file, replacing what was known about its path."""
+        path = Path(path)
+        rows, min_time, max_time, schema = (_parquet_stats if path.suffix == ".parquet" else _csv_stats)(path)
+        entry = CatalogEntry(path, kind, rows, min_time, max_time, schema_hash(schema), source_query,
+                             path.stat().st_size)
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._key(path), kind, rows, min_time, max_time, entry.schema_hash,
+                 json.dumps(source_query, sort_keys=True) if source_query is not None else None, entry.size,
+                 datetime.now(timezone.utc).isoformat()),
+            )
+        return entry
+
+    def move(self, source: Path | str, target: Path | str, kind: str | None = None) -> None:
+        """Record that a file was moved (and optionally changed kind), e.g. a daily file into a backup folder."""
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE files SET path = ?, kind = COALESCE(?, kind) WHERE path = ?",
+                              (self._key(target), kind, self._key(source)))
+
+    def remove(self, path: Path | str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (self._key(path),))
+
+    def entry(self, path: Path | str) -> CatalogEntry | None:
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM files WHERE path = ?", (self._key(path),)).fetchone()
+        return self._entry(row[:8]) if row else None
+
+    def files(self, kind: str | None = None, start_us: int | None = None, end_us: int | None = None) -> list[CatalogEntry]:
+        """Return the recorded files of a kind (all kinds if None) that may hold rows of [start_us, end_us), by path."""
+        query = "SELECT path, kind, rows, min_time, max_time, schema_hash, source_query, size FROM files WHERE 1"
+        params = []
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        if start_us is not None:
+            query += " AND (max_time IS NULL OR max_time >= ?)"
+            params.append(start_us)
+        if end_us is not None:
+            query += " AND (min_time IS NULL OR min_time < ?)"
+            params.append(end_us)
+        with self._lock:
+            rows = self.conn.execute(query + " ORDER BY path", params).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def prune(self, paths: Iterable[Path], kind: str, start_us: int | None = None,
+              end_us: int | None = None) -> list[Path]:
+        """
+        Return the `paths` that may hold rows of [start_us, end_us), in their order.
+
+        Paths the catalog does not know yet are recorded as `kind` first, which reads their footer or time column
+        once; the others are selected from the catalog alone.
+        """
+        paths = list(paths)
+        with self._lock:
+            known = {path: (min_time, max_time) for path, min_time, max_time
+                     in self.conn.execute("SELECT path, min_time, max_time FROM files")}
+        selected = []
+        for path in paths:
+            key = self._key(path)
+            if key not in known:
+                entry = self.record(path, kind)
+                known[key] = (entry.min_time, entry.max_time)
+                logging.info(f"{path} recorded in the data catalog.")
+            min_time, max_time = known[key]
+            if CatalogEntry(path, kind, 0, min_time, max_time, "", None, 0).overlaps(start_us, end_us):
+                selected.append(path)
+        return selected
+
+    def fingerprint(self, paths: Iterable[Path], kind: str) -> str:
+        """
+        Return a hash of what the catalog knows about `paths`: their paths, row counts, time ranges, schemas and
+        sizes. It changes whenever a file is added, moved or removed; unknown files are recorded as `kind` first.
+        """
+        keys = sorted(self._key(path) for path in self.prune(paths, kind))
+        with self._lock:
+            rows = {row[0]: row for row in self.conn.execute(
+                "SELECT path, rows, min_time, max_time, schema_hash, size FROM files")}
+        return hashlib.sha256(json.dumps([rows[key] for key in keys]).encode()).hexdigest()[:16]
@@ -1,66 +1,128 @@
-import os
+import argparse
+from pathlib import Path
+
 import pandas as pd
+from yaml import safe_load
+
+from catalog.data_catalog import DataCatalog
+from enrich.arrow_cache import DEFAULT_CACHE_PATH, write_arrow_cache
+from enrich.ingest import find_backup_files, read_span_files
+from enrich.log_matching import aggregate_logs, join_logs, match_logs
+from enrich.out_of_core import enrich_spans_out_of_core, export_dataset_to_csv
+from enrich.span_index import (DEFAULT_SPAN_INDEX_PATH, LEGACY_SPAN_INDEX_PATH, enrich_incremental,
+                                index_existing_output)
+from load_logs.log_store import find_log_files, read_logs
+from load_traces.utils.table_writer import WriterConfig
+from monitoring.stage_metrics import StageMetrics
 
 
-def process_spans_data(directory_path):
+def process_spans_data(directory_path, columns=None, start_date=None, end_date=None, max_workers=None, catalog=None):
     """
-    Iterates over subfolders within the given directory, finds CSV files,
-    concatenates them into a single DataFrame, converts 'startTime' to datetime,
+    Iterates over subfolders within the given directory, finds span files,
+    reads them in parallel into a single DataFrame, converts 'startTime' to datetime,
     removes duplicates based on 'spanID', and drops empty columns.
 
+    Parquet files are read instead of their CSV siblings. Backup folders are
+    selected by the date in their name, so skipped folders are never opened;
+    with a catalog, files are selected by their recorded startTime range instead.
+
     Parameters:
-    - directory_path: Path to the directory containing subfolders with CSV files.
+    - directory_path: Path to the directory containing subfolders with span files.
+    - columns: Columns to read (spanID is always read); all columns if None.
+    - start_date: First backup folder date to read, "YYYY-MM-DD"; no lower bound if None.
+    - end_date: Last backup folder date to read, "YYYY-MM-DD"; no upper bound if None.
+    - max_workers: Number of files read concurrently; the number of CPUs if None.
+    - catalog: The DataCatalog to select the files of the date range with; folder dates are used if None.
 
     Returns:
     - DataFrame: The processed spans data.
     """
-    all_dataframes = []  # List to hold data from all CSV files
-
-    # Iterate over subfolders and files within the given directory
-    for root, _, files in os.walk(directory_path):
-        for file in files:
-            if file.endswith('.csv'):
-                file_path = os.path.join(root, file)
-                df = pd.read_csv(file_path, low_memory=False)
-                try:
-                    df['startTime'] = pd.to_datetime(df['startTime'])
-                except Exception as e:
-                    print(f"Error converting startTime to datetime in file {file_path}: {e}")
-                all_dataframes.append(df)
-
-    if all_dataframes:
-        concatenated_df = pd.concat(all_dataframes, ignore_index=True)
-        # Remove duplicates based on 'spanID'
-        unique_df = concatenated_df.drop_duplicates(subset=['spanID'])
-        # Drop empty columns
-        cleaned_df = unique_df.dropna(axis=1, how='all')
-        return cleaned_df
-    else:
-        print("No CSV files found in the directory.")
+    span_files = find_backup_files(directory_path, start_date, end_date, catalog=catalog)
+    if not span_files:
+        print("No span files found in the directory.")
         return pd.DataFrame()
 
+    if columns is not None:
+        columns = list(dict.fromkeys(['spanID', *columns]))
+    concatenated_df = read_span_files(span_files, columns=columns, max_workers=max_workers)
+    # Remove duplicates based on 'spanID'
+    unique_df = concatenated_df.drop_duplicates(subset=['spanID'])
+    # Drop empty columns
+    cleaned_df = unique_df.dropna(axis=1, how='all')
+    return cleaned_df
+
 
-def enrich_spans_with_logs(spans_df, logs_file_path):
+def enrich_spans_with_logs(spans_df, logs_dir, match='span_id', aggregate=False):
     """
     Enriches spans data with logs based on matching 'spanID'.
 
+    With match='time', logs without a 'span_id', or whose span is not among the spans, are also matched by
+    trace ID to the innermost span of the trace running at their 'time' (see enrich/log_matching.py).
+
     Parameters:
     - spans_df: DataFrame containing the spans data.
-    - logs_file_path: Path to the logs.csv file used for enriching the data.
+    - logs_dir: Path to the logs directory (Parquet batches and the legacy logs.csv) used for enriching the data.
+    - match: 'span_id' to match logs by span ID only, or 'time' to also match them by trace and time.
+    - aggregate: If True, keep one row per span with the log counts per level and the first error message
+      instead of one row per log.
 
     Returns:
     - DataFrame: The enriched spans data.
     """
     # Load the logs data
-    logs_df = pd.read_csv(logs_file_path, low_memory=False)
-    # Rename 'span_id' to 'spanID' to match the spans DataFrame
-    logs_df.rename(columns={'span_id': 'spanID'}, inplace=True)
-    # Merge with logs data on 'spanID'
-    enriched_df = pd.merge(spans_df, logs_df, on='spanID', how='left')
-    return enriched_df
+    logs_df = read_logs(logs_dir)
+    if match == 'span_id' and not aggregate:
+        # Rename 'span_id' to 'spanID' to match the spans DataFrame
+        logs_df.rename(columns={'span_id': 'spanID'}, inplace=True)
+        # Merge with logs data on 'spanID'
+        return pd.merge(spans_df, logs_df, on='spanID', how='left')
+    log_rows = match_logs(spans_df, logs_df, match)
+    if aggregate:
+        return aggregate_logs(spans_df, logs_df, log_rows)
+    return join_logs(spans_df, logs_df, log_rows)
 
 
 if __name__ == "__main__":
-    spans_df = process_spans_data("data/backups")
-    enriched_df = enrich_spans_with_logs(spans_df, "data/logs/logs.csv")
-    enriched_df.to_csv("enriched_spans.csv", index=False)
+    parser = argparse.ArgumentParser(description="Enrich the backed-up spans with logs.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="re-enrich the whole history out of core and rebuild the span index")
+    parser.add_argument("--export-csv", action="store_true",
+                        help="also export the enriched spans to enriched_spans.csv")
+    args = parser.parse_args()
+
+    base_dir = Path(__file__).resolve().parent
+    with open(base_dir / "config.yml") as file:
+        config = safe_load(file)
+    backups_dir = base_dir / "data" / "backups"
+    logs_dir = base_dir / "data" / "logs"
+    output_dir = base_dir / "data" / "enriched_spans"
+    writer_config = WriterConfig.from_config(config)
+
+    enrich_config = config.get("enrich") or {}
+    span_index_path = base_dir / enrich_config.get("index_path", DEFAULT_SPAN_INDEX_PATH)
+    legacy_index_path = base_dir / LEGACY_SPAN_INDEX_PATH
+    # The span index used to be kept in the data directory; moving it avoids re-enriching the whole history
+    if not span_index_path.exists() and legacy_index_path.exists():
+        span_index_path.parent.mkdir(parents=True, exist_ok=True)
+        legacy_index_path.replace(span_index_path)
+
+    with StageMetrics.from_config("enrich", config, base_dir) as metrics:
+        if args.rebuild or not span_index_path.exists():
+            # Out-of-core: spans and logs are bucketed by span ID on disk and joined one bucket at a time
+            enrich_spans_out_of_core(backups_dir, logs_dir, output_dir, metrics=metrics, config=writer_config)
+            with metrics.stage("index"):
+                index_existing_output(backups_dir, logs_dir, output_dir, span_index_path)
+        else:
+            # Incremental: only the span and log files added since the last run are processed
+            with metrics.stage("merge") as record:
+                summary = enrich_incremental(backups_dir, logs_dir, output_dir, span_index_path, config=writer_config)
+                record.rows_out = summary["new_spans"]
+        # Memory-mapped by the readers of load_arrow_cache; rebuilt only when the input files changed
+        if any(output_dir.glob("date=*/*.parquet")):
+            with metrics.stage("arrow_cache") as record, DataCatalog.from_config(config, base_dir) as catalog:
+                fingerprint = catalog.fingerprint(find_backup_files(backups_dir), "backup") + \
+                    catalog.fingerprint(find_log_files(logs_dir), "logs")
+                record.rows_out = write_arrow_cache(output_dir, base_dir / DEFAULT_CACHE_PATH, fingerprint) or 0
+        if args.export_csv:
+            with metrics.stage("export_csv") as record:
+                record.rows_out = export_dataset_to_csv(output_dir, base_dir / "enriched_spans.csv", writer_config)
@@ -0,0 +1,111 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from load_traces.utils.span_dataset import span_dataset
+
+DEFAULT_CACHE_PATH = "enriched_spans.arrow"
+# Schema metadata key of the fingerprint of the inputs the cache was built from
+FINGERPRINT_KEY = b"inputs_fingerprint"
+
+
+class _DictionaryUnifier:
+    """
+    Re-encode the dictionary columns of successive batches against one growing dictionary per column.
+
+    The IPC file format cannot replace a dictionary between batches, only extend it, and every file of a
+    dataset has its own dictionaries. Remapped this way, each batch's dictionary starts with the previous one,
+    so the writer only emits the new values as a delta.
+    """
+
+    def __init__(self):
+        self.values: dict[str, list] = {}
+        self.positions: dict[str, dict] = {}
+
+    def __call__(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        arrays = [self._remap(name, column) if pa.types.is_dictionary(column.type) else column
+                  for name, column in zip(batch.schema.names, batch.columns)]
+        return pa.RecordBatch.from_arrays(arrays, schema=batch.schema)
+
+    def _remap(self, name: str, column: pa.DictionaryArray) -> pa.DictionaryArray:
+        values = self.values.setdefault(name, [])
+        positions = self.positions.setdefault(name, {})
+        mapping = np.empty(len(column.dictionary), dtype=np.int32)
+        for index, value in enumerate(column.dictionary.to_pylist()):
+            if value not in positions:
+                positions[value] = len(values)
+                values.append(value)
+            mapping[index] = positions[value]
+        indices = np.asarray(pc.fill_null(column.indices, 0)).astype(np.intp)
+        remapped = pa.array(mapping[indices] if len(mapping) else np.zeros(len(column), dtype=np.int32),
+                            type=column.type.index_type, mask=np.asarray(column.is_null()))
+        return pa.DictionaryArray.from_arrays(remapped, pa.array(values, type=column.type.value_type))
+
+
+def cache_fingerprint(cache_path: Path | str) -> str | None:
+    """Return the input fingerprint a cache file was built from, or None if there is no cache."""
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return None
+    metadata = pa.ipc.open_file(pa.memory_map(str(cache_path))).schema.metadata or {}
+    fingerprint = metadata.get(FINGERPRINT_KEY)
+    return fingerprint.decode() if fingerprint is not None else None
+
+
+def write_arrow_cache(dataset_dir: Path | str, cache_path: Path | str, fingerprint: str | None = None) -> int | None:
+    """
+    Write a partitioned Parquet dataset (e.g. data/enriched_spans) as one uncompressed Arrow IPC (Feather v2) file.
+
+    The dataset is streamed batch by batch under its unified schema, with its `date` partition column, and the
+    columns stay in their compact types (uint64 IDs, dictionaries). The file is written under a temporary name
+    and renamed, so readers that have the previous file mapped keep reading it. `fingerprint` identifies the
+    inputs the dataset was built from and is stored in the file; when it matches the fingerprint of the
+    existing cache, nothing is written.
+
+    Returns:
+        int | None: The number of rows written, or None if the cache was already up to date or the dataset has
+            no files yet.
+    """
+    cache_path = Path(cache_path)
+    if not any(Path(dataset_dir).glob('date=*/*.parquet')):
+        logging.info(f"{dataset_dir} has no data files, no cache is written.")
+        return None
+    if fingerprint is not None and cache_fingerprint(cache_path) == fingerprint:
+        logging.info(f"{cache_path} is up to date.")
+        return None
+    dataset = span_dataset(dataset_dir)
+    schema = dataset.schema.with_metadata({FINGERPRINT_KEY: fingerprint or ""})
+    unify = _DictionaryUnifier()
+    rows = 0
+    tmp_path = cache_path.with_name(f".{cache_path.name}.tmp")
+    with pa.ipc.new_file(tmp_path, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)) as writer:
+        for batch in dataset.to_batches():
+            writer.write_batch(unify(pa.RecordBatch.from_arrays(batch.columns, schema=schema)))
+            rows += batch.num_rows
+    tmp_path.replace(cache_path)
+    logging.info(f"{rows} rows of {dataset_dir} cached in {cache_path}.")
+    return rows
+
+
+def load_arrow_cache(cache_path: Path | str = DEFAULT_CACHE_PATH, columns: list[str] | None = None) -> pa.Table:
+    """
+    Load the Arrow cache without copying it: the table's buffers point into a read-only memory map of the file.
+
+    Pages are read from disk on first access and live in the OS page cache, so every process on the host that
+    loads the cache shares one copy of it.
+    """
+    table = pa.ipc.open_file(pa.memory_map(str(cache_path))).read_all()
+    return table.select(columns) if columns is not None else table
+
+
+def load_arrow_cache_pandas(cache_path: Path | str = DEFAULT_CACHE_PATH,
+                            columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Load the Arrow cache as a pandas DataFrame of Arrow-backed columns (`pd.ArrowDtype`), which wrap the
+    memory-mapped buffers instead of copying them into numpy arrays.
+    """
+    return load_arrow_cache(cache_path, columns).to_pandas(types_mapper=pd.ArrowDtype)
@@ -0,0 +1,136 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from catalog.data_catalog import DataCatalog, date_to_us
+from load_traces.utils.compact_schema import SPAN_ID_COLUMNS, TRACE_ID_COLUMNS, compact_table, storage_columns, \
+    to_pandas
+from load_traces.utils.flatten_spans import conform_batch, unify_schemas
+
+# Identifier columns that CSV type inference must not turn into numbers
+ID_COLUMNS = SPAN_ID_COLUMNS + TRACE_ID_COLUMNS
+
+
+def backup_date(folder_name: str) -> str | None:
+    """Return the YYYY-MM-DD date of a backup folder named like 2024-05-01_03-00-00, or None."""
+    date = folder_name[:10]
+    return date if len(date) == 10 and date[4] == date[7] == '-' and date.replace('-', '').isdigit() else None
+
+
+def find_backup_files(
+        directory_path: Path | str,
+        start_date: str | None = None,
+        end_date: str | None = None,
+        prefer_parquet: bool = True,
+        catalog: DataCatalog | None = None
+) -> list[Path]:
+    """
+    List the span files of the backup folders, oldest folder first.
+
+    Without a catalog, folders are filtered by the date in their name without opening any file; folders whose
+    name holds no date are always included. With a `catalog`, files are filtered by the `startTime` range the
+    catalog recorded for them instead, also without opening them. Of a CSV and a Parquet file with the same
+    name, only the Parquet one is returned when `prefer_parquet` is set.
+
+    Args:
+        directory_path (Path | str): The backups directory, e.g. data/backups.
+        start_date (str, optional): The first backup date to include, "YYYY-MM-DD". Defaults to None.
+        end_date (str, optional): The last backup date to include, "YYYY-MM-DD". Defaults to None.
+        prefer_parquet (bool, optional): Read Parquet files instead of their CSV siblings. Defaults to True.
+        catalog (DataCatalog, optional): The data catalog to select the files with. Defaults to None.
+
+    Returns:
+        list[Path]: The files to read.
+    """
+    files = []
+    for root, _, names in sorted(os.walk(directory_path)):
+        date = backup_date(Path(root).name)
+        if catalog is None and date is not None and (start_date and date < start_date or end_date and date > end_date):
+            continue
+        stems = {}
+        for name in sorted(names):
+            path = Path(root) / name
+            if path.suffix == '.csv' or (prefer_parquet and path.suffix == '.parquet'):
+                if path.stem not in stems or path.suffix == '.parquet':
+                    stems[path.stem] = path
+        files.extend(stems.values())
+    if catalog is not None and (start_date or end_date):
+        files = catalog.prune(files, 'backup', date_to_us(start_date) if start_date else None,
+                              date_to_us(end_date) + 86_400_000_000 if end_date else None)
+    return files
+
+
+def read_span_file(path: Path, columns: list[str] | None = None) -> pa.Table:
+    """
+    Read one CSV or Parquet span or log file, with only the requested columns, converted to the compact schema.
+
+    CSV files are parsed by Arrow's multithreaded reader, which does not hold the GIL, with identifier columns
+    read as strings; hex IDs, whether from CSV or from files written before IDs were stored as integers, are
+    then converted by `compact_table`.
+    """
+    if columns is not None:
+        columns = storage_columns(columns)
+    return compact_table(_read_file(path, columns))
+
+
+def _read_file(path: Path, columns: list[str] | None) -> pa.Table:
+    if path.suffix == '.parquet':
+        if columns is not None:
+            columns = [name for name in columns if name in pq.read_schema(path).names]
+        return pq.read_table(path, columns=columns)
+
+    include_columns = None
+    if columns is not None:
+        header = pa_csv.open_csv(path).schema.names
+        include_columns = [name for name in columns if name in header]
+    convert_options = pa_csv.ConvertOptions(
+        column_types={name: pa.string() for name in ID_COLUMNS},
+        include_columns=include_columns,
+    )
+    try:
+        return pa_csv.read_csv(path, convert_options=convert_options)
+    except pa.ArrowInvalid as e:
+        # Column types inferred from the first block do not hold for the whole file
+        logging.warning(f"Column types of {path} are inconsistent ({e}), reading it as strings.")
+        header = pa_csv.open_csv(path, convert_options=convert_options).schema.names
+        convert_options.column_types = {name: pa.string() for name in header}
+        return pa_csv.read_csv(path, convert_options=convert_options)
+
+
+def read_span_files(
+        paths: list[Path],
+        columns: list[str] | None = None,
+        max_workers: int | None = None
+) -> pd.DataFrame:
+    """
+    Read many span files concurrently and concatenate them, in the order of `paths`, under a unified schema.
+
+    Args:
+        paths (list[Path]): The files to read.
+        columns (list[str], optional): The columns to read. Defaults to None, all columns.
+        max_workers (int, optional): The number of files read at once. Defaults to the number of CPUs.
+
+    Returns:
+        DataFrame: The concatenated spans, with startTime as datetime and IDs as UInt64.
+    """
+    if not paths:
+        return pd.DataFrame()
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        tables = list(executor.map(lambda path: read_span_file(path, columns), paths))
+
+    schema = unify_schemas(table.schema for table in tables)
+    batches = [conform_batch(batch, schema) for table in tables for batch in table.to_batches()]
+    df = to_pandas(pa.Table.from_batches(batches, schema=schema))
+    if 'startTime' in df.columns:
+        try:
+            df['startTime'] = pd.to_datetime(df['startTime'])
+        except (ValueError, TypeError) as e:
+            logging.error(f"Error converting startTime to datetime: {e}")
+    logging.info(f"Read {len(df)} rows from {len(paths)} span files.")
+    return df
@@ -0,0 +1,174 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from load_traces.utils.compact_schema import trace_id_columns
+from load_traces.utils.trace_tree import trace_ordinals
+
+# How logs are matched to spans: by their span_id only, or also by trace and time
+MATCH_MODES = ('span_id', 'time')
+# Log times have millisecond resolution, so a log may read up to 1 ms before the start of its span
+TIME_TOLERANCE_US = 1000
+ERROR_LEVELS = ('error', 'fatal', 'critical', 'panic')
+
+
+def _to_us(values: pd.Series) -> np.ndarray:
+    """Return a datetime column as int64 microseconds."""
+    return pd.to_datetime(values).to_numpy(dtype='datetime64[us]').astype(np.int64)
+
+
+def _id_values(df: pd.DataFrame, name: str) -> tuple[np.ndarray, np.ndarray]:
+    """Return a UInt64 ID column as uint64 values with nulls as 0, and the mask of valid rows."""
+    if name not in df.columns:
+        return np.zeros(len(df), dtype=np.uint64), np.zeros(len(df), dtype=bool)
+    column = df[name].astype('UInt64')
+    return column.fillna(0).to_numpy(dtype=np.uint64), column.notna().to_numpy()
+
+
+def match_logs_by_span_id(spans: pd.DataFrame, logs: pd.DataFrame) -> np.ndarray:
+    """Return the row of the span whose `spanID` is the `span_id` of every log, or -1; the first of duplicate spans wins."""
+    span_ids = pd.Index(spans['spanID'].astype('UInt64'))
+    rows = np.flatnonzero(~span_ids.duplicated() & span_ids.notna())
+    if 'span_id' not in logs.columns or not len(rows):
+        return np.full(len(logs), -1, dtype=np.int64)
+    positions = pd.Index(span_ids[rows]).get_indexer(logs['span_id'].astype('UInt64'))
+    return np.where(positions >= 0, rows[positions], -1).astype(np.int64)
+
+
+def _enclosing_spans(traces: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """
+    For spans sorted by (trace, start), return the position of the nearest earlier span of the same trace that
+    ends later, or -1.
+
+    The spans between a span and that one all end no later than it, so when a span has ended before a time, so
+    have they, and the search for a span still running can jump over them. The positions are found by pointer
+    jumping: each round replaces the candidate of every span that ends no later than it by the candidate's
+    own candidate, for all spans at once, until every candidate ends later or is -1.
+    """
+    positions = np.arange(len(traces)) - 1
+    same_trace = np.zeros(len(traces), dtype=bool)
+    same_trace[1:] = traces[1:] == traces[:-1]
+    enclosing = np.where(same_trace, positions, -1)
+    active = np.flatnonzero(enclosing >= 0)
+    while len(active):
+        active = active[end[enclosing[active]] <= end[active]]
+        enclosing[active] = enclosing[enclosing[active]]
+        active = active[enclosing[active] >= 0]
+    return enclosing
+
+
+def match_logs_by_time(spans: pd.DataFrame, logs: pd.DataFrame, tolerance_us: int = TIME_TOLERANCE_US) -> np.ndarray:
+    """
+    Return the row of the innermost span of its trace whose [startTime, startTime + duration] holds the `time`
+    of every log, or -1. The innermost span is the one that started last.
+
+    For each log, the span of the same trace that started last at or before the log is found with one
+    `merge_asof` of the logs sorted by time against the spans sorted by start. If that span had already ended,
+    the search goes on from the nearest earlier span that ends later (`_enclosing_spans`), for all such logs at
+    once, until a span still running is found. Intervals are widened by `tolerance_us` on both sides.
+    """
+    log_rows = np.full(len(logs), -1, dtype=np.int64)
+    high_name, low_name = trace_id_columns('traceID')
+    log_high_name, log_low_name = trace_id_columns('trace_id')
+    if not len(spans) or not len(logs) or log_high_name not in logs.columns or 'time' not in logs.columns:
+        return log_rows
+
+    span_high, _ = _id_values(spans, high_name)
+    span_low, span_valid = _id_values(spans, low_name)
+    log_high, _ = _id_values(logs, log_high_name)
+    log_low, log_valid = _id_values(logs, log_low_name)
+    traces = trace_ordinals(np.concatenate([span_high, log_high]), np.concatenate([span_low, log_low]))
+    span_traces, log_traces = traces[:len(spans)], traces[len(spans):]
+    start = _to_us(spans['startTime'])
+    end = start + spans['duration'].fillna(0).to_numpy(dtype=np.int64)
+    times = _to_us(logs['time'])
+
+    # Spans sorted by (trace, start); the search below works on positions in this order
+    valid_spans = np.flatnonzero(span_valid & spans['startTime'].notna().to_numpy())
+    order = valid_spans[np.lexsort((start[valid_spans], span_traces[valid_spans]))]
+    sorted_end = end[order]
+    enclosing = _enclosing_spans(span_traces[order], sorted_end)
+
+    valid_logs = np.flatnonzero(log_valid & logs['time'].notna().to_numpy())
+    left = pd.DataFrame({'trace': log_traces[valid_logs], 'time': times[valid_logs] + tolerance_us,
+                         'log': valid_logs}).sort_values('time', kind='stable')
+    right = pd.DataFrame({'trace': span_traces[order], 'time': start[order],
+                          'position': np.arange(len(order))}).sort_values('time', kind='stable')
+    candidates = pd.merge_asof(left, right, on='time', by='trace', direction='backward')
+    candidates = candidates[candidates['position'].notna()]
+    logs_left = candidates['log'].to_numpy(dtype=np.int64)
+    positions = candidates['position'].to_numpy(dtype=np.int64)
+    while len(logs_left):
+        inside = times[logs_left] <= sorted_end[positions] + tolerance_us
+        log_rows[logs_left[inside]] = order[positions[inside]]
+        logs_left, positions = logs_left[~inside], enclosing[positions[~inside]]
+        found = positions >= 0
+        logs_left, positions = logs_left[found], positions[found]
+    return log_rows
+
+
+def match_logs(spans: pd.DataFrame, logs: pd.DataFrame, mode: str = 'span_id',
+               tolerance_us: int = TIME_TOLERANCE_US) -> np.ndarray:
+    """
+    Return the row of the span every log belongs to, or -1.
+
+    With mode 'span_id' a log belongs to the span of its `span_id`. With mode 'time' logs whose span is not
+    among the spans are matched by trace and time with `match_logs_by_time`, which also covers logs without a
+    `span_id`.
+
+    Raises:
+        ValueError: If `mode` is not one of `MATCH_MODES`.
+    """
+    if mode not in MATCH_MODES:
+        raise ValueError(f"Unknown log matching mode {mode!r}, expected one of {', '.join(MATCH_MODES)}")
+    log_rows = match_logs_by_span_id(spans, logs)
+    if mode == 'time':
+        unmatched = np.flatnonzero(log_rows < 0)
+        by_time = match_logs_by_time(spans, logs.iloc[unmatched], tolerance_us)
+        log_rows[unmatched] = by_time
+    return log_rows
+
+
+def join_logs(spans: pd.DataFrame, logs: pd.DataFrame, log_rows: np.ndarray) -> pd.DataFrame:
+    """Left-join the logs to the spans they were matched to: one row per matched log, and one per span without logs."""
+    matched = np.flatnonzero(log_rows >= 0)
+    log_columns = [column for column in logs.columns if column not in ('span_id', 'spanID')]
+    pairs = logs.iloc[matched][log_columns].assign(_span_row=log_rows[matched])
+    joined = spans.assign(_span_row=np.arange(len(spans))).merge(pairs, on='_span_row', how='left', sort=True)
+    return joined.drop(columns='_span_row')
+
+
+def _level_column(level: str) -> str:
+    return 'log_count_' + re.sub(r'[^0-9a-z]+', '_', level.lower()).strip('_')
+
+
+def aggregate_logs(spans: pd.DataFrame, logs: pd.DataFrame, log_rows: np.ndarray) -> pd.DataFrame:
+    """
+    Summarize the logs matched to every span, keeping one row per span.
+
+    Adds `log_count`, a `log_count_<level>` column per log level and `first_error_message`, the message of the
+    earliest log of an `ERROR_LEVELS` level of the span (null if none).
+    """
+    matched = np.flatnonzero(log_rows >= 0)
+    span_rows = log_rows[matched]
+    counts = {'log_count': np.bincount(span_rows, minlength=len(spans))}
+    if 'level' in logs.columns:
+        levels = logs['level'].iloc[matched].astype('string')
+        codes, names = pd.factorize(levels.str.lower())
+        for code, name in enumerate(names):
+            column = _level_column(name)
+            level_counts = np.bincount(span_rows[codes == code], minlength=len(spans))
+            counts[column] = counts.get(column, 0) + level_counts
+    result = spans.assign(**counts)
+
+    message = 'message' if 'message' in logs.columns else 'msg' if 'msg' in logs.columns else None
+    first_error = pd.Series(pd.NA, index=spans.index, dtype='string')
+    if message is not None and 'level' in logs.columns and len(matched):
+        errors = logs.iloc[matched].assign(_span_row=span_rows)
+        errors = errors[errors['level'].astype('string').str.lower().isin(ERROR_LEVELS).fillna(False).to_numpy()]
+        if 'time' in errors.columns:
+            errors = errors.sort_values('time', kind='stable')
+        errors = errors.drop_duplicates('_span_row')
+        first_error.iloc[errors['_span_row'].to_numpy()] = errors[message].astype('string').to_numpy()
+    return result.assign(first_error_message=first_error)
@@ -0,0 +1,267 @@
+import csv
+import logging
+import shutil
+from collections.abc import Iterator
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from catalog.data_catalog import DataCatalog
+from enrich.ingest import ID_COLUMNS, find_backup_files
+from load_logs.log_store import find_log_files
+from load_traces.utils.compact_schema import DICTIONARY_TYPE, compact_table, storage_columns, to_pandas
+from load_traces.utils.flatten_spans import unify_schemas
+from load_traces.utils.span_dataset import span_dataset, update_dataset_schema
+from load_traces.utils.table_writer import WriterConfig, write_batches, write_table
+from monitoring.stage_metrics import StageMetrics
+
+BUCKET_PARTITIONING = ds.partitioning(pa.schema([('bucket', pa.string())]), flavor='hive')
+
+
+def _file_format(path: Path, all_strings: bool = False) -> ds.FileFormat:
+    """Return the dataset format of a span or log file; CSV identifier columns are always read as strings."""
+    if path.suffix == '.parquet':
+        return ds.ParquetFileFormat()
+    if all_strings:
+        with open(path, newline='') as file:
+            header = next(csv.reader(file), [])
+        column_types = {name: pa.string() for name in header}
+    else:
+        column_types = {name: pa.string() for name in ID_COLUMNS}
+    return ds.CsvFileFormat(convert_options=pa_csv.ConvertOptions(column_types=column_types))
+
+
+def _iter_projected_batches(
+        path: Path,
+        key: str,
+        columns: list[str] | None,
+        all_strings: bool,
+        bucket_chars: int
+) -> Iterator[pa.RecordBatch]:
+    """
+    Scan a file lazily, reading only `columns` (plus `key`), convert it to the compact schema and add its hash
+    bucket column. A file without the `key` column, e.g. a log batch of start-up logs only, yields nothing.
+    """
+    dataset = ds.dataset(path, format=_file_format(path, all_strings))
+    if key not in dataset.schema.names:
+        logging.info(f"{path} has no {key} column, none of its rows are spilled.")
+        return
+    projection = None
+    if columns is not None:
+        projection = [name for name in storage_columns([key, *columns]) if name in dataset.schema.names]
+    for batch in dataset.to_batches(columns=projection):
+        # Only the fixed dictionary columns are encoded, so every batch of the file gets the same schema
+        batch = compact_table(batch, dictionary_threshold=None)
+        buckets = _bucket_of(batch.column(key), bucket_chars)
+        yield pa.RecordBatch.from_arrays([*batch.columns, buckets], names=[*batch.schema.names, 'bucket'])
+
+
+def _bucket_of(keys: pa.Array, bucket_chars: int) -> pa.Array:
+    """Bucket integer identifiers by their last `bucket_chars` hex digits; ids are random, so buckets are even."""
+    buckets = pc.bit_wise_and(keys, pa.scalar(16 ** bucket_chars - 1, pa.uint64())).cast(pa.string())
+    return pc.fill_null(buckets, '-')
+
+
+def spill_to_buckets(
+        paths: list[Path],
+        key: str,
+        spill_dir: Path,
+        columns: list[str] | None = None,
+        bucket_chars: int = 1
+) -> None:
+    """
+    Hash-partition the rows of many CSV/Parquet files into `<spill_dir>/bucket=<x>/` Parquet files by `key`.
+
+    Each file is streamed batch by batch and written with its own schema. A CSV whose column types change
+    after the first block is read again with every column as a string. Files keep their order through the
+    numbering of the spill files, so the first occurrence of a key can still be told apart. The spill files
+    are scratch data removed after the join, so they are written by Arrow's dataset writer with its defaults
+    rather than by a `TableWriter`.
+    """
+    for index, path in enumerate(paths):
+        for all_strings in (False, True):
+            try:
+                batches = _iter_projected_batches(path, key, columns, all_strings, bucket_chars)
+                first = next(batches, None)
+                if first is None:
+                    break
+                ds.write_dataset(
+                    _chain(first, batches), spill_dir, schema=first.schema, format='parquet',
+                    partitioning=BUCKET_PARTITIONING, basename_template=f"f{index:05d}-{{i}}.parquet",
+                    existing_data_behavior='overwrite_or_ignore',
+                )
+                break
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                for partial in spill_dir.glob(f"bucket=*/f{index:05d}-*.parquet"):
+                    partial.unlink()
+                if all_strings:
+                    raise
+                logging.warning(f"Column types of {path} are inconsistent ({e}), reading it as strings.")
+        logging.debug(f"Spilled {path} into {spill_dir}.")
+
+
+def _chain(first: pa.RecordBatch, rest: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    yield first
+    yield from rest
+
+
+def _spill_order(path: Path) -> tuple[int, int]:
+    """Sort key of a spill file f<file>-<i>.parquet: source file order, then write order."""
+    file_index, part_index = path.stem[1:].split('-')
+    return int(file_index), int(part_index)
+
+
+def read_bucket(bucket_dir: Path) -> pd.DataFrame:
+    """Load one spilled bucket under the unified schema of its files, in source file order."""
+    if not bucket_dir.exists():
+        return pd.DataFrame()
+    files = sorted(bucket_dir.glob('*.parquet'), key=_spill_order)
+    if not files:
+        return pd.DataFrame()
+    schema = unify_schemas(pq.read_schema(file) for file in files)
+    return to_pandas(ds.dataset([str(file) for file in files], schema=schema, format='parquet').to_table())
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Convert a DataFrame to Arrow, turning object columns of mixed types into strings.
+
+    Categoricals of strings become dictionaries with int32 indices, whatever the number of categories,
+    so the files of a dataset agree on their dictionary types.
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].map(lambda value: None if pd.isna(value) else str(value))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    for index, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type) and pa.types.is_string(field.type.value_type):
+            table = table.set_column(index, field.name, table.column(index).cast(DICTIONARY_TYPE))
+    return table
+
+
+def with_date(table: pa.Table) -> pa.Table:
+    """Add the date=YYYY-MM-DD partition column from startTime."""
+    start_time = table.column('startTime')
+    if pa.types.is_timestamp(start_time.type):
+        dates = pc.strftime(start_time, format='%Y-%m-%d')
+    else:
+        dates = pc.utf8_slice_codeunits(start_time.cast(pa.string()), start=0, stop=10)
+    return table.append_column('date', pc.fill_null(dates, 'unknown'))
+
+
+def enrich_spans_out_of_core(
+        backups_dir: Path | str,
+        logs_dir: Path | str,
+        output_dir: Path | str,
+        columns: list[str] | None = None,
+        spill_dir: Path | str | None = None,
+        bucket_chars: int = 1,
+        start_date: str | None = None,
+        end_date: str | None = None,
+        metrics: StageMetrics | None = None,
+        catalog: DataCatalog | None = None,
+        config: WriterConfig | None = None
+) -> int:
+    """
+    De-duplicate the backed-up spans by spanID and left-join them with the logs, without loading everything at once.
+
+    Spans and logs are scanned file by file (only `columns` are read, if given) and spilled into hash buckets
+    on their span ID, 16 ** `bucket_chars` of them. Each bucket is then de-duplicated and joined on its own, so
+    peak memory is about one bucket of spans and logs. The output is written as a Parquet dataset partitioned by
+    span date (`date=YYYY-MM-DD/part-<bucket>.parquet`, one file per bucket written with `config`), replacing
+    `output_dir` once complete; read it with `load_traces.utils.span_dataset.read_spans`.
+
+    Args:
+        backups_dir (Path | str): The directory with the backup folders of span files (Parquet preferred over CSV).
+        logs_dir (Path | str): The logs directory (Parquet batches and the legacy logs.csv).
+        output_dir (Path | str): The directory of the enriched dataset.
+        columns (list[str], optional): The span columns to keep; spanID and startTime are always read. Defaults to None, all columns.
+        spill_dir (Path | str, optional): Where to spill buckets. Defaults to `<output_dir>.spill`.
+        bucket_chars (int, optional): The number of trailing hex digits of the span ID that pick the bucket. Defaults to 1.
+        start_date (str, optional): The first backup folder date to read, "YYYY-MM-DD". Defaults to None.
+        end_date (str, optional): The last backup folder date to read, "YYYY-MM-DD". Defaults to None.
+        metrics (StageMetrics, optional): Where to record the spill, dedup, merge and write stages. Defaults to None.
+        catalog (DataCatalog, optional): The data catalog to select the span files of the date range with,
+            by their startTime range instead of their folder date. Defaults to None.
+        config (WriterConfig, optional): The compression and row group size of the output. Defaults to WriterConfig().
+
+    Returns:
+        int: The number of enriched rows written.
+    """
+    metrics = metrics or StageMetrics("enrich")
+    output_dir = Path(output_dir)
+    spill_dir = Path(spill_dir) if spill_dir else output_dir.with_name(f"{output_dir.name}.spill")
+    staging_dir = output_dir.with_name(f"{output_dir.name}.tmp")
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    if columns is not None:
+        columns = list(dict.fromkeys(['spanID', 'startTime', *columns]))
+
+    span_files = find_backup_files(backups_dir, start_date, end_date, catalog=catalog)
+    if not span_files:
+        logging.warning(f"No span files found in {backups_dir}.")
+        return 0
+    with metrics.stage("spill"):
+        logging.info(f"Spilling {len(span_files)} span files into buckets.")
+        spill_to_buckets(span_files, 'spanID', spill_dir / 'spans', columns, bucket_chars)
+        logging.info("Spilling log files into buckets.")
+        spill_to_buckets(find_log_files(logs_dir), 'span_id', spill_dir / 'logs', bucket_chars=bucket_chars)
+
+    rows_written = 0
+    staging_dir.mkdir(parents=True)
+    try:
+        for bucket_dir in sorted((spill_dir / 'spans').glob('bucket=*')):
+            bucket = bucket_dir.name.split('=', 1)[1]
+            with metrics.stage("dedup") as record:
+                bucket_df = read_bucket(bucket_dir)
+                spans_df = bucket_df.drop_duplicates(subset=['spanID'])
+                record.rows_in, record.rows_out = len(bucket_df), len(spans_df)
+            with metrics.stage("merge", rows_in=len(spans_df)) as record:
+                logs_df = read_bucket(spill_dir / 'logs' / bucket_dir.name)
+                if logs_df.empty:
+                    enriched_df = spans_df
+                else:
+                    logs_df = logs_df.rename(columns={'span_id': 'spanID'})
+                    enriched_df = pd.merge(spans_df, logs_df, on='spanID', how='left')
+                record.rows_out = len(enriched_df)
+
+            with metrics.stage("write", rows_in=len(enriched_df)) as record:
+                table = with_date(to_arrow_table(enriched_df))
+                dates = table.column('date')
+                table = table.drop(['date'])
+                for date in pc.unique(dates).to_pylist():
+                    partition_dir = staging_dir / f"date={date}"
+                    partition_dir.mkdir(exist_ok=True)
+                    write_table(table.filter(pc.equal(dates, date)), partition_dir / f"part-{bucket}.parquet", config)
+                update_dataset_schema(staging_dir, table.schema)
+                record.rows_out = table.num_rows
+            rows_written += table.num_rows
+            logging.debug(f"Bucket {bucket}: {len(spans_df)} spans, {table.num_rows} enriched rows.")
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    staging_dir.replace(output_dir)
+    logging.info(f"{rows_written} enriched rows written to {output_dir}.")
+    return rows_written
+
+
+def export_dataset_to_csv(dataset_dir: Path | str, csv_path: Path | str, config: WriterConfig | None = None) -> int:
+    """
+    Stream a date-partitioned dataset into one CSV file under its unified schema, batch by batch, with hex IDs.
+
+    The file is written through a `TableWriter`, so it only appears once complete; returns the rows written.
+    """
+    dataset = span_dataset(dataset_dir)
+    return write_batches(dataset.to_batches(), csv_path, dataset.schema, config, format='csv')
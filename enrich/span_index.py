@@ -0,0 +1,316 @@
+import logging
+import sqlite3
+import uuid
+from collections.abc import Iterable
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from enrich.ingest import find_backup_files, read_span_file, read_span_files
+from enrich.out_of_core import to_arrow_table, with_date
+from load_logs.log_store import find_log_files
+from load_traces.utils.compact_schema import to_pandas
+from load_traces.utils.span_dataset import compact_dataset_files, update_dataset_schema
+from load_traces.utils.table_writer import WriterConfig, write_table
+
+# Local state like the data catalog: rewritten by every run, so kept outside the DVC-tracked data directory
+DEFAULT_SPAN_INDEX_PATH = "state/span_index.sqlite"
+LEGACY_SPAN_INDEX_PATH = "data/span_index.sqlite"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS spans (
+    span_id TEXT PRIMARY KEY,
+    output_file TEXT NOT NULL,
+    enriched INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS log_rows (
+    span_id TEXT NOT NULL,
+    log_file TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_rows_span_id ON log_rows (span_id);
+CREATE TABLE IF NOT EXISTS log_columns (
+    name TEXT PRIMARY KEY
+);
+"""
+
+
+def _span_key(span_id: int) -> str:
+    """Return the index key of a span ID: SQLite integers are signed, so IDs are stored as 16-digit hex text."""
+    return f"{int(span_id):016x}"
+
+
+class SpanIndex:
+    """
+    A persistent SQLite index of the enrichment state.
+
+    It records which span and log files were already processed, where each spanID was written in the
+    enriched dataset and whether it matched any log, and which log files hold the logs of each span ID.
+    Span IDs are passed in and returned as integers; missing IDs are ignored.
+    """
+
+    def __init__(self, path: Path | str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(INDEX_SCHEMA)
+        self.conn.execute("CREATE TEMP TABLE lookup (span_id TEXT PRIMARY KEY)")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _fill_lookup(self, span_ids: Iterable[int]) -> None:
+        self.conn.execute("DELETE FROM lookup")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO lookup VALUES (?)",
+            ((_span_key(span_id),) for span_id in span_ids if not pd.isna(span_id)),
+        )
+
+    def new_files(self, kind: str, paths: list[Path]) -> list[Path]:
+        """Return the files that are not indexed yet or changed since they were."""
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.conn.execute("SELECT path, size, mtime_ns FROM files WHERE kind = ?", (kind,))
+        }
+        new = []
+        for path in paths:
+            stat = path.stat()
+            if known.get(str(path)) != (stat.st_size, stat.st_mtime_ns):
+                new.append(path)
+        return new
+
+    def mark_files(self, kind: str, paths: list[Path]) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            ((str(path), kind, path.stat().st_size, path.stat().st_mtime_ns) for path in paths),
+        )
+
+    def known_span_ids(self, span_ids: Iterable[int]) -> set[int]:
+        self._fill_lookup(span_ids)
+        return {int(row[0], 16) for row in self.conn.execute("SELECT span_id FROM spans JOIN lookup USING (span_id)")}
+
+    def span_locations(self, span_ids: Iterable[int]) -> dict[int, tuple[str, int]]:
+        """Return {span_id: (output_file, enriched)} for the indexed span IDs among `span_ids`."""
+        self._fill_lookup(span_ids)
+        return {
+            int(span_id, 16): (output_file, enriched)
+            for span_id, output_file, enriched in self.conn.execute(
+                "SELECT span_id, output_file, enriched FROM spans JOIN lookup USING (span_id)"
+            )
+        }
+
+    def set_spans(self, rows: Iterable[tuple[int, str, int]]) -> None:
+        """Record (span_id, output_file, enriched) rows."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO spans VALUES (?, ?, ?)",
+            ((_span_key(span_id), output_file, enriched) for span_id, output_file, enriched in rows
+             if not pd.isna(span_id)),
+        )
+
+    def add_log_rows(self, span_ids: Iterable[int], log_file: Path, columns: Iterable[str]) -> None:
+        self.conn.executemany(
+            "INSERT INTO log_rows VALUES (?, ?)",
+            ((_span_key(span_id), str(log_file)) for span_id in span_ids if not pd.isna(span_id)),
+        )
+        self.conn.executemany("INSERT OR IGNORE INTO log_columns VALUES (?)", ((name,) for name in columns))
+
+    def log_files_for(self, span_ids: Iterable[int]) -> dict[str, set[int]]:
+        """Return {log_file: span IDs} for the log files that hold logs of `span_ids`."""
+        self._fill_lookup(span_ids)
+        files: dict[str, set[int]] = {}
+        for span_id, log_file in self.conn.execute("SELECT span_id, log_file FROM log_rows JOIN lookup USING (span_id)"):
+            files.setdefault(log_file, set()).add(int(span_id, 16))
+        return files
+
+    def log_columns(self) -> set[str]:
+        return {row[0] for row in self.conn.execute("SELECT name FROM log_columns")}
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+
+def _has_span_ids(log_file: Path) -> bool:
+    """Whether a log file has a span_id column; a batch of start-up logs only has none."""
+    schema = pq.read_schema(log_file) if log_file.suffix == '.parquet' else pa_csv.open_csv(log_file).schema
+    if 'span_id' in schema.names:
+        return True
+    logging.info(f"{log_file} has no span_id column, none of its rows are indexed.")
+    return False
+
+
+def _read_logs_for(log_files: dict[str, set[int]], loaded: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Load the log rows of the given span IDs, from already loaded frames or by filtering the files."""
+    frames = []
+    for log_file, span_ids in log_files.items():
+        if log_file in loaded:
+            df = loaded[log_file]
+            frames.append(df[df['span_id'].isin(span_ids)])
+        else:
+            table = read_span_file(Path(log_file))
+            value_set = pa.array(list(span_ids), type=pa.uint64())
+            frames.append(to_pandas(table.filter(pc.is_in(table.column('span_id'), value_set=value_set))))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['span_id'])
+
+
+def _write_run_partitions(df: pd.DataFrame, output_dir: Path, config: WriterConfig | None) -> pd.Series:
+    """Append rows as new date=YYYY-MM-DD/part-<run>.parquet files; return the output file of each row."""
+    table = with_date(to_arrow_table(df))
+    dates = table.column('date')
+    table = table.drop(['date'])
+    part_name = f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+    for date in pc.unique(dates).to_pylist():
+        partition_dir = output_dir / f"date={date}"
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        write_table(table.filter(pc.equal(dates, date)), partition_dir / part_name, config)
+    update_dataset_schema(output_dir, table.schema)
+    return pd.Series(dates.to_pandas()).map(lambda date: str(output_dir / f"date={date}" / part_name))
+
+
+def _rewrite_with_logs(output_file: Path, locations: dict[int, tuple[str, int]], new_logs: pd.DataFrame,
+                       log_columns: set[str], config: WriterConfig | None) -> None:
+    """Add the new log rows of already written spans to their output file, replacing log-less rows."""
+    df = to_pandas(pq.read_table(output_file))
+    span_ids = set(new_logs['spanID'])
+    span_columns = [column for column in df.columns if column == 'spanID' or column not in log_columns]
+    span_rows = df.loc[df['spanID'].isin(span_ids), span_columns].drop_duplicates(subset=['spanID'])
+    added = pd.merge(span_rows, new_logs, on='spanID', how='inner')
+    without_logs = {span_id for span_id in span_ids if locations[span_id][1] == 0}
+    updated = pd.concat([df[~df['spanID'].isin(without_logs)], added], ignore_index=True)
+    table = to_arrow_table(updated)
+    write_table(table, output_file, config)
+    update_dataset_schema(output_file.parents[1], table.schema)
+
+
+def enrich_incremental(
+        backups_dir: Path | str,
+        logs_dir: Path | str,
+        output_dir: Path | str,
+        index_path: Path | str,
+        max_workers: int | None = None,
+        config: WriterConfig | None = None
+) -> dict[str, int]:
+    """
+    Enrich only the spans and logs that arrived since the last run, using the persistent span index.
+
+    New backup files are read, their spans de-duplicated against the index, left-joined with their logs (found
+    through the index of log rows, so old log files are only read for the span IDs they hold) and appended to
+    the date-partitioned enriched dataset. New log rows of spans written by earlier runs are added to the
+    output files of those spans only. Runtime follows the daily delta rather than the whole history.
+
+    Args:
+        backups_dir (Path | str): The directory with the backup folders of span files.
+        logs_dir (Path | str): The logs directory (Parquet batches and the legacy logs.csv).
+        output_dir (Path | str): The directory of the enriched dataset.
+        index_path (Path | str): The SQLite index file.
+        max_workers (int, optional): The number of span files read at once. Defaults to the number of CPUs.
+        config (WriterConfig, optional): The compression and row group size of the output. Defaults to WriterConfig().
+
+    Returns:
+        dict[str, int]: The number of new span files, log files, new spans and updated output files.
+    """
+    output_dir = Path(output_dir)
+    # Output files written before IDs were stored as integers are converted once, as new rows are appended
+    compact_dataset_files(output_dir, config)
+    with SpanIndex(index_path) as index:
+        span_files = index.new_files('span', find_backup_files(backups_dir))
+        log_files = index.new_files('log', find_log_files(logs_dir))
+        logging.info(f"{len(span_files)} new span files and {len(log_files)} new log files to enrich.")
+
+        new_logs: dict[str, pd.DataFrame] = {}
+        for log_file in log_files:
+            if not _has_span_ids(log_file):
+                continue
+            logs_df = to_pandas(read_span_file(log_file))
+            logs_df = logs_df[logs_df['span_id'].notna()]
+            new_logs[str(log_file)] = logs_df
+            index.add_log_rows(logs_df['span_id'], log_file, logs_df.columns)
+        log_columns = index.log_columns() | {'spanID'}
+
+        spans_df = read_span_files(span_files, max_workers=max_workers).drop_duplicates(subset=['spanID'])
+        if not spans_df.empty:
+            spans_df = spans_df[spans_df['spanID'].notna()]
+            spans_df = spans_df[~spans_df['spanID'].isin(index.known_span_ids(spans_df['spanID']))]
+        new_span_ids = set(spans_df['spanID']) if not spans_df.empty else set()
+
+        if new_span_ids:
+            logs_df = _read_logs_for(index.log_files_for(new_span_ids), new_logs).rename(columns={'span_id': 'spanID'})
+            enriched_df = pd.merge(spans_df, logs_df, on='spanID', how='left')
+            output_files = _write_run_partitions(enriched_df, output_dir, config)
+            matched = set(logs_df['spanID'])
+            index.set_spans(
+                (span_id, output_file, int(span_id in matched))
+                for span_id, output_file in dict(zip(enriched_df['spanID'], output_files)).items()
+            )
+
+        late_logs = pd.concat(new_logs.values(), ignore_index=True) if new_logs else pd.DataFrame(columns=['span_id'])
+        late_logs = late_logs[~late_logs['span_id'].isin(new_span_ids)].rename(columns={'span_id': 'spanID'})
+        locations = index.span_locations(late_logs['spanID']) if not late_logs.empty else {}
+        late_logs = late_logs[late_logs['spanID'].isin(locations.keys())]
+        updated_files = 0
+        for output_file, file_logs in late_logs.groupby(late_logs['spanID'].map(lambda span_id: locations[span_id][0])):
+            _rewrite_with_logs(Path(output_file), locations, file_logs, log_columns, config)
+            index.set_spans((span_id, output_file, 1) for span_id in set(file_logs['spanID']))
+            updated_files += 1
+
+        index.mark_files('span', span_files)
+        index.mark_files('log', log_files)
+        index.commit()
+
+    stats = {
+        'span_files': len(span_files),
+        'log_files': len(log_files),
+        'new_spans': len(new_span_ids),
+        'updated_output_files': updated_files,
+    }
+    logging.info(f"Incremental enrichment done: {stats}.")
+    return stats
+
+
+def index_existing_output(
+        backups_dir: Path | str,
+        logs_dir: Path | str,
+        output_dir: Path | str,
+        index_path: Path | str
+) -> None:
+    """
+    Rebuild the span index from a fully enriched dataset, e.g. after `enrich_spans_out_of_core`.
+
+    All current span and log files are marked as processed, every log row is registered, and every spanID of
+    the dataset is recorded with its output file.
+    """
+    Path(index_path).unlink(missing_ok=True)
+    with SpanIndex(index_path) as index:
+        log_files = find_log_files(logs_dir)
+        for log_file in log_files:
+            if not _has_span_ids(log_file):
+                continue
+            table = read_span_file(log_file)
+            span_ids = table.column('span_id').drop_null().to_pylist()
+            index.add_log_rows(span_ids, log_file, table.schema.names)
+
+        for output_file in sorted(Path(output_dir).glob('date=*/*.parquet')):
+            span_ids = pc.unique(pq.read_table(output_file, columns=['spanID']).column('spanID')).to_pylist()
+            index.set_spans((span_id, str(output_file), 0) for span_id in span_ids)
+        index.conn.execute(
+            "UPDATE spans SET enriched = EXISTS (SELECT 1 FROM log_rows WHERE log_rows.span_id = spans.span_id)"
+        )
+
+        index.mark_files('span', find_backup_files(backups_dir))
+        index.mark_files('log', log_files)
+        index.commit()
+    logging.info(f"Span index {index_path} rebuilt from {output_dir}.")
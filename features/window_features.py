@@ -0,0 +1,499 @@
+import logging
+import re
+import uuid
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from anomaly.sketch import DDSketch
+from catalog.data_catalog import DataCatalog
+from enrich.log_matching import ERROR_LEVELS
+from load_logs.log_store import read_logs
+from load_traces.utils.compact_schema import DICTIONARY_TYPE, to_pandas
+from load_traces.utils.span_dataset import PARTITIONING, span_dataset
+from load_traces.utils.table_writer import live_files, write_merged, write_table
+
+DEFAULT_FEATURES_DIR = "data"
+# Every aggregate is kept per value of these columns, plus the configured tag columns
+KEY_COLUMNS = ('serviceName', 'operationName')
+MINUTE_US = 60_000_000
+DAY_US = 86_400_000_000
+# A log counts for its span if it lies between a minute before the span's start minute and a minute after its end
+LOG_MARGIN_US = MINUTE_US
+# Window lengths; a window whose step equals its length is tumbling, a shorter step makes it sliding
+DEFAULT_WINDOWS = ('1m', '5m', '1h')
+DEFAULT_SLIDING = {'5m': '1m', '1h': '5m'}
+QUANTILES = (0.5, 0.95, 0.99)
+# Additive per-minute state: one row per (minute, key, duration bucket) of spans, and per (minute, key) of logs,
+# whose bucket is null
+CELL_COLUMNS = ('spans', 'errors', 'logs', 'log_errors')
+FEATURE_SCHEMA = pa.schema([
+    ('window_start', pa.timestamp('us')),
+    ('requests', pa.int64()),
+    ('request_rate', pa.float32()),
+    ('errors', pa.int64()),
+    ('error_ratio', pa.float32()),
+    *((f"duration_p{q * 100:g}", pa.float32()) for q in QUANTILES),
+    ('logs', pa.int64()),
+    ('log_errors', pa.int64()),
+    ('log_errors_per_minute', pa.float32()),
+])
+
+
+def parse_duration(text: str) -> int:
+    """
+    Convert a window length like "1m", "5m" or "1h" to microseconds.
+
+    Raises:
+        ValueError: If the text is not a number of minutes (m), hours (h) or days (d).
+    """
+    match = re.fullmatch(r"(\d+)([mhd])", text.strip())
+    if not match:
+        raise ValueError(f"Invalid window length {text!r}, expected e.g. 1m, 5m or 1h")
+    return int(match[1]) * {'m': 1, 'h': 60, 'd': 1440}[match[2]] * MINUTE_US
+
+
+@dataclass(frozen=True)
+class Window:
+    """Windows of `length` µs starting every `step` µs; the name is the table directory, e.g. 5m or 1h_every_5m."""
+    name: str
+    length: int
+    step: int
+
+    @classmethod
+    def parse(cls, length: str, step: str | None = None) -> "Window":
+        """
+        Raises:
+            ValueError: If a length is invalid or the window length is not a multiple of its step.
+        """
+        length_us = parse_duration(length)
+        step_us = parse_duration(step) if step else length_us
+        if length_us % step_us:
+            raise ValueError(f"The {length} window length is not a multiple of its {step} step")
+        return cls(length if step_us == length_us else f"{length}_every_{step}", length_us, step_us)
+
+    def starts(self, minutes: np.ndarray) -> np.ndarray:
+        """Return the sorted starts of the windows that hold any of the `minutes` (µs)."""
+        base = np.unique(minutes) // self.step * self.step
+        return np.unique(np.concatenate([base - j * self.step for j in range(self.length // self.step)]))
+
+
+def _date(us: int) -> str:
+    return datetime.fromtimestamp(us // 1_000_000, timezone.utc).strftime('%Y-%m-%d')
+
+
+def _day_number(partition_dir: Path) -> int:
+    date = datetime.strptime(partition_dir.name.removeprefix('date='), '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return int(date.timestamp()) // 86_400
+
+
+def _key_frame(table: pa.Table | pa.RecordBatch, key_columns: tuple[str, ...]) -> pd.DataFrame:
+    """Return the key columns of the rows as categoricals of strings, with nulls for missing columns."""
+    return pd.DataFrame({
+        name: pd.Categorical(pc.cast(table.column(name), pa.string()).to_numpy(zero_copy_only=False)
+                             if name in table.schema.names else np.full(table.num_rows, None, dtype=object))
+        for name in key_columns
+    })
+
+
+def _near_span(log_times: np.ndarray, span_minutes: np.ndarray, span_ends: np.ndarray) -> np.ndarray:
+    """Return whether each log time, in microseconds, lies within `LOG_MARGIN_US` of the time of its span."""
+    return (log_times >= span_minutes - LOG_MARGIN_US) & (log_times <= span_ends + LOG_MARGIN_US)
+
+
+def _log_times(logs: pd.DataFrame) -> np.ndarray:
+    return pd.to_datetime(logs['time']).to_numpy(dtype='datetime64[us]').astype(np.int64)
+
+
+def _run_name() -> str:
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def _is_true(column: pa.Array | pa.ChunkedArray) -> np.ndarray:
+    """Return a tag column as booleans: True for true, "true" and 1, False for anything else and nulls."""
+    if not pa.types.is_boolean(column.type):
+        column = pc.is_in(pc.utf8_lower(pc.cast(column, pa.string())), pa.array(['true', '1']))
+    return np.asarray(pc.fill_null(column, False), dtype=bool)
+
+
+class FeatureStore:
+    """
+    Windowed per-operation features of the spans and logs of one trace target, maintained incrementally.
+
+    For every key (the serviceName and operationName of a span plus the values of the configured `tag_*`
+    columns, e.g. the status code) and every window, it keeps the request count and rate, the share of spans
+    with the `error_tag` set, the p50/p95/p99 duration and the number of logs and of error logs of the spans of
+    the key. Windows are tumbling (1m, 5m, 1h) or sliding (a 5m window every minute, a 1h window every 5 minutes).
+
+    The state is a table of additive per-minute cells: per minute and key, the spans per duration bucket of a
+    `DDSketch` with their errors, and the logs with their errors. Cells of new spans and logs are only ever
+    appended, as new `cells/date=YYYY-MM-DD/part-<run>.parquet` files, so a late batch simply adds to the
+    minutes it falls in. `commit` then recomputes the windows that hold those minutes, and only them, from
+    the cells of the minutes they cover, and writes them as new `<window>/date=YYYY-MM-DD/part-<run>.parquet`
+    files; `read_features` keeps the newest row of every window and key. Once a later day has cells, the parts
+    of a day are merged into one file per table (see `_compact`), so a past day keeps a single cells file and a
+    single file per window table.
+
+    A log counts for the span of its `span_id`, at the minute of its own time. Whichever of the two is stored
+    second adds it: committed spans look up the logs already stored, and `add_logs` looks up the spans already
+    stored in the target's span dataset, so as long as spans and logs are stored one at a time (the daemon's
+    data lock) every matched log is counted once.
+    """
+
+    def __init__(self, features_dir: Path | str, dataset_dir: Path | str | None = None,
+                 logs_dir: Path | str | None = None, key_tags: Iterable[str] = (), error_tag: str = 'error',
+                 windows: Iterable[Window] | None = None, relative_accuracy: float = 0.01,
+                 catalog: DataCatalog | None = None):
+        self.features_dir = Path(features_dir)
+        self.cells_dir = self.features_dir / 'cells'
+        self.dataset_dir = Path(dataset_dir) if dataset_dir is not None else None
+        self.logs_dir = Path(logs_dir) if logs_dir is not None else None
+        self.key_columns = KEY_COLUMNS + tuple(f"tag_{tag}" for tag in key_tags)
+        self.error_column = f"tag_{error_tag}"
+        self.windows = list(windows) if windows is not None else \
+            [Window.parse(length) for length in DEFAULT_WINDOWS] + \
+            [Window.parse(length, step) for length, step in DEFAULT_SLIDING.items()]
+        self.sketch = DDSketch(relative_accuracy)
+        self.catalog = catalog
+        self._cells: list[pd.DataFrame] = []
+        self._span_keys: list[pd.DataFrame] = []
+        # The latest day with cells; the days before it are merged by `commit`, and on start-up if left unmerged
+        self._latest_day = max((_day_number(path) for path in self.cells_dir.glob('date=*')), default=None)
+        table_dirs = [self.cells_dir, *(self.features_dir / window.name for window in self.windows)]
+        days = {_day_number(path) for table_dir in table_dirs for path in table_dir.glob('date=*')}
+        for day in sorted(days):
+            if self._latest_day is not None and day < self._latest_day:
+                self._compact(day)
+
+    @classmethod
+    def from_config(cls, config: dict, base_dir: Path, target_name: str, dataset_dir: Path | None = None,
+                    logs_dir: Path | None = None, catalog: DataCatalog | None = None) -> "FeatureStore | None":
+        """
+        Create the feature store of a trace target from the `features` section of config.yml, or return None if
+        `features.dir` is null. Its cells and tables are kept under `<dir>/features/<target>`.
+        """
+        features_config = config.get("features") or {}
+        features_dir = features_config.get("dir", DEFAULT_FEATURES_DIR)
+        if not features_dir:
+            return None
+        sliding = features_config.get("sliding", DEFAULT_SLIDING) or {}
+        windows = [Window.parse(length) for length in features_config.get("windows", DEFAULT_WINDOWS)] + \
+            [Window.parse(length, step) for length, step in sliding.items()]
+        return cls(
+            base_dir / features_dir / "features" / target_name,
+            dataset_dir,
+            logs_dir,
+            key_tags=features_config.get("key_tags") or (),
+            error_tag=features_config.get("error_tag", "error"),
+            windows=windows,
+            relative_accuracy=features_config.get("relative_accuracy", 0.01),
+            catalog=catalog,
+        )
+
+    def _log_cells(self, logs: pd.DataFrame, keys: pd.DataFrame) -> pd.DataFrame:
+        """Return the cells of logs, given the key of the span of every log."""
+        minutes = logs['time'].to_numpy(dtype='datetime64[us]').astype(np.int64) // MINUTE_US * MINUTE_US
+        levels = logs['level'].astype('string').str.lower() if 'level' in logs.columns \
+            else pd.Series(pd.NA, index=logs.index, dtype='string')
+        return keys.assign(minute=minutes, bucket=pd.array([pd.NA] * len(logs), dtype='Int32'), spans=0, errors=0,
+                           logs=1, log_errors=levels.isin(ERROR_LEVELS).fillna(False).to_numpy(dtype=np.int64))
+
+    def add_spans(self, batch: pa.RecordBatch) -> None:
+        """Count a batch of spans into pending cells."""
+        start = batch.column('startTime').cast(pa.int64())
+        valid = np.asarray(pc.is_valid(start))
+        if not valid.any():
+            return
+        rows = np.flatnonzero(valid)
+        batch = batch.take(pa.array(rows))
+        start = np.asarray(batch.column('startTime').cast(pa.int64()))
+        minutes = start // MINUTE_US * MINUTE_US
+        duration = batch.column('duration')
+        buckets = pd.array(self.sketch.bucket_indexes(np.maximum(np.asarray(pc.fill_null(duration, 1)), 1)),
+                           dtype='Int32')
+        buckets[np.asarray(pc.is_null(duration))] = pd.NA
+        errors = _is_true(batch.column(self.error_column)) if self.error_column in batch.schema.names \
+            else np.zeros(batch.num_rows, dtype=bool)
+        keys = _key_frame(batch, self.key_columns)
+        self._cells.append(keys.assign(minute=minutes, bucket=buckets, spans=1, errors=errors.astype(np.int64),
+                                       logs=0, log_errors=0))
+        if self.logs_dir is not None:
+            self._span_keys.append(keys.assign(
+                spanID=pd.array(np.asarray(batch.column('spanID')), dtype='UInt64'), minute=minutes,
+                end=start + np.asarray(pc.fill_null(duration, 0))))
+
+    def observe(self, batches: Iterable[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+        """Count every batch with `add_spans` as it passes through, and yield it unchanged."""
+        for batch in batches:
+            self.add_spans(batch)
+            yield batch
+
+    def _logs_of_pending_spans(self) -> None:
+        """Count the logs already stored of the pending spans."""
+        spans = pd.concat(self._span_keys, ignore_index=True)
+        # Only the logs from a minute before the first span starts to a minute after the last one ends are read
+        logs = read_logs(self.logs_dir, columns=['span_id', 'level', 'time'], catalog=self.catalog,
+                         start_us=int(spans['minute'].min()) - LOG_MARGIN_US,
+                         end_us=int(spans['end'].max()) + LOG_MARGIN_US)
+        if logs.empty or 'span_id' not in logs.columns or 'time' not in logs.columns:
+            return
+        logs = logs[logs['time'].notna()].reset_index(drop=True)
+        spans = spans.drop_duplicates('spanID')
+        positions = pd.Index(spans['spanID']).get_indexer(logs['span_id'].astype('UInt64'))
+        matched = positions >= 0
+        # The same bound as in `add_logs`, so the count does not depend on whether the spans or the logs came first
+        matched[matched] = _near_span(_log_times(logs[matched]), spans['minute'].to_numpy()[positions[matched]],
+                                      spans['end'].to_numpy()[positions[matched]])
+        if matched.any():
+            keys = spans.iloc[positions[matched]][list(self.key_columns)].reset_index(drop=True)
+            self._cells.append(self._log_cells(logs[matched].reset_index(drop=True), keys))
+
+    def add_logs(self, path: Path | str) -> int:
+        """
+        Count the logs of a new log batch file whose spans are already stored into pending cells.
+
+        Returns:
+            int: The number of logs matched to a span.
+        """
+        if self.dataset_dir is None or not self.dataset_dir.exists():
+            return 0
+        names = pq.read_schema(path).names
+        if 'span_id' not in names or 'time' not in names:
+            return 0
+        logs = to_pandas(pq.read_table(path, columns=[name for name in ('span_id', 'level', 'time') if name in names]))
+        logs = logs[logs['span_id'].notna() & logs['time'].notna()].reset_index(drop=True)
+        if logs.empty:
+            return 0
+        times = _log_times(logs)
+        dataset = span_dataset(self.dataset_dir)
+        columns = ['spanID', 'startTime', *(name for name in ('duration', *self.key_columns)
+                                            if name in dataset.schema.names)]
+        span_filter = (ds.field('date') >= _date(int(times.min()) - DAY_US)) & \
+            (ds.field('date') <= _date(int(times.max()))) & \
+            ds.field('spanID').isin(pa.array(logs['span_id'].unique().to_numpy(dtype=np.uint64), pa.uint64()))
+        spans = dataset.to_table(columns=columns, filter=span_filter)
+        # A span stored twice (e.g. by an overlapping fetch) counts its logs once, with the key of its first row
+        span_ids, first_rows = np.unique(np.asarray(spans.column('spanID')), return_index=True)
+        positions = pd.Index(span_ids).get_indexer(logs['span_id'].to_numpy(dtype=np.uint64))
+        matched = positions >= 0
+        if matched.any():
+            rows = spans.take(pa.array(first_rows[positions[matched]]))
+            start = np.asarray(pc.fill_null(rows.column('startTime').cast(pa.int64()), 0))
+            duration = np.asarray(pc.fill_null(rows.column('duration'), 0)) if 'duration' in rows.schema.names \
+                else np.zeros(rows.num_rows, dtype=np.int64)
+            near = _near_span(times[matched], start // MINUTE_US * MINUTE_US, start + duration)
+            matched[matched] = near
+            rows = rows.filter(pa.array(near))
+        if matched.any():
+            keys = _key_frame(rows, self.key_columns)
+            self._cells.append(self._log_cells(logs[matched].reset_index(drop=True), keys))
+        return int(matched.sum())
+
+    def _read_cells(self, start_us: int, end_us: int) -> pd.DataFrame:
+        """Return the cells of the minutes in [start_us, end_us), summed over the cell files."""
+        columns = ['minute', *self.key_columns, 'bucket', *CELL_COLUMNS]
+        if not self.cells_dir.exists():
+            return pd.DataFrame(columns=columns)
+        dataset = ds.dataset(self.cells_dir, format='parquet', partitioning=PARTITIONING)
+        cell_filter = (ds.field('date') >= _date(start_us)) & (ds.field('date') <= _date(end_us - 1)) & \
+            (ds.field('minute') >= pa.scalar(start_us, pa.timestamp('us'))) & \
+            (ds.field('minute') < pa.scalar(end_us, pa.timestamp('us')))
+        cells = dataset.to_table(columns=[name for name in columns if name in dataset.schema.names], filter=cell_filter)
+        return self._cell_frame(cells)
+
+    def _cell_frame(self, cells: pa.Table) -> pd.DataFrame:
+        return _key_frame(cells, self.key_columns).assign(
+            minute=np.asarray(cells.column('minute').cast(pa.int64())),
+            bucket=pd.array(cells.column('bucket').to_pandas(), dtype='Int32'),
+            **{name: np.asarray(cells.column(name)) for name in CELL_COLUMNS},
+        )
+
+    def _sum_cells(self, cells: pd.DataFrame) -> pd.DataFrame:
+        """Add up the cells of the same minute, key and bucket."""
+        cells = cells.astype({name: 'category' for name in self.key_columns})
+        return cells.groupby(['minute', *self.key_columns, 'bucket'], dropna=False, observed=True)[
+            list(CELL_COLUMNS)].sum().reset_index()
+
+    def _window_features(self, cells: pd.DataFrame, window: Window, starts: np.ndarray) -> pd.DataFrame:
+        """Aggregate the cells into the features of the windows starting at `starts`."""
+        group_columns = ['window_start', *self.key_columns]
+        copies = window.length // window.step
+        rows = np.repeat(np.arange(len(cells)), copies)
+        window_start = (cells['minute'].to_numpy() // window.step * window.step)[rows] - \
+            np.tile(np.arange(copies) * window.step, len(cells))
+        inside = np.isin(window_start, starts)
+        frame = cells.iloc[rows[inside]].drop(columns='minute').assign(window_start=window_start[inside])
+
+        totals = frame.groupby(group_columns, dropna=False, observed=True)[list(CELL_COLUMNS)].sum().reset_index()
+        spans = frame[(frame['spans'] > 0) & frame['bucket'].notna()]
+        histogram = spans.groupby([*group_columns, 'bucket'], dropna=False, observed=True)['spans'].sum().reset_index()
+        if len(histogram):
+            # Every group is a run of rows sorted by bucket; the bucket of rank r of a group is the first whose
+            # cumulative count past the counts of the groups before it exceeds r, as in DDSketch.quantile
+            cumulative = histogram['spans'].to_numpy().cumsum()
+            group = histogram.groupby(group_columns, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+            first = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+            last = np.r_[first[1:], len(histogram)] - 1
+            before = np.where(first > 0, cumulative[first - 1], 0)
+            count = cumulative[last] - before
+            quantiles = histogram.iloc[first][group_columns].reset_index(drop=True)
+            buckets = histogram['bucket'].to_numpy(dtype=np.int64)
+            for q in QUANTILES:
+                positions = np.minimum(np.searchsorted(cumulative, before + q * (count - 1), side='right'), last)
+                quantiles[f"duration_p{q * 100:g}"] = self.sketch.bucket_values(buckets[positions])
+            totals = totals.merge(quantiles, on=group_columns, how='left')
+        else:
+            for q in QUANTILES:
+                totals[f"duration_p{q * 100:g}"] = np.nan
+
+        requests = totals['spans'].to_numpy()
+        table = pa.table({
+            'window_start': pa.array(totals['window_start'].to_numpy(), pa.int64()).cast(pa.timestamp('us')),
+            **{name: pa.array(totals[name].to_numpy(dtype=object), pa.string(), from_pandas=True).cast(
+                DICTIONARY_TYPE if name in KEY_COLUMNS else pa.string()) for name in self.key_columns},
+            'requests': pa.array(requests, pa.int64()),
+            'request_rate': pa.array(requests / (window.length / 1_000_000), pa.float32()),
+            'errors': pa.array(totals['errors'].to_numpy(), pa.int64()),
+            'error_ratio': pa.array(np.where(requests > 0, totals['errors'] / np.maximum(requests, 1), np.nan),
+                                    pa.float32()),
+            **{f"duration_p{q * 100:g}": pa.array(totals[f"duration_p{q * 100:g}"].to_numpy(dtype=np.float64),
+                                                  pa.float32(), from_pandas=True) for q in QUANTILES},
+            'logs': pa.array(totals['logs'].to_numpy(), pa.int64()),
+            'log_errors': pa.array(totals['log_errors'].to_numpy(), pa.int64()),
+            'log_errors_per_minute': pa.array(totals['log_errors'] / (window.length / MINUTE_US), pa.float32()),
+        })
+        return table.sort_by([('window_start', 'ascending')])
+
+    def _cell_table(self, cells: pd.DataFrame) -> pa.Table:
+        return pa.table({
+            'minute': pa.array(cells['minute'].to_numpy(), pa.int64()).cast(pa.timestamp('us')),
+            **{name: pa.array(cells[name].to_numpy(dtype=object), pa.string(), from_pandas=True).cast(
+                DICTIONARY_TYPE if name in KEY_COLUMNS else pa.string()) for name in self.key_columns},
+            'bucket': pa.array(cells['bucket'], pa.int32(), from_pandas=True),
+            **{name: pa.array(cells[name].to_numpy(), pa.int64()) for name in CELL_COLUMNS},
+        })
+
+    def commit(self) -> int:
+        """
+        Save the pending cells and rewrite the features of the windows they fall in as new files.
+
+        Returns:
+            int: The number of feature rows written.
+        """
+        if self._span_keys:
+            self._logs_of_pending_spans()
+        if not self._cells:
+            self.rollback()
+            return 0
+        run = _run_name()
+        pending = pd.concat(self._cells, ignore_index=True)
+        cells = self._sum_cells(pending)
+        days = cells['minute'].to_numpy() // DAY_US
+        for day in np.unique(days):
+            partition_dir = self.cells_dir / f"date={_date(int(day) * DAY_US)}"
+            partition_dir.mkdir(parents=True, exist_ok=True)
+            write_table(self._cell_table(cells[days == day]), partition_dir / f"part-{run}.parquet")
+
+        rows = 0
+        written_days = set(np.unique(days).tolist())
+        minutes = np.unique(cells['minute'].to_numpy())
+        for window in self.windows:
+            starts = window.starts(minutes)
+            # One day of windows at a time, so memory is bounded by the cells of a day and a window length
+            start_days = starts // DAY_US
+            written_days.update(np.unique(start_days).tolist())
+            for day in np.unique(start_days):
+                day_starts = starts[start_days == day]
+                window_cells = self._read_cells(int(day_starts[0]), int(day_starts[-1]) + window.length)
+                features = self._window_features(window_cells, window, day_starts)
+                partition_dir = self.features_dir / window.name / f"date={_date(int(day) * DAY_US)}"
+                partition_dir.mkdir(parents=True, exist_ok=True)
+                write_table(features, partition_dir / f"part-{run}.parquet")
+                rows += features.num_rows
+        logging.info(f"{len(pending)} span and log rows counted into {len(minutes)} minutes of {self.features_dir}, "
+                     f"{rows} window features rewritten.")
+
+        latest_day = max(int(days.max()), self._latest_day if self._latest_day is not None else -1)
+        past_days = {day for day in written_days if day < latest_day}
+        if self._latest_day is not None and self._latest_day < latest_day:
+            past_days.add(self._latest_day)
+        self._latest_day = latest_day
+        for day in sorted(past_days):
+            self._compact(day)
+        self.rollback()
+        return rows
+
+    def _compact(self, day: int) -> None:
+        """
+        Merge the parts of one day of the cells and of every window table into one file per table.
+
+        Cells are added up, and of the window rows the newest of every window and key is kept, as `read_features`
+        does. The parts are replaced with `write_merged`, so an interrupted merge never counts cells twice.
+        """
+        date = _date(day * DAY_US)
+        run = _run_name()
+        merged = 0
+        parts = live_files(sorted((self.cells_dir / f"date={date}").glob('part-*.parquet')))
+        if len(parts) > 1:
+            cells = self._cell_frame(pa.concat_tables([pq.read_table(part) for part in parts],
+                                                      promote_options='default'))
+            write_merged(self._cell_table(self._sum_cells(cells)), parts[0].with_name(f"part-{run}.parquet"), parts)
+            merged += len(parts)
+        for window in self.windows:
+            parts = live_files(sorted((self.features_dir / window.name / f"date={date}").glob('part-*.parquet')))
+            if len(parts) < 2:
+                continue
+            features = pa.concat_tables([pq.read_table(part) for part in parts], promote_options='default')
+            features = features.unify_dictionaries().combine_chunks()
+            keys = [name for name in features.schema.names if name not in FEATURE_SCHEMA.names]
+            last_rows = features.append_column('_row', pa.array(np.arange(features.num_rows))) \
+                .group_by(['window_start', *keys]).aggregate([('_row', 'max')]).column('_row_max')
+            features = features.take(np.sort(last_rows.to_numpy())).sort_by([('window_start', 'ascending')])
+            write_merged(features, parts[0].with_name(f"part-{run}.parquet"), parts)
+            merged += len(parts)
+        if merged:
+            logging.info(f"Merged {merged} parts of {date} in {self.features_dir}.")
+
+    def rollback(self) -> None:
+        """Drop the spans and logs counted since the last commit."""
+        self._cells.clear()
+        self._span_keys.clear()
+
+
+def read_features(features_dir: Path | str, window: str = '5m', start_date: str | None = None,
+                  end_date: str | None = None) -> pd.DataFrame:
+    """
+    Load a feature table of a target, e.g. data/features/sr-api_upload, keeping the newest row of every window.
+
+    Args:
+        features_dir (Path | str): The features directory of the target.
+        window (str, optional): The window table, e.g. 1m, 5m, 1h or 1h_every_5m. Defaults to '5m'.
+        start_date (str, optional): The first day of windows to load, "YYYY-MM-DD", inclusive. Defaults to None.
+        end_date (str, optional): The last day of windows to load, "YYYY-MM-DD", inclusive. Defaults to None.
+
+    Returns:
+        DataFrame: One row per window start and key, with dictionary columns as categoricals.
+    """
+    table_dir = Path(features_dir) / window
+    tables = []
+    for partition_dir in sorted(table_dir.glob('date=*')):
+        date = partition_dir.name.removeprefix('date=')
+        if (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+            continue
+        # Part names start with their run time, so later parts come last
+        tables.extend(pq.read_table(path) for path in sorted(partition_dir.glob('part-*.parquet')))
+    if not tables:
+        logging.warning(f"No {window} features found in {features_dir}.")
+        return pd.DataFrame()
+    features = to_pandas(pa.concat_tables(tables, promote_options='default').unify_dictionaries())
+    keys = [name for name in features.columns if name not in FEATURE_SCHEMA.names]
+    features = features.drop_duplicates(['window_start', *keys], keep='last')
+    return features.sort_values(['window_start', *keys], kind='stable').reset_index(drop=True)
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from yaml import safe_load
+
+from anomaly.latency_detector import LatencyDetector
+from archive.raw_archive import RawArchive
+from catalog.data_catalog import DataCatalog
+from features.window_features import FeatureStore
+from load_logs.log_store import plan_fetch, store_new_entries
+from load_logs.loki_client import SR_API_QUERY, query_range_async
+from load_traces.utils.fetch_jaeger_traces import iter_jaeger_traces_sliced_async, make_async_session
+from load_traces.utils.flatten_spans import iter_span_batches, write_span_batches_parquet
+from load_traces.utils.span_dataset import append_spans, compact_dataset_files, move_dataset
+from load_traces.utils.table_writer import WriterConfig
+from load_traces.utils.trace_targets import DEFAULT_TARGET, TraceTarget, load_trace_targets
+from monitoring.stage_metrics import StageMetrics
+from publish.dvc_publisher import DvcPublisher, dvc_and_git_pull
+
+TRACE_CHECKPOINT_FILE = "traces_checkpoint.json"
+
+
+def _read_trace_checkpoints(data_dir: Path) -> dict[str, int]:
+    checkpoint_path = data_dir / TRACE_CHECKPOINT_FILE
+    if not checkpoint_path.exists():
+        return {}
+    with open(checkpoint_path) as file:
+        checkpoints = json.load(file)
+    # Checkpoint of the single target collected before targets were configurable
+    if "end_us" in checkpoints:
+        return {DEFAULT_TARGET.name: checkpoints["end_us"]}
+    return checkpoints
+
+
+def read_trace_checkpoint(data_dir: Path, target: TraceTarget) -> int | None:
+    """Return the end of the last collected trace window of a target, in microseconds, or None if there is none yet."""
+    return _read_trace_checkpoints(data_dir).get(target.name)
+
+
+def write_trace_checkpoint(data_dir: Path, target: TraceTarget, end_us: int) -> None:
+    """Save the end of the last collected trace window of a target atomically (temporary file and rename)."""
+    checkpoints = _read_trace_checkpoints(data_dir)
+    checkpoints[target.name] = end_us
+    tmp_path = data_dir / f".{TRACE_CHECKPOINT_FILE}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(checkpoints, file)
+    tmp_path.replace(data_dir / TRACE_CHECKPOINT_FILE)
+
+
+class IngestionDaemon:
+    """
+    One long-running service that collects traces and logs on independent intervals and publishes them.
+
+    Every configured trace target is collected on its own interval, all over one Jaeger session whose
+    connection pool and request rate limit they share. Jaeger and Loki are polled over pooled aiohttp sessions that stay open for the life of the daemon. The
+    traces of each slice are handed through a bounded queue to a worker thread that flattens and writes them
+    while the next slices are still being fetched; when the worker falls behind, the queue fills up and
+    fetching waits (backpressure). Log parsing and all file writes also run in the worker pool, so the event
+    loop only does network I/O. Writers and the DVC publisher share a lock, so a snapshot is never taken
+    halfway through a write.
+    """
+
+    def __init__(self, config: dict, base_dir: Path):
+        daemon_config = config.get("daemon") or {}
+        self.config = config
+        self.base_dir = base_dir
+        self.data_dir = base_dir / "data"
+        self.logs_dir = self.data_dir / "logs"
+        self.spans_dir = self.data_dir / "spans"
+        self.backups_dir = self.data_dir / "backups"
+        self.staging_dir = base_dir / ".staging"
+        self.fetch_config = config.get("jaeger_fetch") or {}
+        self.collector_config = config.get("logs_collector") or {}
+        self.writer_config = WriterConfig.from_config(config)
+        self.targets = load_trace_targets(config)
+        self.traces_lag = daemon_config.get("traces_lag_seconds", 60)
+        self.logs_interval = daemon_config.get("logs_interval_seconds", 60)
+        self.publish_interval = daemon_config.get("publish_interval_seconds", 1800)
+        self.initial_lookback_minutes = daemon_config.get("initial_lookback_minutes", 40)
+        self.max_pending_batches = daemon_config.get("max_pending_batches", 4)
+        self.publisher = DvcPublisher.from_config(config, base_dir)
+        # Every raw Jaeger and Loki response is saved, so the datasets can be rebuilt with --replay
+        self.archive = RawArchive.from_config(config, base_dir)
+        # Every file written is recorded with its row count, time range and query
+        self.catalog = DataCatalog.from_config(config, base_dir)
+        # The latency baselines of every target stay in memory between cycles
+        self.detectors = {target.name: LatencyDetector.from_config(config, base_dir, target.name)
+                          for target in self.targets}
+        # The window features of every target, fed with its spans and with the logs of its stored spans; the
+        # log cycle has stores of its own, so it never commits or drops the spans of a window being fetched
+        self.feature_stores = {target.name: self._feature_store(target) for target in self.targets}
+        self.log_feature_stores = [store for target in self.targets if (store := self._feature_store(target))]
+        self.executor = ThreadPoolExecutor(max_workers=daemon_config.get("cpu_workers", 2))
+        self.data_lock = asyncio.Lock()
+
+    def _feature_store(self, target: TraceTarget) -> FeatureStore | None:
+        return FeatureStore.from_config(self.config, self.base_dir, target.name, target.dataset_dir(self.spans_dir),
+                                        self.logs_dir, self.catalog)
+
+    async def _in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _every(self, interval_seconds: float, job, *args) -> None:
+        """Run `job` every `interval_seconds`; a run that overruns delays the next one instead of overlapping it."""
+        while True:
+            started = time.monotonic()
+            try:
+                await job(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"{job.__name__} failed: {e}")
+            await asyncio.sleep(max(0.0, interval_seconds - (time.monotonic() - started)))
+
+    def _drain(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop) -> Iterator[dict]:
+        """Yield the traces put on an asyncio queue, from a worker thread, until the None sentinel."""
+        while (traces := asyncio.run_coroutine_threadsafe(queue.get(), loop).result()) is not None:
+            yield from traces
+
+    def _write_traces(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, path: Path,
+                      metrics: StageMetrics, detector: LatencyDetector | None,
+                      feature_store: FeatureStore | None) -> int:
+        """
+        Flatten the queued traces into a Parquet file, scoring their latency and counting their window features
+        on the way; runs in the worker pool.
+        """
+        batches = metrics.iterate(
+            "flatten",
+            iter_span_batches(self._drain(queue, loop), batch_size=self.fetch_config.get("batch_size", 50_000)),
+            rows=lambda batch: batch.num_rows,
+        )
+        if detector is not None:
+            batches = metrics.iterate("score", detector.observe(batches), rows=lambda batch: batch.num_rows)
+        if feature_store is not None:
+            batches = metrics.iterate("aggregate", feature_store.observe(batches), rows=lambda batch: batch.num_rows)
+        with metrics.stage("write") as record:
+            record.rows_in = record.rows_out = write_span_batches_parquet(batches, path, self.writer_config)
+            record.bytes = path.stat().st_size
+        return record.rows_out
+
+    async def _fetch_traces(self, session, target: TraceTarget, start_us: int, end_us: int, queue: asyncio.Queue,
+                            writer: asyncio.Future, metrics: StageMetrics) -> None:
+        """Put the traces of each fetched slice on the queue, waiting while it is full; stop if the writer fails."""
+        with metrics.stage("fetch") as record:
+            async for traces in iter_jaeger_traces_sliced_async(
+                    session, self.config["server"], target.service, start_us, end_us,
+                    limit=target.limit,
+                    operation=target.operation,
+                    slice_minutes=self.fetch_config.get("slice_minutes", 60),
+                    max_workers=self.fetch_config.get("max_workers", 8),
+                    max_retries=self.fetch_config.get("max_retries", 3),
+                    backoff_factor=self.fetch_config.get("backoff_factor", 0.5),
+                    archive=self.archive):
+                record.rows_out += len(traces)
+                put = asyncio.ensure_future(queue.put(traces))
+                await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+                if not put.done():
+                    put.cancel()
+                    return
+
+    async def collect_traces(self, session, target: TraceTarget) -> None:
+        """Fetch the traces of a target started since its last window, back them up and append them to its dataset."""
+        end_us = int((time.time() - self.traces_lag) * 1_000_000)
+        start_us = read_trace_checkpoint(self.data_dir, target) or end_us - self.initial_lookback_minutes * 60_000_000
+        if end_us <= start_us:
+            return
+        day = datetime.fromtimestamp(start_us / 1e6, timezone.utc).strftime("%Y-%m-%d")
+        path = self.backups_dir / day / f"{target.name}_spans_{start_us}-{end_us}.parquet"
+        # Written outside the data directory, so a DVC snapshot never picks up a partial file
+        self.staging_dir.mkdir(exist_ok=True)
+        staging_path = self.staging_dir / path.name
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.max_pending_batches)
+        detector = self.detectors[target.name]
+        feature_store = self.feature_stores[target.name]
+        with StageMetrics.from_config(f"traces_{target.name}", self.config, self.base_dir) as metrics:
+            writer = loop.run_in_executor(self.executor, self._write_traces, queue, loop, staging_path, metrics,
+                                          detector, feature_store)
+            try:
+                try:
+                    await self._fetch_traces(session, target, start_us, end_us, queue, writer, metrics)
+                finally:
+                    if not writer.done():
+                        await queue.put(None)
+                    spans_written = await writer
+
+                async with self.data_lock:
+                    if spans_written:
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        staging_path.replace(path)
+                        source_query = {"service": target.service, "operation": target.operation,
+                                        "start": start_us, "end": end_us}
+                        await self._in_executor(self.catalog.record, path, "backup", source_query)
+                        with metrics.stage("merge", rows_in=spans_written) as record:
+                            appended = await self._in_executor(append_spans, path,
+                                                               target.dataset_dir(self.spans_dir),
+                                                               self.writer_config,
+                                                               self.catalog, source_query)
+                            record.rows_out = sum(appended.values())
+                    if detector is not None:
+                        with metrics.stage("anomalies", rows_in=spans_written) as record:
+                            record.rows_out = await self._in_executor(detector.commit)
+                    if feature_store is not None:
+                        with metrics.stage("features", rows_in=spans_written) as record:
+                            record.rows_out = await self._in_executor(feature_store.commit)
+                    write_trace_checkpoint(self.data_dir, target, end_us)
+            finally:
+                staging_path.unlink(missing_ok=True)
+                # A failed window is fetched again, so the spans it scored must not stay in the baselines
+                if detector is not None:
+                    detector.rollback()
+                if feature_store is not None:
+                    feature_store.rollback()
+        logging.info(f"{spans_written} spans of {target.name} collected for {start_us}-{end_us}.")
+
+    async def collect_logs(self, session) -> None:
+        """Fetch the logs ingested since the checkpoint and write them as a new Parquet batch."""
+        overlap_seconds = self.collector_config.get("overlap_seconds", 60)
+        plan = plan_fetch(self.logs_dir, time.time_ns(), overlap_seconds, self.initial_lookback_minutes)
+        with StageMetrics.from_config("logs", self.config, self.base_dir) as metrics:
+            with metrics.stage("fetch") as record:
+                result = await query_range_async(session, self.config["loki"], SR_API_QUERY, plan.start_ns, plan.end_ns,
+                                                  archive=self.archive)
+                record.rows_out = len(result.entries)
+            if result.truncated:
+                logging.warning(f"Log range {plan.start_ns}-{plan.end_ns} was truncated.")
+            def update_features(part_path: Path) -> None:
+                # Runs under the data lock, so the spans stored meanwhile cannot count these logs a second time
+                with metrics.stage("features") as record:
+                    for store in self.log_feature_stores:
+                        try:
+                            record.rows_in += store.add_logs(part_path)
+                            record.rows_out += store.commit()
+                        finally:
+                            store.rollback()
+
+            async with self.data_lock:
+                await self._in_executor(store_new_entries, self.logs_dir, plan, result.entries, overlap_seconds,
+                                        metrics, self.catalog,
+                                        {"query": SR_API_QUERY, "start": plan.start_ns, "end": plan.end_ns},
+                                        self.writer_config, update_features if self.log_feature_stores else None)
+
+    async def publish(self) -> None:
+        """Push the data files created since the last push with DVC; the .dvc file is committed every few pushes."""
+        with StageMetrics.from_config("publish", self.config, self.base_dir) as metrics:
+            async with self.data_lock:
+                with metrics.stage("dvc_push") as record:
+                    record.rows_out = await self._in_executor(
+                        self.publisher.publish, f"Update traces and logs {datetime.now()}"
+                    )
+
+    async def run(self) -> None:
+        """Pull the latest data once, then collect and publish until cancelled."""
+        self.logs_dir.mkdir(parents=True, exist_ok=True)
+        await self._in_executor(dvc_and_git_pull)
+        # The span store written before targets were configurable belongs to the default target
+        await self._in_executor(move_dataset, self.spans_dir, DEFAULT_TARGET.dataset_dir(self.spans_dir))
+        # Partitions written before IDs were stored as integers are converted before new spans are appended
+        for target in self.targets:
+            await self._in_executor(compact_dataset_files, target.dataset_dir(self.spans_dir),
+                                    self.writer_config)
+        fetch_config = self.fetch_config
+        username, password = os.getenv("JAEGER_USERNAME"), os.getenv("JAEGER_PASSWORD")
+        async with make_async_session(fetch_config.get("max_workers", 8) * len(self.targets), username, password,
+                                      max_requests_per_second=fetch_config.get("max_requests_per_second")) \
+                as jaeger_session, make_async_session(pool_size=2) as loki_session:
+            await asyncio.gather(
+                *(self._every(target.interval_seconds, self.collect_traces, jaeger_session, target)
+                  for target in self.targets),
+                self._every(self.logs_interval, self.collect_logs, loki_session),
+                self._every(self.publish_interval, self.publish),
+            )
+
+
+async def main(base_dir: Path) -> None:
+    with open(base_dir / "config.yml") as file:
+        config = safe_load(file)
+    daemon = IngestionDaemon(config, base_dir)
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await daemon.run()
+    except asyncio.CancelledError:
+        logging.info("Ingestion daemon stopped.")
+    finally:
+        daemon.executor.shutdown(wait=True)
+        if daemon.archive is not None:
+            daemon.archive.close()
+        daemon.catalog.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+                        handlers=[logging.FileHandler("ingest_daemon.log"), logging.StreamHandler()], force=True)
+    try:
+        asyncio.run(main(Path(__file__).resolve().parent))
+    except KeyboardInterrupt:
+        logging.info("Ingestion daemon terminated by user.")
@@ -2,8 +2,8 @@
 
 cd "$HOME/anomalies-detection" || exit 1  # Ensure we're in the right directory
 source .venv/bin/activate
+export PYTHONPATH="$PWD"
 
-git pull
-dvc pull
-python load_logs/logs_to_ds_collector.py
+# The daemon pulls code and data once at start-up, then collects traces and logs and pushes them with DVC
+exec python ingest_daemon.py
 
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from catalog.data_catalog import DataCatalog, date_to_us
+from load_logs.parse_logs import parse_log_lines
+from load_traces.utils.compact_schema import SPAN_ID_COLUMNS, TRACE_ID_COLUMNS, compact_table, storage_columns, to_pandas
+from load_traces.utils.flatten_spans import conform_batch, unify_schemas
+from load_traces.utils.table_writer import WriterConfig, write_table
+from monitoring.stage_metrics import StageMetrics
+
+CHECKPOINT_FILE = "checkpoint.json"
+PARTS_DIR = "parts"
+LEGACY_CSV = "logs.csv"
+
+
+def entry_key(timestamp_ns: int, line: str) -> str:
+    """Return the de-duplication key of a Loki entry: its timestamp and a hash of its line."""
+    return f"{timestamp_ns}:{hashlib.sha1(line.encode()).hexdigest()[:16]}"
+
+
+def read_checkpoint(logs_dir: Path) -> dict | None:
+    """
+    Load the collector checkpoint.
+
+    Returns:
+        dict | None: {'last_timestamp_ns': int, 'overlap_keys': [str, ...]}, or None if there is no checkpoint yet.
+    """
+    checkpoint_path = logs_dir / CHECKPOINT_FILE
+    if not checkpoint_path.exists():
+        return None
+    with open(checkpoint_path) as file:
+        return json.load(file)
+
+
+def write_checkpoint(logs_dir: Path, last_timestamp_ns: int, overlap_keys: list[str]) -> None:
+    """Save the collector checkpoint atomically (temporary file and rename)."""
+    tmp_path = logs_dir / f".{CHECKPOINT_FILE}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"last_timestamp_ns": last_timestamp_ns, "overlap_keys": overlap_keys}, file)
+    tmp_path.replace(logs_dir / CHECKPOINT_FILE)
+
+
+@dataclass
+class FetchPlan:
+    """The Loki range a collection cycle fetches, and the checkpoint state its entries are de-duplicated against."""
+    start_ns: int
+    end_ns: int
+    last_timestamp_ns: int = 0
+    seen_keys: set[str] = field(default_factory=set)
+
+
+def plan_fetch(logs_dir: Path, end_ns: int, overlap_seconds: int = 60, initial_lookback_minutes: int = 40) -> FetchPlan:
+    """
+    Plan the next collection cycle from the checkpoint.
+
+    The fetch starts `overlap_seconds` before the checkpointed Loki timestamp, to pick up late entries.
+    Without a checkpoint the last `initial_lookback_minutes` before `end_ns` are fetched.
+    """
+    checkpoint = read_checkpoint(logs_dir)
+    if checkpoint:
+        start_ns = checkpoint["last_timestamp_ns"] - overlap_seconds * 1_000_000_000
+        return FetchPlan(start_ns, end_ns, checkpoint["last_timestamp_ns"], set(checkpoint["overlap_keys"]))
+    logging.warning(f"No checkpoint found, fetching the last {initial_lookback_minutes} minutes.")
+    return FetchPlan(end_ns - initial_lookback_minutes * 60 * 1_000_000_000, end_ns)
+
+
+def store_new_entries(
+        logs_dir: Path,
+        plan: FetchPlan,
+        entries: list[tuple[int, str]],
+        overlap_seconds: int = 60,
+        metrics: StageMetrics | None = None,
+        catalog: DataCatalog | None = None,
+        source_query: dict | None = None,
+        writer_config: WriterConfig | None = None,
+        on_written: Callable[[Path], None] | None = None
+) -> int:
+    """
+    Drop the entries already seen in the overlap window, write the rest as a new Parquet batch and advance the checkpoint.
+
+    The checkpoint is only advanced after the batch file is written. The dedup, parse and write stages are
+    measured into `metrics`, if given, and the batch is recorded in `catalog` with `source_query`, if given.
+    The batch is written with `writer_config` (zstd Parquet by default), and `on_written`, if given, is called
+    with the new batch file once the checkpoint is advanced.
+
+    Returns:
+        int: The number of new log entries written.
+    """
+    metrics = metrics or StageMetrics("logs")
+    overlap_ns = overlap_seconds * 1_000_000_000
+    seen_keys = plan.seen_keys
+    new_entries = []
+    with metrics.stage("dedup", rows_in=len(entries)) as record:
+        for timestamp_ns, line in entries:
+            key = entry_key(timestamp_ns, line)
+            if key not in seen_keys:
+                seen_keys.add(key)
+                new_entries.append((timestamp_ns, line))
+        record.rows_out = len(new_entries)
+    if not new_entries:
+        logging.info("No new log entries since the last checkpoint.")
+        return 0
+
+    new_entries.sort(key=lambda entry: entry[0])
+    with metrics.stage("parse", rows_in=len(new_entries)) as record:
+        new_logs_df = parse_log_lines([line for _, line in new_entries])
+        record.rows_out = len(new_logs_df)
+    with metrics.stage("write", rows_in=len(new_logs_df)) as record:
+        part_path = write_log_batch(logs_dir, new_logs_df, new_entries[0][0], new_entries[-1][0], catalog,
+                                    source_query, writer_config)
+        record.rows_out = len(new_logs_df)
+        record.bytes = part_path.stat().st_size
+    logging.info(f"{len(new_entries)} new log entries saved at {part_path}.")
+
+    last_timestamp_ns = max(plan.last_timestamp_ns, new_entries[-1][0])
+    overlap_keys = [key for key in seen_keys if int(key.split(":", 1)[0]) >= last_timestamp_ns - overlap_ns]
+    write_checkpoint(logs_dir, last_timestamp_ns, overlap_keys)
+    if on_written is not None:
+        on_written(part_path)
+    return len(new_entries)
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    """Convert a logs DataFrame to Arrow, turning object columns of mixed types into strings."""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].map(lambda value: None if value is None else str(value))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_log_batch(logs_dir: Path, df: pd.DataFrame, first_timestamp_ns: int, last_timestamp_ns: int,
+                    catalog: DataCatalog | None = None, source_query: dict | None = None,
+                    writer_config: WriterConfig | None = None) -> Path:
+    """
+    Write one batch of parsed logs as a new Parquet file under `<logs_dir>/parts`.
+
+    The file is named after the Loki timestamps it covers and is written by `write_table` under a temporary
+    name, then renamed, so readers never see a partial file. Span and trace IDs are stored as integers and
+    low-cardinality strings as dictionaries, see `compact_table`. The file is recorded in `catalog`, if given.
+
+    Returns:
+        Path: The written file.
+    """
+    parts_dir = logs_dir / PARTS_DIR
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    part_path = parts_dir / f"logs-{first_timestamp_ns}-{last_timestamp_ns}.parquet"
+    write_table(compact_table(_to_arrow(df)), part_path, writer_config)
+    if catalog is not None:
+        catalog.record(part_path, "logs", source_query)
+    return part_path
+
+
+def find_log_files(logs_dir: Path | str) -> list[Path]:
+    """Return the legacy logs.csv and the Parquet log batches of the logs directory."""
+    logs_dir = Path(logs_dir)
+    files = [logs_dir / LEGACY_CSV] if (logs_dir / LEGACY_CSV).exists() else []
+    return files + sorted((logs_dir / PARTS_DIR).glob('logs-*.parquet'))
+
+
+def read_logs(
+        logs_dir: Path | str,
+        columns: list[str] | None = None,
+        start_date: str | None = None,
+        end_date: str | None = None,
+        catalog: DataCatalog | None = None,
+        start_us: int | None = None,
+        end_us: int | None = None
+) -> pd.DataFrame:
+    """
+    Load all collected logs: the Parquet batches under `<logs_dir>/parts` and the legacy logs.csv, if present.
+
+    With a date or time range only the logs whose `time` is in it are returned; with a `catalog`, the files whose
+    time range lies outside it are not opened.
+
+    Args:
+        logs_dir (Path | str): The logs directory, e.g. data/logs.
+        columns (list[str], optional): The columns to load; "trace_id" loads its two halves. Defaults to None, all columns.
+        start_date (str, optional): The first day of logs to load, "YYYY-MM-DD" (UTC). Defaults to None.
+        end_date (str, optional): The last day of logs to load, "YYYY-MM-DD" (UTC), inclusive. Defaults to None.
+        catalog (DataCatalog, optional): The data catalog to select the files with. Defaults to None.
+        start_us (int, optional): The start of the time range to load in microseconds, for a range finer than days;
+            with `start_date` the later of the two applies. Defaults to None.
+        end_us (int, optional): The end of the time range to load in microseconds, exclusive; with `end_date` the
+            earlier of the two applies. Defaults to None.
+
+    Returns:
+        DataFrame: The logs, with span and trace IDs as UInt64 and dictionary columns as categoricals.
+    """
+    logs_dir = Path(logs_dir)
+    if columns is not None:
+        columns = storage_columns(columns)
+    if start_date:
+        start_us = max(date_to_us(start_date), start_us if start_us is not None else -1)
+    if end_date:
+        end_us = min(date_to_us(end_date) + 86_400_000_000, end_us if end_us is not None else 2 ** 63 - 1)
+    log_files = find_log_files(logs_dir)
+    if catalog is not None:
+        log_files = catalog.prune(log_files, "logs", start_us, end_us)
+    tables = []
+    csv_path = logs_dir / LEGACY_CSV
+    if csv_path in log_files:
+        usecols = None if columns is None else (lambda column: column in columns)
+        id_types = {name: str for name in SPAN_ID_COLUMNS + TRACE_ID_COLUMNS}
+        tables.append(compact_table(_to_arrow(pd.read_csv(csv_path, usecols=usecols, dtype=id_types, low_memory=False))))
+    for part_path in log_files:
+        if part_path == csv_path:
+            continue
+        part_columns = None
+        if columns is not None:
+            part_columns = [column for column in columns if column in pq.read_schema(part_path).names]
+        tables.append(compact_table(pq.read_table(part_path, columns=part_columns)))
+    if not tables:
+        logging.warning(f"No logs found in {logs_dir}.")
+        return pd.DataFrame()
+
+    schema = unify_schemas(table.schema for table in tables)
+    logs_df = to_pandas(pa.Table.from_batches(
+        [conform_batch(batch, schema) for table in tables for batch in table.to_batches()], schema=schema
+    ))
+    if "time" in logs_df.columns:
+        logs_df["time"] = pd.to_datetime(logs_df["time"])
+        if start_us is not None or end_us is not None:
+            times = logs_df["time"].to_numpy(dtype="datetime64[us]").astype("int64")
+            in_range = logs_df["time"].notna().to_numpy()
+            if start_us is not None:
+                in_range &= times >= start_us
+            if end_us is not None:
+                in_range &= times < end_us
+            logs_df = logs_df[in_range].reset_index(drop=True)
+    return logs_df
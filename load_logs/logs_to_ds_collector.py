@@ -1,13 +1,20 @@
+import argparse
 from pathlib import Path
-import pandas as pd
 import requests
-import json
 import datetime
 import time
 import logging
-import subprocess
-from typing import Any
 from yaml import safe_load
+from archive.raw_archive import RawArchive
+from archive.replay import replay_logs
+from catalog.data_catalog import DataCatalog
+from features.window_features import FeatureStore
+from load_logs.log_store import plan_fetch, store_new_entries
+from load_logs.loki_client import SR_API_QUERY, make_session, query_range
+from load_traces.utils.table_writer import WriterConfig
+from load_traces.utils.trace_targets import load_trace_targets
+from monitoring.stage_metrics import StageMetrics
+from publish.dvc_publisher import DvcPublisher, dvc_and_git_pull
 
 # Setup logging
 logging.basicConfig(filename='log_fetcher.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,6 +29,9 @@ def get_config(path: Path | str) -> dict:
 
 parent_path = Path(__file__).parents[1]
 config_path = parent_path / "config.yml"
+loki_session = make_session(pool_size=1)
+# The archive every raw Loki response is saved to, opened by the collector loop
+raw_archive: RawArchive | None = None
 
 
 def get_unix_timestamp_ns(dt: datetime.datetime) -> int:
@@ -29,65 +39,65 @@ def get_unix_timestamp_ns(dt: datetime.datetime) -> int:
     return int(dt.timestamp() * 1e9)
 
 
-def fetch_logs(start_timestamp: datetime.datetime, end_timestamp: datetime.datetime) -> list[str]:
-    """Fetch logs from Loki within the specified timestamp range."""
-    loki_url = get_config(config_path)["loki"]
-    params = {
-        "query": "{container_name=\"/sr-api\"} |= `` | json | __error__=``",
-        "start": get_unix_timestamp_ns(start_timestamp),
-        "end": get_unix_timestamp_ns(end_timestamp),
-        "limit": 5000,
-    }
-    response = requests.get(loki_url, params=params)
-    logging.debug(response.headers)
-    if response.status_code == 200:
-        logging.info("Logs fetched successfully.")
-        logs = response.json()
-        return [entry[1] for result in logs['data']['result'] for entry in result['values']]
-    else:
-        logging.error(f"Failed to fetch logs. Status code: {response.status_code}")
-        return []
-
-
-def parse_logs_to_dataframe(log_entries: list[str]) -> pd.DataFrame:
-    """Parse log entries and return a DataFrame."""
-    parsed_log_entries: list[dict[str, Any]] = []
-    for log_entry in log_entries:
-        entry_dict = json.loads(log_entry)
-        # Extract common fields and any additional ones
-        parsed_entry = {**entry_dict, "time": pd.to_datetime(entry_dict["time"], unit='ms')}
-        parsed_log_entries.append(parsed_entry)
-
-    if parsed_log_entries:
-        logging.info("Log entries parsed successfully.")
-    else:
-        logging.warning("No log entries to parse.")
-
-    return pd.DataFrame(parsed_log_entries)
-
-
-def dvc_and_git_pull():
-    try:
-        subprocess.run(["git", "pull"], check=True)
-        logging.info("Git pull successful.")
-        subprocess.run(["dvc", "pull"], check=True)
-        logging.info("DVC pull successful.")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Failed to pull data. Error: {e}")
+def fetch_log_entries(start_ns: int, end_ns: int) -> list[tuple[int, str]]:
+    """
+    Fetch all logs from Loki within [start_ns, end_ns), oldest first, with their Loki timestamps.
 
+    The range is paged until exhausted over the collector's pooled session.
 
-def dvc_add_and_push(data_dir, dvc_file="data.dvc", message="Update logs"):
-    """Add and push the given file to DVC remote storage."""
+    Returns:
+        list[tuple[int, str]]: (timestamp in nanoseconds, log line) pairs.
+    """
+    loki_url = get_config(config_path)["loki"]
     try:
-        subprocess.run(['dvc', 'add', data_dir], check=True)
-        subprocess.run(['git', 'add', dvc_file], check=True)
-        subprocess.run(['git', 'commit', '-m', message], check=True)
-        subprocess.run(['dvc', 'push'], check=True)
-        logging.info(f"Logs added {data_dir}, {dvc_file} and pushed to DVC successfully.")
-        subprocess.run(['git', 'push'], check=True)
-        logging.info("Git push successful.")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Failed to add or push logs to DVC. Error: {e}")
+        result = query_range(loki_session, loki_url, SR_API_QUERY, start_ns, end_ns, archive=raw_archive)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Failed to fetch logs. Error: {e}")
+        return []
+    if result.truncated:
+        logging.warning(f"Log range {start_ns}-{end_ns} was truncated.")
+    logging.info(f"{len(result.entries)} log entries fetched successfully in {result.pages} pages.")
+    return result.entries
+
+
+def collect_new_logs(
+        logs_dir: Path,
+        overlap_seconds: int = 60,
+        initial_lookback_minutes: int = 40,
+        metrics: StageMetrics | None = None,
+        catalog: DataCatalog | None = None,
+        writer_config: WriterConfig | None = None,
+        feature_stores: list[FeatureStore] | None = None
+) -> int:
+    """
+    Fetch the logs ingested since the last checkpoint and write them as a new Parquet batch.
+
+    The fetch starts `overlap_seconds` before the checkpointed Loki timestamp, to pick up late entries,
+    and entries already seen in that overlap window are dropped. Without a checkpoint the last
+    `initial_lookback_minutes` are fetched. The checkpoint is only advanced after the batch file is written.
+    The fetch, dedup, parse and write stages are measured into `metrics`, if given, and the new batch is
+    recorded in `catalog`, if given. It is written with `writer_config` (zstd Parquet by default), and the
+    logs of already stored spans are then counted into the window features of every `feature_stores` target.
+
+    Returns:
+        int: The number of new log entries written.
+    """
+    metrics = metrics or StageMetrics("logs")
+    end_ns = get_unix_timestamp_ns(datetime.datetime.now(datetime.timezone.utc))
+    plan = plan_fetch(logs_dir, end_ns, overlap_seconds, initial_lookback_minutes)
+    with metrics.stage("fetch") as record, metrics.count_response_bytes(loki_session, "fetch"):
+        entries = fetch_log_entries(plan.start_ns, plan.end_ns)
+        record.rows_out = len(entries)
+    source_query = {"query": SR_API_QUERY, "start": plan.start_ns, "end": plan.end_ns}
+
+    def update_features(part_path: Path) -> None:
+        with metrics.stage("features") as record:
+            for store in feature_stores or []:
+                record.rows_in += store.add_logs(part_path)
+                record.rows_out += store.commit()
+
+    return store_new_entries(logs_dir, plan, entries, overlap_seconds, metrics, catalog, source_query, writer_config,
+                             update_features if feature_stores else None)
 
 
 # Directory setup
@@ -95,46 +105,72 @@ parent_path = Path(__file__).resolve().parents[1]
 dvc_file = parent_path / "data.dvc"
 data_dir = parent_path / "data"
 logs_dir = data_dir / "logs"
-logs_dir.mkdir(parents=True, exist_ok=True)  # Ensure the directory exists
-df_name = "logs.csv"
-
-# Attempt to read existing logs from CSV
-csv_path = logs_dir / df_name
-if csv_path.exists():
-    df_logs: pd.DataFrame = pd.read_csv(csv_path)
-else:
-    # Initialize an empty DataFrame to store logs
-    df_logs: pd.DataFrame = pd.DataFrame()
-    logging.warning("Failed to load existing log data, blank df created")
-
-try:
-    while True:
-        logging.info("Script execution started.")
-        logging.debug("Performing DVC and Git pull...")
-        dvc_and_git_pull()
-
-        # Define the time range for fetching logs
-        logging.debug("defining time range...")
-        end_timestamp: datetime.datetime = datetime.datetime.now(datetime.timezone.utc)
-        start_timestamp: datetime.datetime = end_timestamp - datetime.timedelta(minutes=40)
-
-        log_entries: list[str] = fetch_logs(start_timestamp, end_timestamp)
-        new_logs_df: pd.DataFrame = parse_logs_to_dataframe(log_entries)
-
-        # Append new logs to the existing DataFrame and remove duplicates
-        logging.info(f"Appending {len(new_logs_df)} new log entries to old logs {len(df_logs)}.")
-        df_logs = pd.concat([df_logs, new_logs_df], ignore_index=True).drop_duplicates(subset=['time'])
-
-        logging.info("Saving logs to CSV...")
-        df_logs.to_csv(csv_path, index=False)
-        logging.info(f"Logs updated and saved at {csv_path}.")
-
-        logging.debug("Performing DVC add and push...")
-        dvc_add_and_push(data_dir=data_dir, dvc_file=str(dvc_file), message=f"Update logs {datetime.datetime.now()}")
-
-        logging.info("Sleeping for 30 minutes...")
-        time.sleep(1800)
-except KeyboardInterrupt:
-    logging.info("Script terminated by user.")
-except Exception as e:
-    logging.exception(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect the sr-api logs from Loki into Parquet batches.")
+    parser.add_argument("--replay", action="store_true",
+                        help="rebuild the log batches from the raw response archive instead of querying Loki")
+    parser.add_argument("--start", default=None, help="first day to replay, YYYY-MM-DD (UTC); defaults to the whole archive")
+    parser.add_argument("--end", default=None, help="last day to replay, YYYY-MM-DD (UTC), inclusive")
+    parser.add_argument("--output", type=Path, default=parent_path / "replay",
+                        help="directory of the replayed logs; the batches go to <output>/logs")
+    parser.add_argument("--workers", type=int, default=None, help="replay worker processes; defaults to one per CPU")
+    args = parser.parse_args()
+    config = get_config(config_path)
+    # Every raw Loki response is saved, so the log batches can be rebuilt later with --replay
+    raw_archive = RawArchive.from_config(config, parent_path)
+    if args.replay:
+        if raw_archive is None:
+            raise SystemExit("The raw response archive is disabled (archive.dir is null), nothing to replay.")
+
+        def day_to_ns(day: str) -> int:
+            return get_unix_timestamp_ns(datetime.datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc))
+
+        replay_logs(
+            raw_archive, SR_API_QUERY, args.output / "logs",
+            start_ns=day_to_ns(args.start) if args.start else None,
+            end_ns=day_to_ns(args.end) + 86_400 * 1_000_000_000 if args.end else None,
+            max_workers=args.workers,
+        )
+        raise SystemExit(0)
+
+    logs_dir.mkdir(parents=True, exist_ok=True)  # Ensure the directory exists
+    collector_config = config.get("logs_collector", {})
+    publisher = DvcPublisher.from_config(config, parent_path)
+    catalog = DataCatalog.from_config(config, parent_path)
+    writer_config = WriterConfig.from_config(config)
+    # Window features of every trace target, fed with the logs of its stored spans
+    feature_stores = [store for target in load_trace_targets(config)
+                      if (store := FeatureStore.from_config(config, parent_path, target.name,
+                                                            target.dataset_dir(data_dir / "spans"), logs_dir,
+                                                            catalog)) is not None]
+
+    try:
+        while True:
+            logging.info("Script execution started.")
+            with StageMetrics.from_config("logs", config, parent_path) as metrics:
+                logging.debug("Performing DVC and Git pull...")
+                with metrics.stage("dvc_pull"):
+                    dvc_and_git_pull()
+
+                collect_new_logs(
+                    logs_dir,
+                    overlap_seconds=collector_config.get("overlap_seconds", 60),
+                    initial_lookback_minutes=collector_config.get("initial_lookback_minutes", 40),
+                    metrics=metrics,
+                    catalog=catalog,
+                    writer_config=writer_config,
+                    feature_stores=feature_stores,
+                )
+
+                logging.debug("Pushing new files with DVC...")
+                with metrics.stage("dvc_push") as record:
+                    record.rows_out = publisher.publish(message=f"Update logs {datetime.datetime.now()}")
+
+            interval_minutes = collector_config.get("interval_minutes", 30)
+            logging.info(f"Sleeping for {interval_minutes} minutes...")
+            time.sleep(interval_minutes * 60)
+    except KeyboardInterrupt:
+        logging.info("Script terminated by user.")
+    except Exception as e:
+        logging.exception(f"An error occurred: {e}")
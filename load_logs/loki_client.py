@@ -0,0 +1,218 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import aiohttp
+import requests
+
+from archive.raw_archive import LOKI, RawArchive
+from load_traces.utils.fetch_jaeger_traces import get_json_async, make_session
+
+# LogQL query of the sr-api container logs, parsed as JSON
+SR_API_QUERY = "{container_name=\"/sr-api\"} |= `` | json | __error__=``"
+
+
+@dataclass
+class RangeResult:
+    """The entries of one [start_ns, end_ns) range and how they were fetched."""
+    start_ns: int
+    end_ns: int
+    entries: list[tuple[int, str]] = field(default_factory=list)
+    pages: int = 0
+    truncated: bool = False
+
+
+def _query_page(
+        session: requests.Session,
+        url: str,
+        query: str,
+        start_ns: int,
+        end_ns: int,
+        limit: int,
+        direction: str,
+        archive: RawArchive | None = None
+) -> list[tuple[int, str]]:
+    """Send one query_range request and return its entries across all streams, in `direction` order."""
+    params = {
+        "query": query,
+        "start": start_ns,
+        "end": end_ns,
+        "limit": limit,
+        "direction": direction,
+    }
+    response = session.get(url, params=params)
+    response.raise_for_status()
+    if archive is not None:
+        archive.put(LOKI, params, response.content)
+    return _page_entries(response.json(), direction)
+
+
+def _page_entries(response: dict, direction: str) -> list[tuple[int, str]]:
+    """Return the entries of a query_range response across all streams, in `direction` order."""
+    result = response['data']['result']
+    entries = [(int(entry[0]), entry[1]) for stream in result for entry in stream['values']]
+    entries.sort(key=lambda entry: entry[0], reverse=direction == "backward")
+    return entries
+
+
+class _RangePager:
+    """
+    The paging state of one query_range call, shared by the blocking and the asyncio clients.
+
+    Each page continues from the timestamp of the last entry returned. Loki bounds are inclusive at the
+    start, so the entries at that boundary timestamp are fetched again and dropped. If a page holds
+    nothing but one timestamp, the cursor is moved past it and the range is reported as truncated.
+    """
+
+    def __init__(self, start_ns: int, end_ns: int, limit: int, direction: str, max_pages: int | None):
+        self.result = RangeResult(start_ns, end_ns)
+        self.limit = limit
+        self.direction = direction
+        self.max_pages = max_pages
+        self.page_start, self.page_end = start_ns, end_ns
+        self.boundary_keys: set[tuple[int, str]] = set()
+        self.exhausted = False
+
+    def next_bounds(self) -> tuple[int, int] | None:
+        """Return the bounds of the next page to fetch, or None once the range is exhausted."""
+        if self.exhausted or self.page_start >= self.page_end:
+            return None
+        if self.max_pages is not None and self.result.pages >= self.max_pages:
+            self.result.truncated = True
+            return None
+        return self.page_start, self.page_end
+
+    def add_page(self, page: list[tuple[int, str]]) -> None:
+        """Record one fetched page and move the cursor past it."""
+        result = self.result
+        result.pages += 1
+        result.entries.extend(entry for entry in page if entry not in self.boundary_keys)
+        if len(page) < self.limit:
+            self.exhausted = True
+            return
+
+        cursor = page[-1][0]
+        self.boundary_keys = {entry for entry in page if entry[0] == cursor}
+        if len(self.boundary_keys) == len(page):
+            # One timestamp fills the whole page: more entries may share it, skip past it
+            result.truncated = True
+            self.boundary_keys = set()
+            cursor += 1 if self.direction == "forward" else -1
+        if self.direction == "forward":
+            self.page_start = cursor
+        else:
+            self.page_end = cursor + 1
+
+    def finish(self) -> RangeResult:
+        """Return the entries, oldest first."""
+        if self.direction == "backward":
+            self.result.entries.reverse()
+        return self.result
+
+
+def query_range(
+        session: requests.Session,
+        url: str,
+        query: str,
+        start_ns: int,
+        end_ns: int,
+        limit: int = 5000,
+        direction: str = "forward",
+        max_pages: int | None = None,
+        archive: RawArchive | None = None
+) -> RangeResult:
+    """
+    Fetch every entry of [start_ns, end_ns) from Loki, paging until the range is exhausted.
+
+    Each page continues from the timestamp of the last entry returned. Loki bounds are inclusive at the
+    start, so the entries at that boundary timestamp are fetched again and dropped. If a page holds
+    nothing but one timestamp, the cursor is moved past it and the range is reported as truncated.
+
+    Args:
+        session (requests.Session): The HTTP session to send the requests with.
+        url (str): The Loki query_range URL.
+        query (str): The LogQL query.
+        start_ns (int): The start of the range, in nanoseconds, inclusive.
+        end_ns (int): The end of the range, in nanoseconds, exclusive.
+        limit (int, optional): The number of entries per page. Defaults to 5000.
+        direction (str, optional): "forward" or "backward". Defaults to "forward".
+        max_pages (int, optional): Stop after this many pages and report truncation. Defaults to None, no bound.
+        archive (RawArchive, optional): The archive the raw response of every page is saved to. Defaults to None.
+
+    Returns:
+        RangeResult: The entries, oldest first, with the number of pages and the truncation flag.
+    """
+    pager = _RangePager(start_ns, end_ns, limit, direction, max_pages)
+    while (bounds := pager.next_bounds()) is not None:
+        pager.add_page(_query_page(session, url, query, *bounds, limit, direction, archive))
+    return pager.finish()
+
+
+async def query_range_async(
+        session: aiohttp.ClientSession,
+        url: str,
+        query: str,
+        start_ns: int,
+        end_ns: int,
+        limit: int = 5000,
+        direction: str = "forward",
+        max_pages: int | None = None,
+        archive: RawArchive | None = None
+) -> RangeResult:
+    """The asyncio counterpart of `query_range`, over a pooled aiohttp session."""
+    pager = _RangePager(start_ns, end_ns, limit, direction, max_pages)
+    while (bounds := pager.next_bounds()) is not None:
+        params = {"query": query, "start": bounds[0], "end": bounds[1], "limit": limit, "direction": direction}
+        on_body = None if archive is None else lambda body: archive.put(LOKI, params, body)
+        response = await get_json_async(session, url, params, on_body=on_body)
+        pager.add_page(_page_entries(response, direction))
+    return pager.finish()
+
+
+def fetch_range_parallel(
+        url: str,
+        start_ns: int,
+        end_ns: int,
+        query: str = SR_API_QUERY,
+        split_seconds: float = 3600,
+        limit: int = 5000,
+        max_workers: int = 8,
+        session: requests.Session | None = None
+) -> list[RangeResult]:
+    """
+    Fetch a long range from Loki as sub-ranges of `split_seconds`, paged and fetched concurrently.
+
+    All sub-ranges share one pooled session. The entry count and truncation of each sub-range are logged.
+
+    Args:
+        url (str): The Loki query_range URL.
+        start_ns (int): The start of the range, in nanoseconds, inclusive.
+        end_ns (int): The end of the range, in nanoseconds, exclusive.
+        query (str, optional): The LogQL query. Defaults to the sr-api container logs.
+        split_seconds (float, optional): The sub-range length in seconds. Defaults to 3600.
+        limit (int, optional): The number of entries per page. Defaults to 5000.
+        max_workers (int, optional): The number of sub-ranges fetched concurrently. Defaults to 8.
+        session (requests.Session, optional): A session to reuse instead of creating a new one. Defaults to None.
+
+    Returns:
+        list[RangeResult]: The sub-range results, in time order.
+    """
+    split_ns = int(split_seconds * 1_000_000_000)
+    ranges = [(start, min(start + split_ns, end_ns)) for start in range(start_ns, end_ns, split_ns)]
+    own_session = session is None
+    if own_session:
+        session = make_session(pool_size=max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda bounds: query_range(session, url, query, *bounds, limit=limit), ranges
+            ))
+    finally:
+        if own_session:
+            session.close()
+
+    for result in results:
+        log = logging.warning if result.truncated else logging.info
+        log(f"Loki range {result.start_ns}-{result.end_ns}: {len(result.entries)} entries in {result.pages} pages"
+            f"{', truncated' if result.truncated else ''}.")
+    return results
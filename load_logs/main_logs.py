@@ -1,11 +1,12 @@
 from pathlib import Path
 
-import requests
 import datetime
-import pandas as pd
-import json
 from yaml import safe_load
 
+from load_logs.parse_logs import parse_log_lines
+from load_logs.loki_client import fetch_range_parallel, make_session
+from monitoring.stage_metrics import StageMetrics
+
 
 def get_unix_timestamp_ns(dt):
     """Convert a datetime object to Unix timestamp in nanoseconds."""
@@ -21,72 +22,42 @@ def get_config(path: Path | str) -> dict:
 
 parent_path = Path(__file__).parents[1]
 config_path = parent_path / "config.yml"
-server = get_config(config_path)["loki"]
-
-
-def fetch_logs_for_hour(start_hour):
-    """Fetch logs for a specific hour."""
-    params = {
-        "query": "{container_name=\"/sr-api\"} |= `` | json | __error__=``",
-        "start": get_unix_timestamp_ns(start_hour),
-        "end": get_unix_timestamp_ns(start_hour + datetime.timedelta(hours=1)),
-        "limit": 5000,
-    }
-    response = requests.get(loki_url, params=params)
-    if response.status_code == 200:
-        logs = response.json()
-        print(logs)
-        return [entry[1] for result in logs['data']['result'] for entry in result['values']]
-    else:
-        print(f"Failed to fetch logs for hour starting at {start_hour}. Status code: {response.status_code}")
-        return []
+config = get_config(config_path)
+server = config["loki"]
 
 
 # Setup
 end_timestamp = datetime.datetime.now(datetime.timezone.utc)
 start_timestamp = end_timestamp - datetime.timedelta(days=1)
 loki_url = server
-
-# Collect logs
-all_log_entries = []
-current_hour = start_timestamp
-epoch = 0
-while current_hour < end_timestamp:
-    print(f"Fetching logs for {current_hour}")
-    epoch += 1
-    print(f"Epoch: {epoch}")
-    hour_log_entries = fetch_logs_for_hour(current_hour)
-    print(f"Number of logs fetched: {len(hour_log_entries)}")
-    all_log_entries.extend(hour_log_entries)
-    current_hour += datetime.timedelta(hours=1)
-
-
-# Handle logs here
-def parse_log_entry(log_entry):
-    """Parse a log entry and prepare it for DataFrame insertion."""
-    entry_dict = json.loads(log_entry)
-    parsed_entry = {
-        "level": entry_dict.get("level", ""),
-        "message": entry_dict.get("message", ""),
-        "time": entry_dict.get("time", 0)
-    }
-
-    # Handle additional fields
-    for key, value in entry_dict.items():
-        if key not in ["level", "message", "time"]:
-            parsed_entry[f"add_{key}"] = value
-
-    return parsed_entry
-
-
-# Parse each log entry
-parsed_log_entries = [parse_log_entry(log) for log in all_log_entries]
-
-# Create a DataFrame
-df_logs = pd.DataFrame(parsed_log_entries)
-
-# Set 'time' as the index of the DataFrame and convert to datetime
+session = make_session(pool_size=8)
+
+metrics = StageMetrics.from_config("main_logs", config, parent_path)
+
+with metrics, session, metrics.count_response_bytes(session, "fetch"):
+    # Collect logs: the 24 hourly ranges are paged and fetched concurrently over one session
+    with metrics.stage("fetch") as record:
+        range_results = fetch_range_parallel(
+            loki_url,
+            get_unix_timestamp_ns(start_timestamp),
+            get_unix_timestamp_ns(end_timestamp),
+            split_seconds=3600,
+            max_workers=8,
+            session=session,
+        )
+        all_log_entries = []
+        for epoch, range_result in enumerate(range_results, start=1):
+            print(f"Epoch: {epoch}, number of logs fetched: {len(range_result.entries)}"
+                  f"{' (truncated)' if range_result.truncated else ''}")
+            all_log_entries.extend(line for _, line in range_result.entries)
+        record.rows_out = len(all_log_entries)
+
+    # Parse all log entries in one batch, prefixing the additional fields with add_
+    with metrics.stage("parse", rows_in=len(all_log_entries)) as record:
+        df_logs = parse_log_lines(all_log_entries, extra_prefix="add_")
+        record.rows_out = len(df_logs)
+
+# Set 'time' (already converted to datetime) as the index of the DataFrame
 df_logs.set_index('time', inplace=True)
-df_logs.index = pd.to_datetime(df_logs.index, unit='ms')
 
 print(df_logs.head())  # Display the first few rows of the DataFrame
@@ -0,0 +1,60 @@
+import io
+import logging
+
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pa_json
+
+# Fields every sr-api log line has; the others are extra fields
+BASE_FIELDS = ("level", "message", "time")
+
+
+def _decode_arrow(lines: list[str]) -> pd.DataFrame:
+    """Decode JSON lines in bulk with Arrow's newline-delimited JSON reader."""
+    buffer = io.BytesIO("\n".join(lines).encode())
+    table = pa_json.read_json(buffer, parse_options=pa_json.ParseOptions(newlines_in_values=False))
+    return table.to_pandas()
+
+
+def _decode_orjson(lines: list[str]) -> pd.DataFrame:
+    """Decode JSON lines with orjson into records, for batches Arrow cannot type (e.g. a field of mixed types)."""
+    return pd.DataFrame.from_records([orjson.loads(line) for line in lines])
+
+
+def parse_log_lines(lines: list[str], extra_prefix: str = "") -> pd.DataFrame:
+    """
+    Parse Loki log lines (one JSON object each) into a DataFrame in one batch.
+
+    All lines are decoded at once by Arrow's JSON reader, falling back to orjson when the batch has
+    fields of inconsistent types. Columns are built directly from the decoded batch and `time`
+    (epoch milliseconds) is converted to datetime once, as a column.
+
+    Args:
+        lines (list[str]): The log lines.
+        extra_prefix (str, optional): A prefix for the fields other than level, message and time. When set,
+            those three columns are always present, with "" and 0 for missing values. Defaults to "".
+
+    Returns:
+        DataFrame: One row per log line.
+    """
+    if not lines:
+        return pd.DataFrame()
+
+    try:
+        df = _decode_arrow(lines)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        logging.debug(f"Arrow could not decode the log batch ({e}), falling back to orjson.")
+        df = _decode_orjson(lines)
+
+    if extra_prefix:
+        for field, default in zip(BASE_FIELDS, ("", "", 0)):
+            df[field] = df[field].fillna(default) if field in df.columns else default
+        extra_columns = [column for column in df.columns if column not in BASE_FIELDS]
+        df = df[list(BASE_FIELDS) + extra_columns].rename(
+            columns={column: f"{extra_prefix}{column}" for column in extra_columns}
+        )
+
+    if "time" in df.columns:
+        df["time"] = pd.to_datetime(df["time"], unit="ms")
+    return df
@@ -1,15 +1,26 @@
-from datetime import datetime
-from pyarrow.lib import ArrowTypeError
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import logging
 
-import pandas as pd
 import shutil
 import os
+import requests
 from yaml import safe_load
 from pathlib import Path
+from anomaly.latency_detector import LatencyDetector
+from archive.raw_archive import RawArchive
+from archive.replay import replay_traces
+from catalog.data_catalog import DataCatalog
+from features.window_features import FeatureStore
 from utils.date_utils import get_date_strings
-from utils.fetch_jaeger_traces import fetch_jaeger_traces
-from utils.convert_tag_value import convert_tag_value
+from utils.fetch_jaeger_traces import iter_jaeger_traces_sliced, make_session, share_session
+from utils.flatten_spans import export_parquet_to_csv, iter_span_batches, write_span_batches_parquet
+from utils.span_dataset import append_spans, compact_dataset_files, import_legacy_spans, move_dataset, \
+    read_dataset_schema
+from utils.table_writer import WriterConfig
+from utils.trace_targets import DEFAULT_TARGET, TraceTarget, load_trace_targets
+from monitoring.stage_metrics import StageMetrics
 
 # Configure logging
 parent_path = Path(__file__).parents[1]
@@ -22,126 +33,183 @@ logging.basicConfig(level=logging.DEBUG,
                     ])
 config = safe_load(open(parent_path / "config.yml"))
 
-logging.info("Script started.")
-
-service_name = "sr-api"
 start_date_str, end_date_str = get_date_strings()
-limit = 25000
-operation = "/upload"
+targets = load_trace_targets(config)
+fetch_config = config.get("jaeger_fetch", {})
+writer_config = WriterConfig.from_config(config)
 data_dir = parent_path / "data"
 backup_dir = data_dir / "backups" / datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+spans_dir = data_dir / "spans"
+full_parquet_filename = data_dir / "full_upload_spans.parquet"
+date_suffix = datetime.now().strftime("%Y-%m-%d")
 
 username = os.getenv("JAEGER_USERNAME")
 password = os.getenv("JAEGER_PASSWORD")
 server = config["server"]
 
-logging.info(f"Fetching traces for {service_name} service from {start_date_str} to {end_date_str}.")
-
-
-def get_most_recent_file(directory, pattern):
-    """Get the most recent file matching the pattern in the given directory."""
-    files = list(directory.glob(pattern))
-    if not files:
-        logging.warning(f"No files matching {pattern} in {directory}.")
-        return None
-    return max(files, key=os.path.getmtime)
-
-
-# Check for the most recent CSV and Parquet files
-most_recent_csv = get_most_recent_file(data_dir, "*.csv")
-most_recent_parquet = get_most_recent_file(data_dir, "*.parquet")
-
-# Load the most recent data if available
-if most_recent_csv and most_recent_parquet:
-    logging.info("Loading the most recent parquet data for concatenation.")
-    previous_data_df = pd.read_parquet(most_recent_parquet)
-else:
-    logging.info("No previous data found, initializing new dataset.")
-    previous_data_df = pd.DataFrame()
-
-traces = fetch_jaeger_traces(
-    server=server,
-    service_name=service_name,
-    start_date=start_date_str,
-    end_date=end_date_str, limit=limit, operation=operation,
-    username=username,
-    password=password
-)
-logging.info("Traces fetched successfully.")
-
-
-# Process and save the data
-logging.info("Processing fetched traces.")
-spans_list = [
-    {
-        **{
-            'spanID': span.get('spanID'),
-            'traceID': span.get('traceID'),
-            'operationName': span.get('operationName'),
-            'serviceName': span.get('process', {}).get('serviceName'),
-            'startTime': span.get('startTime'),
-            'duration': span.get('duration')
-        },
-        **{
-            'tag_' + tag.get('key'): convert_tag_value(tag.get('value'), tag.get('type', 'string'))
-            for tag in span.get('tags', [])
-        }
-    }
-    for trace in traces.get('data', [])
-    for span in trace.get('spans', [])
-]
-
-# Create a DataFrame
-spans_df = pd.DataFrame(spans_list)
-
-# Optional: Convert startTime to a readable datetime format
-spans_df['startTime'] = pd.to_datetime(spans_df['startTime'], unit='us')
-
-
-logging.info("Processing completed. Saving data...")
-# Define file paths for daily and full (cumulative) backups
-date_suffix = datetime.now().strftime("%Y-%m-%d")
-daily_csv_filename = f"{data_dir}/daily_upload_spans_{date_suffix}.csv"
-daily_parquet_filename = f"{data_dir}/daily_upload_spans_{date_suffix}.parquet"
-full_csv_filename = f"{data_dir}/full_upload_spans.csv"
-full_parquet_filename = f"{data_dir}/full_upload_spans.parquet"
-
-# Save today's data (daily backup) without affecting previous daily backups
-spans_df.to_csv(path_or_buf=daily_csv_filename, index=False)
-spans_df.to_parquet(path=daily_parquet_filename, index=False)
-logging.info("Data saved successfully. Performing backup...")
-
-# For full data backup: Check if a full backup exists, load it, append new data, and save
-if os.path.exists(full_parquet_filename):
-    # Load existing full data
-    full_data_df = pd.read_parquet(full_parquet_filename)
-    logging.info("Full data loaded successfully.")
-elif os.path.exists(full_csv_filename):
-    full_data_df = pd.read_csv(full_csv_filename)
-    logging.info("Full data loaded successfully.")
-else:
-    # Initialize empty DataFrame if full data doesn't exist yet
-    logging.warning("No full data found, initializing new dataset.")
-    full_data_df = pd.DataFrame()
-
-# Append today's data to the full data DataFrame
-full_data_combined_df = pd.concat([full_data_df, spans_df], ignore_index=True)
-
-# Save the updated full data (cumulative backup)
-full_data_combined_df.to_csv(path_or_buf=full_csv_filename, index=False)
-logging.info(f"full csv data saved to {full_csv_filename}")
-try:
-    full_data_combined_df.to_parquet(path=full_parquet_filename, index=False)
-    logging.info(f"full parquet data saved to {full_parquet_filename}")
-except ArrowTypeError as ate:
-    logging.error(f"Failed to save parquet file. Error was: {ate}")
-
-
-backup_dir.mkdir(parents=True, exist_ok=True)
-
-if most_recent_csv:
-    shutil.move(most_recent_csv, backup_dir / most_recent_csv.name)
-if most_recent_parquet:
-    shutil.move(most_recent_parquet, backup_dir / most_recent_parquet.name)
-
-logging.info("Backup completed successfully.")
+
+def collect_target(target: TraceTarget, session: requests.Session, archive: RawArchive | None,
+                   catalog: DataCatalog) -> int:
+    """
+    Fetch the traces of one target, save them as a daily Parquet file (and CSV, with `writer.export_csv`) and
+    append them to the target's span dataset.
+    """
+    logging.info(f"Fetching traces for {target.service} {target.operation or ''} from {start_date_str} to {end_date_str}.")
+    target_session = share_session(session)
+    daily_csv_filename = data_dir / f"daily_{target.name}_spans_{date_suffix}.csv"
+    daily_parquet_filename = data_dir / f"daily_{target.name}_spans_{date_suffix}.parquet"
+    dataset_dir = target.dataset_dir(spans_dir)
+    source_query = {"service": target.service, "operation": target.operation, "start": start_date_str,
+                    "end": end_date_str}
+    # Latency baselines of the target, updated from the spans as they are flattened
+    detector = LatencyDetector.from_config(config, parent_path, target.name)
+    # Window features of the target, updated from the same batches
+    feature_store = FeatureStore.from_config(config, parent_path, target.name, dataset_dir, data_dir / "logs", catalog)
+
+    # Per-stage timings, row counts, bytes and memory are exported when the run ends
+    metrics = StageMetrics.from_config(f"traces_{target.name}", config, parent_path)
+    with metrics, metrics.count_response_bytes(target_session, "fetch"):
+        traces = metrics.iterate("fetch", iter_jaeger_traces_sliced(
+            server=server,
+            service_name=target.service,
+            start_date=start_date_str,
+            end_date=end_date_str, limit=target.limit, operation=target.operation,
+            slice_minutes=fetch_config.get("slice_minutes", 60),
+            max_workers=fetch_config.get("max_workers", 8),
+            session=target_session,
+            archive=archive
+        ))
+        # Fetch, flatten and save today's data (daily backup) batch by batch; batches are compressed on a writer
+        # thread while the next ones are fetched
+        span_batches = metrics.iterate(
+            "flatten",
+            iter_span_batches(traces, batch_size=fetch_config.get("batch_size", 50_000)),
+            rows=lambda batch: batch.num_rows
+        )
+        if detector is not None:
+            span_batches = metrics.iterate("score", detector.observe(span_batches), rows=lambda batch: batch.num_rows)
+        if feature_store is not None:
+            span_batches = metrics.iterate("aggregate", feature_store.observe(span_batches),
+                                           rows=lambda batch: batch.num_rows)
+        with metrics.stage("write") as record:
+            record.rows_in = record.rows_out = spans_written = write_span_batches_parquet(
+                span_batches, daily_parquet_filename, writer_config
+            )
+            record.bytes = os.path.getsize(daily_parquet_filename)
+        catalog.record(daily_parquet_filename, "daily", source_query)
+        logging.info(f"{spans_written} spans of {target.name} written to {daily_parquet_filename}.")
+        if writer_config.export_csv:
+            with metrics.stage("export_csv", rows_in=spans_written) as record:
+                record.rows_out = export_parquet_to_csv(daily_parquet_filename, daily_csv_filename, writer_config)
+                record.bytes = os.path.getsize(daily_csv_filename)
+            catalog.record(daily_csv_filename, "daily", source_query)
+
+        # Append today's spans to the target's partitioned dataset; existing partitions are left untouched
+        with metrics.stage("merge", rows_in=spans_written) as record:
+            record.rows_out = sum(append_spans(daily_parquet_filename, dataset_dir, writer_config,
+                                               catalog=catalog, source_query=source_query).values())
+        logging.info(f"Spans appended to {dataset_dir}.")
+
+        # The spans join the baselines only once they are stored
+        if detector is not None:
+            with metrics.stage("anomalies", rows_in=spans_written) as record:
+                record.rows_out = detector.commit()
+            logging.info(f"{record.rows_out} spans of {target.name} flagged as latency anomalies.")
+        if feature_store is not None:
+            with metrics.stage("features", rows_in=spans_written) as record:
+                record.rows_out = feature_store.commit()
+    return spans_written
+
+
+def collect(archive: RawArchive | None, catalog: DataCatalog) -> None:
+    """Fetch the last day of traces of every target, then move the daily files of the previous run to a backup folder."""
+    # Daily files the catalog does not know yet, e.g. written before it existed, are recorded; known ones are skipped
+    catalog.prune(sorted(data_dir.glob("daily_*.csv")) + sorted(data_dir.glob("daily_*.parquet")), "daily")
+    # The daily files of the previous run are moved to the backup folder once this run is done
+    previous_daily_files = [entry.path for entry in catalog.files("daily")]
+
+    # All targets share one connection pool and one request rate limit
+    session = make_session(
+        pool_size=fetch_config.get("max_workers", 8) * len(targets),
+        max_retries=fetch_config.get("max_retries", 3),
+        backoff_factor=fetch_config.get("backoff_factor", 0.5),
+        username=username,
+        password=password,
+        max_requests_per_second=fetch_config.get("max_requests_per_second")
+    )
+    with session:
+        # One-time migrations into the dataset of the target collected before targets were configurable:
+        # the legacy cumulative file, then the single-target dataset written directly under data/spans
+        default_dataset_dir = DEFAULT_TARGET.dataset_dir(spans_dir)
+        if full_parquet_filename.exists() and read_dataset_schema(default_dataset_dir) is None \
+                and read_dataset_schema(spans_dir) is None:
+            logging.info(f"Importing {full_parquet_filename} into {default_dataset_dir}.")
+            with StageMetrics.from_config("traces", config, parent_path) as metrics:
+                with metrics.stage("import_legacy") as record:
+                    record.rows_out = sum(import_legacy_spans(full_parquet_filename, default_dataset_dir,
+                                                              writer_config).values())
+        move_dataset(spans_dir, default_dataset_dir)
+        # Partitions written before IDs were stored as integers are converted before new spans are appended
+        for target in targets:
+            compact_dataset_files(target.dataset_dir(spans_dir), writer_config)
+
+        # Targets are collected concurrently; the shared rate limit keeps the total load on Jaeger bounded
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            spans_written = executor.map(lambda target: collect_target(target, session, archive, catalog), targets)
+            spans_per_target = dict(zip((target.name for target in targets), spans_written))
+        logging.info(f"Traces fetched successfully: {spans_per_target}. Performing backup...")
+
+    backup_dir.mkdir(parents=True, exist_ok=True)
+
+    for daily_file in previous_daily_files:
+        if not daily_file.exists():
+            logging.warning(f"{daily_file} is in the data catalog but no longer exists.")
+            catalog.remove(daily_file)
+            continue
+        shutil.move(daily_file, backup_dir / daily_file.name)
+        catalog.move(daily_file, backup_dir / daily_file.name, kind="backup")
+
+    logging.info("Backup completed successfully.")
+
+
+def day_to_us(day: str) -> int:
+    """Convert a "YYYY-MM-DD" UTC date to a Unix timestamp in microseconds."""
+    return int(datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1_000_000)
+
+
+def replay(archive: RawArchive, output_dir: Path, start_day: str | None, end_day: str | None,
+           max_workers: int | None) -> None:
+    """Rebuild the span dataset of every target from the raw response archive into `<output_dir>/spans/<target>`."""
+    for target in targets:
+        replay_traces(
+            archive, target, target.dataset_dir(output_dir / "spans"),
+            start_us=day_to_us(start_day) if start_day else None,
+            end_us=day_to_us(end_day) + 86_400_000_000 if end_day else None,
+            max_workers=max_workers,
+            batch_size=fetch_config.get("batch_size", 50_000),
+        )
+    logging.info(f"Span datasets replayed into {output_dir / 'spans'}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch the last day of Jaeger traces into the span datasets.")
+    parser.add_argument("--replay", action="store_true",
+                        help="rebuild the span datasets from the raw response archive instead of querying Jaeger")
+    parser.add_argument("--start", default=None, help="first day to replay, YYYY-MM-DD (UTC); defaults to the whole archive")
+    parser.add_argument("--end", default=None, help="last day to replay, YYYY-MM-DD (UTC), inclusive")
+    parser.add_argument("--output", type=Path, default=parent_path / "replay",
+                        help="directory of the replayed datasets")
+    parser.add_argument("--workers", type=int, default=None, help="replay worker processes; defaults to one per CPU")
+    args = parser.parse_args()
+
+    logging.info("Script started.")
+    # Every raw Jaeger response is saved, so the datasets can be rebuilt later with --replay
+    raw_archive = RawArchive.from_config(config, parent_path)
+    if args.replay:
+        if raw_archive is None:
+            raise SystemExit("The raw response archive is disabled (archive.dir is null), nothing to replay.")
+        with raw_archive:
+            replay(raw_archive, args.output, args.start, args.end, args.workers)
+    else:
+        with DataCatalog.from_config(config, parent_path) as catalog:
+            collect(raw_archive, catalog)
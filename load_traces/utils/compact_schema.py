@@ -0,0 +1,221 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# 64-bit span IDs, stored as uint64 under their own name
+SPAN_ID_COLUMNS = ('spanID', 'parentSpanID', 'span_id')
+# 128-bit trace IDs, stored as a pair of uint64 columns <name>_high and <name>_low
+TRACE_ID_COLUMNS = ('traceID', 'trace_id')
+# Strings that take few distinct values, always stored as Arrow dictionaries (pandas categoricals)
+DICTIONARY_COLUMNS = ('operationName', 'serviceName', 'level')
+DICTIONARY_TYPE = pa.dictionary(pa.int32(), pa.string())
+# Other string columns are dictionary-encoded on read when at most this share of their values is distinct
+DICTIONARY_THRESHOLD = 0.5
+
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+_HEX_VALUES[_HEX_DIGITS] = np.arange(16)
+_HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+
+def trace_id_columns(name: str = 'traceID') -> tuple[str, str]:
+    """Return the names of the high and low halves of a trace ID column."""
+    return f"{name}_high", f"{name}_low"
+
+
+def storage_columns(columns: list[str]) -> list[str]:
+    """Return the stored columns to read for the requested ones: a trace ID column is also read as its two halves."""
+    stored = []
+    for name in columns:
+        stored.append(name)
+        if name in TRACE_ID_COLUMNS:
+            stored.extend(trace_id_columns(name))
+    return list(dict.fromkeys(stored))
+
+
+def is_compact(schema: pa.Schema) -> bool:
+    """Return True if no ID column of `schema` is still stored as a hex string."""
+    return not any(name in schema.names for name in TRACE_ID_COLUMNS) and all(
+        pa.types.is_uint64(schema.field(name).type) for name in SPAN_ID_COLUMNS if name in schema.names
+    )
+
+
+def _hex_to_words(strings: pa.Array, words: int) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Parse hex strings of up to 16 * `words` digits into big-endian uint64 words.
+
+    Returns:
+        tuple[list[np.ndarray], np.ndarray]: The words, most significant first, and the mask of valid rows.
+            Null, empty, too long or non-hex strings are invalid and parse to 0.
+    """
+    width = 16 * words
+    if len(strings) == 0:
+        return [np.zeros(0, dtype=np.uint64) for _ in range(words)], np.zeros(0, dtype=bool)
+    strings = strings.cast(pa.string())
+    lengths = pc.fill_null(pc.utf8_length(strings), 0)
+    valid = pc.and_(pc.greater(lengths, 0), pc.less_equal(lengths, width))
+    padded = pc.utf8_lpad(pc.if_else(valid, strings, ''), width=width, padding='0')
+    padded = pc.if_else(valid, padded, '0' * width)
+    if isinstance(padded, pa.ChunkedArray):
+        padded = padded.combine_chunks()
+    offsets = np.frombuffer(padded.buffers()[1], dtype=np.int32)[padded.offset:padded.offset + len(padded) + 1]
+    data = np.frombuffer(padded.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]].reshape(len(padded), width)
+    nibbles = _HEX_VALUES[data]
+    valid = np.asarray(valid) & (nibbles != 255).all(axis=1)
+    nibbles = np.where(valid[:, None], nibbles, 0).astype(np.uint64)
+    result = []
+    for word in range(words):
+        value = np.zeros(len(padded), dtype=np.uint64)
+        for digit in range(16 * word, 16 * word + 16):
+            value = (value << np.uint64(4)) | nibbles[:, digit]
+        result.append(value)
+    return result, valid
+
+
+def _words_to_hex(words: list[np.ndarray]) -> np.ndarray:
+    """Format big-endian uint64 words as rows of 16 * len(words) lowercase hex digits (a 2-D uint8 array)."""
+    digits = []
+    for value in words:
+        for shift in range(60, -4, -4):
+            digits.append(_HEX_DIGITS[((value >> np.uint64(shift)) & np.uint64(15)).astype(np.intp)])
+    return np.stack(digits, axis=1) if digits else np.empty((0, 0), dtype=np.uint8)
+
+
+def _hex_array(digits: np.ndarray, valid: np.ndarray) -> pa.Array:
+    """Build a string array from rows of hex digits, with nulls where `valid` is False."""
+    count, width = digits.shape
+    offsets = pa.py_buffer((np.arange(count + 1, dtype=np.int32) * width).tobytes())
+    validity = pa.array(valid).buffers()[1] if not valid.all() else None
+    return pa.Array.from_buffers(pa.string(), count, [validity, offsets, pa.py_buffer(digits.tobytes())],
+                                 null_count=int(count - valid.sum()))
+
+
+def _to_numpy(array: pa.Array | pa.ChunkedArray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the values of a uint64 array as numpy, with nulls as 0, and the mask of valid rows."""
+    valid = np.asarray(pc.is_valid(array))
+    return np.asarray(pc.fill_null(array, 0)).astype(np.uint64), valid
+
+
+def encode_span_ids(ids: pa.Array | pa.ChunkedArray) -> pa.Array:
+    """Convert hex span IDs to uint64; IDs that are not 64-bit hex become null. uint64 input is returned as is."""
+    if pa.types.is_uint64(ids.type):
+        return ids
+    (values,), valid = _hex_to_words(ids, 1)
+    invalid = len(ids) - ids.null_count - int(valid.sum())
+    if invalid:
+        logging.warning(f"{invalid} span IDs are not 64-bit hex values and were dropped.")
+    return pa.array(values, type=pa.uint64(), mask=~valid)
+
+
+def decode_span_ids(ids: pa.Array | pa.ChunkedArray) -> pa.Array:
+    """Format uint64 span IDs as 16-digit lowercase hex strings, as Jaeger does."""
+    values, valid = _to_numpy(ids)
+    return _hex_array(_words_to_hex([values]), valid)
+
+
+def encode_trace_ids(ids: pa.Array | pa.ChunkedArray) -> tuple[pa.Array, pa.Array]:
+    """Convert hex trace IDs of up to 128 bits to a (high, low) pair of uint64 arrays; invalid IDs become null."""
+    (high, low), valid = _hex_to_words(ids, 2)
+    invalid = len(ids) - ids.null_count - int(valid.sum())
+    if invalid:
+        logging.warning(f"{invalid} trace IDs are not 128-bit hex values and were dropped.")
+    return pa.array(high, type=pa.uint64(), mask=~valid), pa.array(low, type=pa.uint64(), mask=~valid)
+
+
+def decode_trace_ids(high: pa.Array | pa.ChunkedArray, low: pa.Array | pa.ChunkedArray) -> pa.Array:
+    """Format (high, low) trace ID pairs as hex strings, as Jaeger does: 16 digits when the high half is 0, else 32."""
+    high_values, valid = _to_numpy(high)
+    low_values, _ = _to_numpy(low)
+    full = _hex_array(_words_to_hex([high_values, low_values]), valid)
+    return pc.if_else(pa.array(high_values == 0), pc.utf8_slice_codeunits(full, start=16), full)
+
+
+def trace_id_keys(high: pa.Array | pa.ChunkedArray, low: pa.Array | pa.ChunkedArray) -> pa.Array:
+    """Pack (high, low) trace ID pairs into 16-byte binary keys, for hashing, set membership and joins in Arrow."""
+    high_values, valid = _to_numpy(high)
+    low_values, _ = _to_numpy(low)
+    packed = np.stack([high_values, low_values], axis=1).astype('>u8')
+    validity = pa.array(valid).buffers()[1] if not valid.all() else None
+    return pa.Array.from_buffers(pa.binary(16), len(valid), [validity, pa.py_buffer(packed.tobytes())],
+                                 null_count=int(len(valid) - valid.sum()))
+
+
+def _is_dictionary_candidate(column: pa.ChunkedArray | pa.Array, threshold: float | None) -> bool:
+    if threshold is None or not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        return False
+    values = len(column) - column.null_count
+    return values > 0 and pc.count_distinct(column).as_py() <= threshold * values
+
+
+def compact_table(table: pa.Table | pa.RecordBatch, dictionary_threshold: float | None = DICTIONARY_THRESHOLD):
+    """
+    Convert the ID and low-cardinality string columns of a span or log table to their compact types.
+
+    Hex span IDs become uint64 and hex trace IDs a `<name>_high`/`<name>_low` pair of uint64 columns, in place of
+    the original column. The columns of `DICTIONARY_COLUMNS`, and any other string column with at most
+    `dictionary_threshold` distinct values per value (None to skip them), become dictionaries. Columns already
+    compact are left as they are, so the conversion can be applied to any input more than once.
+
+    Returns:
+        pa.Table | pa.RecordBatch: The compact table, of the same kind as `table`.
+    """
+    names, arrays = [], []
+    for name, column in zip(table.schema.names, table.columns):
+        if name in SPAN_ID_COLUMNS:
+            names.append(name)
+            arrays.append(encode_span_ids(column))
+        elif name in TRACE_ID_COLUMNS:
+            names.extend(trace_id_columns(name))
+            arrays.extend(encode_trace_ids(column))
+        elif name in DICTIONARY_COLUMNS and not column.type.equals(DICTIONARY_TYPE):
+            names.append(name)
+            arrays.append(column.cast(pa.string()).cast(DICTIONARY_TYPE))
+        elif _is_dictionary_candidate(column, dictionary_threshold):
+            names.append(name)
+            arrays.append(column.cast(pa.string()).cast(DICTIONARY_TYPE))
+        else:
+            names.append(name)
+            arrays.append(column)
+    if isinstance(table, pa.RecordBatch):
+        arrays = [array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array for array in arrays]
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def expand_table(table: pa.Table | pa.RecordBatch):
+    """
+    Convert a compact table back to hex ID strings and plain strings, e.g. for CSV export.
+
+    Returns:
+        pa.Table | pa.RecordBatch: The expanded table, of the same kind as `table`.
+    """
+    schema_names = table.schema.names
+    names, arrays = [], []
+    for name, column in zip(schema_names, table.columns):
+        base = name.rsplit('_', 1)[0]
+        if name in SPAN_ID_COLUMNS and pa.types.is_uint64(column.type):
+            names.append(name)
+            arrays.append(decode_span_ids(column))
+        elif base in TRACE_ID_COLUMNS and name == trace_id_columns(base)[0]:
+            names.append(base)
+            arrays.append(decode_trace_ids(column, table.column(trace_id_columns(base)[1])))
+        elif base in TRACE_ID_COLUMNS and name == trace_id_columns(base)[1]:
+            continue
+        elif pa.types.is_dictionary(column.type):
+            names.append(name)
+            arrays.append(column.cast(column.type.value_type))
+        else:
+            names.append(name)
+            arrays.append(column)
+    if isinstance(table, pa.RecordBatch):
+        arrays = [array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array for array in arrays]
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Convert a compact table to pandas: IDs as nullable UInt64 (nulls would turn plain uint64 into float) and dictionaries as categoricals."""
+    return table.to_pandas(types_mapper={pa.uint64(): pd.UInt64Dtype()}.get)
@@ -1,51 +1,53 @@
-from typing import Any
-
-
-def convert_tag_value(value, type_hint) -> Any:
+import logging
+
+import pyarrow as pa
+
+# Arrow types of Jaeger's declared tag types, plus the aliases boolean, int, integer, float, double and str.
+# Binary tags are kept as the base64 text Jaeger's JSON API returns for them.
+TAG_TYPES: dict[str, pa.DataType] = {
+    'bool': pa.bool_(),
+    'boolean': pa.bool_(),
+    'int64': pa.int64(),
+    'int': pa.int64(),
+    'integer': pa.int64(),
+    'float64': pa.float64(),
+    'float': pa.float64(),
+    'double': pa.float64(),
+    'string': pa.string(),
+    'str': pa.string(),
+    'binary': pa.string(),
+}
+
+
+def convert_tag_column(values: list, type_hint: str | None) -> pa.Array:
     """
-    Convert tag value based on the type hint or inferred data type.
+    Convert all values of one tag key to a typed, nullable Arrow array in a single cast.
 
-    This function takes a value and a type hint as input. It then converts the value to the type specified by the type hint.
-    If the type hint is not recognized, the function attempts to infer the type from the value itself.
-    If the type cannot be inferred, the original value is returned.
+    The values are loaded into Arrow as they come from the Jaeger JSON (native bools and numbers, or strings)
+    and cast once to the Arrow type of the declared Jaeger type. Unknown type hints, mixed declared types
+    (passed as None) and values that cannot be cast give a string column.
 
     Args:
-        value (Any): The value to be converted.
-        type_hint (str): A string hinting at the type to which the value should be converted.
+        values (list): The raw tag values; None for missing values.
+        type_hint (str | None): The declared Jaeger type ('bool', 'int64', 'float64', 'string' or 'binary'),
+            or one of the aliases of `TAG_TYPES`.
 
     Returns:
-        Any: The converted value, or the original value if the type could not be inferred or converted.
+        pa.Array: The converted column.
 
     Examples:
-        >>> convert_tag_value('true', 'bool')
-        True
-        >>> convert_tag_value('123', 'int')
-        123
-        >>> convert_tag_value('123.456', 'float')
-        123.456
-        >>> convert_tag_value('yes', 'str')
-        'yes'
+        >>> convert_tag_column([True, None, False], 'bool').to_pylist()
+        [True, None, False]
+        >>> convert_tag_column(['1', '2'], 'int64').to_pylist()
+        [1, 2]
     """
-
-    # Convert the value to a boolean if the type hint is 'bool' or 'boolean'
-    if type_hint in ['bool', 'boolean']:
-        return bool(value)
-
-    # Convert the value to a string if the type hint is 'string' or 'str'
-    if type_hint in ['string', 'str']:
-        return str(value)
-
-    # Convert the value to an integer if the type hint is 'int' or 'integer'
-    if type_hint in ['int', 'integer']:
-        return int(value)
-
-    # Convert the value to a float if the type hint is 'float' or 'double'
-    if type_hint in ['float', 'double']:
-        return float(value)
-
-    # If the value is a string, check if it represents a boolean value
-    if isinstance(value, str):
-        return value.lower() in ['true', '1', 't', 'y', 'yes']
-
-    # Return the original value if type is unknown or not specified
-    return value
+    target = TAG_TYPES.get(type_hint, pa.string())
+    try:
+        return pa.array(values).cast(target)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        pass
+    try:
+        return pa.array(values, type=pa.string()).cast(target)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        logging.warning(f"Tag values of type {type_hint} could not be converted, keeping them as strings.")
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
@@ -1,6 +1,18 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import aiohttp
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+from archive.raw_archive import JAEGER, RawArchive
 from load_traces.utils.date_utils import date_to_timestamp_microseconds
 
 
@@ -62,3 +74,386 @@ def fetch_jaeger_traces(
     assert response.json().get('data'), f"No traces found for service: {service_name}"
 
     return response.json()
+
+
+class RateLimiter:
+    """Space requests at least 1 / `max_per_second` seconds apart, across all the threads and tasks sharing it."""
+
+    def __init__(self, max_per_second: float):
+        self.interval = 1 / max_per_second
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Reserve the next free slot and return how long to wait for it, in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+            return slot - now
+
+    def acquire(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """An HTTP adapter that waits for a shared rate limiter before sending each request."""
+
+    def __init__(self, rate_limiter: RateLimiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def make_session(
+        pool_size: int = 8,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        username: str | None = None,
+        password: str | None = None,
+        max_requests_per_second: float | None = None
+) -> requests.Session:
+    """
+    Create a pooled HTTP session with retry and exponential backoff.
+
+    Args:
+        pool_size (int, optional): The number of connections kept per host. Defaults to 8.
+        max_retries (int, optional): The number of retries for failed requests. Defaults to 3.
+        backoff_factor (float, optional): The backoff factor between retries, in seconds. Defaults to 0.5.
+        username (str, optional): The username for basic HTTP authentication. Defaults to None.
+        password (str, optional): The password for basic HTTP authentication. Defaults to None.
+        max_requests_per_second (float, optional): The request rate cap of all users of the session. Defaults to None, no cap.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    if max_requests_per_second:
+        adapter = RateLimitedAdapter(RateLimiter(max_requests_per_second), pool_connections=pool_size,
+                                     pool_maxsize=pool_size, max_retries=retry)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if username and password:
+        session.auth = HTTPBasicAuth(username, password)
+    return session
+
+
+def share_session(session: requests.Session) -> requests.Session:
+    """
+    Create a session that shares the connection pools, rate limit and auth of `session` but has its own hooks.
+
+    Closing either session closes the shared pools, so only the original session should be closed.
+    """
+    shared = requests.Session()
+    for prefix, adapter in session.adapters.items():
+        shared.mount(prefix, adapter)
+    shared.auth = session.auth
+    return shared
+
+
+def _fetch_slice(
+        session: requests.Session,
+        server: str,
+        service_name: str,
+        start_us: int,
+        end_us: int,
+        limit: int,
+        operation: str | None,
+        archive: RawArchive | None = None
+) -> list[dict]:
+    """Fetch the traces of a single [start_us, end_us) slice, archiving the raw response if an archive is given."""
+    params = {
+        "service": service_name,
+        "start": start_us,
+        "end": end_us,
+        "limit": limit,
+        "operation": operation
+    }
+    response = session.get(url=server, params=params)
+    response.raise_for_status()
+    if archive is not None:
+        archive.put(JAEGER, params, response.content)
+    return response.json().get('data') or []
+
+
+def iter_jaeger_traces_sliced(
+        server: str,
+        service_name: str,
+        start_date: str,
+        end_date: str,
+        limit: int = 1000,
+        operation: str | None = None,
+        username: str | None = None,
+        password: str | None = None,
+        slice_minutes: int = 60,
+        max_workers: int = 8,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        min_slice_seconds: int = 1,
+        session: requests.Session | None = None,
+        archive: RawArchive | None = None
+):
+    """
+    Fetch Jaeger traces for a date range by splitting it into concurrently fetched time slices.
+
+    The date range is cut into slices of `slice_minutes`, which are fetched in parallel over one pooled session.
+    Any slice that returns `limit` traces is assumed to be truncated and is split in half and fetched again,
+    until it fits or reaches `min_slice_seconds`. Traces are yielded as soon as their slice completes, so only
+    the responses of in-flight slices are held in memory. Traces returned by several slices are yielded once.
+
+    Args:
+        server (str): The URL of the Jaeger server.
+        service_name (str): The name of the service for which to fetch the traces.
+        start_date (str): The start date of the date range.
+        end_date (str): The end date of the date range.
+        limit (int, optional): The maximum number of traces to fetch per slice. Defaults to 1000.
+        operation (str, optional): The name of the operation for which to fetch the traces. Defaults to None.
+        username (str, optional): The username for basic HTTP authentication. Defaults to None.
+        password (str, optional): The password for basic HTTP authentication. Defaults to None.
+        slice_minutes (int, optional): The initial slice length in minutes. Defaults to 60.
+        max_workers (int, optional): The number of slices fetched concurrently. Defaults to 8.
+        max_retries (int, optional): The number of retries per request. Defaults to 3.
+        backoff_factor (float, optional): The backoff factor between retries, in seconds. Defaults to 0.5.
+        min_slice_seconds (int, optional): The shortest slice that is still split further. Defaults to 1.
+        session (requests.Session, optional): A session to reuse instead of creating a new one. Defaults to None.
+        archive (RawArchive, optional): The archive every raw response is saved to. Defaults to None.
+
+    Yields:
+        dict: Unique traces, one Jaeger trace object at a time.
+
+    Raises:
+        requests.exceptions.RequestException: If a slice still fails after all retries.
+    """
+    start_us = date_to_timestamp_microseconds(start_date)
+    end_us = date_to_timestamp_microseconds(end_date)
+    slice_us = slice_minutes * 60 * 1_000_000
+    min_slice_us = min_slice_seconds * 1_000_000
+
+    own_session = session is None
+    if own_session:
+        session = make_session(max_workers, max_retries, backoff_factor, username, password)
+
+    seen_trace_ids: set[str] = set()
+    truncated_slices = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            for slice_start in range(start_us, end_us, slice_us):
+                bounds = (slice_start, min(slice_start + slice_us, end_us))
+                future = executor.submit(_fetch_slice, session, server, service_name, *bounds, limit, operation,
+                                         archive)
+                pending[future] = bounds
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    slice_start, slice_end = pending.pop(future)
+                    traces = future.result()
+
+                    if len(traces) >= limit:
+                        if slice_end - slice_start > min_slice_us:
+                            middle = (slice_start + slice_end) // 2
+                            logging.debug(f"Slice {slice_start}-{slice_end} hit the limit, splitting at {middle}.")
+                            for bounds in ((slice_start, middle), (middle, slice_end)):
+                                child = executor.submit(
+                                    _fetch_slice, session, server, service_name, *bounds, limit, operation, archive
+                                )
+                                pending[child] = bounds
+                            continue
+                        truncated_slices += 1
+                        logging.warning(f"Slice {slice_start}-{slice_end} hit the limit of {limit} traces "
+                                        f"and cannot be split further, some traces may be missing.")
+
+                    for trace in traces:
+                        trace_id = trace.get('traceID')
+                        if trace_id not in seen_trace_ids:
+                            seen_trace_ids.add(trace_id)
+                            yield trace
+    finally:
+        if own_session:
+            session.close()
+
+    logging.info(f"Fetched {len(seen_trace_ids)} unique traces for {service_name} "
+                 f"({truncated_slices} truncated slices).")
+
+
+def fetch_jaeger_traces_sliced(*args, **kwargs):
+    """
+    Fetch Jaeger traces for a date range as concurrently fetched time slices.
+
+    Takes the same arguments as `iter_jaeger_traces_sliced` and collects its traces.
+
+    Returns:
+        dict: A Jaeger-shaped response, {'data': [trace, ...]}, with unique traces.
+    """
+    return {'data': list(iter_jaeger_traces_sliced(*args, **kwargs))}
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def make_async_session(
+        pool_size: int = 8,
+        username: str | None = None,
+        password: str | None = None,
+        timeout_seconds: float = 300,
+        max_requests_per_second: float | None = None
+) -> aiohttp.ClientSession:
+    """
+    Create a pooled asyncio HTTP session whose connections are kept alive between requests.
+
+    Must be called from a running event loop.
+
+    Args:
+        pool_size (int, optional): The number of connections kept open. Defaults to 8.
+        username (str, optional): The username for basic HTTP authentication. Defaults to None.
+        password (str, optional): The password for basic HTTP authentication. Defaults to None.
+        timeout_seconds (float, optional): The total timeout of one request. Defaults to 300.
+        max_requests_per_second (float, optional): The request rate cap of all users of the session, retries
+            included. Defaults to None, no cap.
+
+    Returns:
+        aiohttp.ClientSession: The configured session.
+    """
+    trace_configs = []
+    if max_requests_per_second:
+        rate_limiter = RateLimiter(max_requests_per_second)
+
+        async def wait_for_slot(session, context, params):
+            await rate_limiter.acquire_async()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(wait_for_slot)
+        trace_configs.append(trace_config)
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=600),
+        auth=aiohttp.BasicAuth(username, password) if username and password else None,
+        timeout=aiohttp.ClientTimeout(total=timeout_seconds),
+        trace_configs=trace_configs,
+    )
+
+
+async def get_json_async(
+        session: aiohttp.ClientSession,
+        url: str,
+        params: dict,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        on_body: Callable[[bytes], None] | None = None
+) -> dict:
+    """
+    GET a JSON document, retrying connection errors and 429/5xx responses with exponential backoff.
+
+    `on_body`, if given, is called with the raw body of the successful response, e.g. to archive it.
+
+    Raises:
+        aiohttp.ClientError: If the request still fails after all retries.
+    """
+    params = {key: str(value) for key, value in params.items() if value is not None}
+    for attempt in range(max_retries + 1):
+        try:
+            async with session.get(url, params=params) as response:
+                if response.status in RETRY_STATUSES and attempt < max_retries:
+                    logging.debug(f"{url} returned {response.status}, retrying.")
+                else:
+                    response.raise_for_status()
+                    body = await response.read()
+                    if on_body is not None:
+                        on_body(body)
+                    return json.loads(body)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == max_retries:
+                raise
+            logging.debug(f"{url} failed ({e!r}), retrying.")
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+
+async def iter_jaeger_traces_sliced_async(
+        session: aiohttp.ClientSession,
+        server: str,
+        service_name: str,
+        start_us: int,
+        end_us: int,
+        limit: int = 1000,
+        operation: str | None = None,
+        slice_minutes: int = 60,
+        max_workers: int = 8,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        min_slice_seconds: int = 1,
+        archive: RawArchive | None = None
+) -> AsyncIterator[list[dict]]:
+    """
+    Fetch the Jaeger traces of [start_us, end_us) as concurrently fetched time slices, on an event loop.
+
+    The asyncio counterpart of `iter_jaeger_traces_sliced`: slices that return `limit` traces are split in
+    half and fetched again, and traces returned by several slices are yielded once. The traces of each
+    slice are yielded as one list as soon as the slice completes. Every raw response is saved to `archive`, if given.
+
+    Yields:
+        list[dict]: The new unique traces of one completed slice.
+    """
+    slice_us = slice_minutes * 60 * 1_000_000
+    min_slice_us = min_slice_seconds * 1_000_000
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def fetch_slice(slice_start: int, slice_end: int) -> list[dict]:
+        params = {"service": service_name, "start": slice_start, "end": slice_end,
+                  "limit": limit, "operation": operation}
+        on_body = None if archive is None else lambda body: archive.put(JAEGER, params, body)
+        async with semaphore:
+            response = await get_json_async(session, server, params, max_retries, backoff_factor, on_body)
+        return response.get('data') or []
+
+    pending = {}
+    for slice_start in range(start_us, end_us, slice_us):
+        bounds = (slice_start, min(slice_start + slice_us, end_us))
+        pending[asyncio.ensure_future(fetch_slice(*bounds))] = bounds
+    seen_trace_ids: set[str] = set()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                slice_start, slice_end = pending.pop(task)
+                traces = task.result()
+                if len(traces) >= limit:
+                    if slice_end - slice_start > min_slice_us:
+                        middle = (slice_start + slice_end) // 2
+                        logging.debug(f"Slice {slice_start}-{slice_end} hit the limit, splitting at {middle}.")
+                        for bounds in ((slice_start, middle), (middle, slice_end)):
+                            pending[asyncio.ensure_future(fetch_slice(*bounds))] = bounds
+                        continue
+                    logging.warning(f"Slice {slice_start}-{slice_end} hit the limit of {limit} traces "
+                                    f"and cannot be split further, some traces may be missing.")
+
+                new_traces = []
+                for trace in traces:
+                    trace_id = trace.get('traceID')
+                    if trace_id not in seen_trace_ids:
+                        seen_trace_ids.add(trace_id)
+                        new_traces.append(trace)
+                if new_traces:
+                    yield new_traces
+    finally:
+        for task in pending:
+            task.cancel()
+
+    logging.info(f"Fetched {len(seen_trace_ids)} unique traces for {service_name}.")
@@ -0,0 +1,236 @@
+import logging
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from load_traces.utils.compact_schema import DICTIONARY_TYPE, encode_span_ids, encode_trace_ids
+from load_traces.utils.convert_tag_value import convert_tag_column
+from load_traces.utils.table_writer import TableWriter, WriterConfig, write_batches, write_table
+from load_traces.utils.trace_tree import STRUCTURE_SCHEMA, add_trace_structure
+
+# Columns every span row has, in output order, with their Arrow types: IDs as integers (the 128-bit trace ID as
+# two halves) and the low-cardinality names as dictionaries, see load_traces.utils.compact_schema. The parent is
+# the span of the first CHILD_OF reference, or of the first reference if there is none; the structure columns
+# of load_traces.utils.trace_tree follow.
+SPAN_SCHEMA = pa.schema([
+    ('spanID', pa.uint64()),
+    ('traceID_high', pa.uint64()),
+    ('traceID_low', pa.uint64()),
+    ('parentSpanID', pa.uint64()),
+    ('refType', DICTIONARY_TYPE),
+    ('operationName', DICTIONARY_TYPE),
+    ('serviceName', DICTIONARY_TYPE),
+    ('processID', DICTIONARY_TYPE),
+    ('startTime', pa.timestamp('us')),
+    ('duration', pa.int64()),
+    *STRUCTURE_SCHEMA,
+])
+# The columns read from each span; the others are derived when the batch is built
+_SPAN_FIELDS = ('spanID', 'traceID', 'parentSpanID', 'refType', 'operationName', 'serviceName', 'processID',
+                'startTime', 'duration')
+
+
+def _scatter(column: pa.Array, rows: list[int], num_rows: int) -> pa.Array:
+    """Spread the values of `column`, which belong to the given row positions, over `num_rows` rows with nulls."""
+    if len(rows) == num_rows:
+        return column
+    indices = np.full(num_rows, len(column), dtype=np.int64)
+    indices[rows] = np.arange(len(column))
+    return pa.concat_arrays([column, pa.nulls(1, type=column.type)]).take(pa.array(indices))
+
+
+class _SpanBatchBuilder:
+    """Accumulates spans column by column and converts each tag column once per batch."""
+
+    def __init__(self):
+        self.num_rows = 0
+        self.columns: dict[str, list] = {name: [] for name in _SPAN_FIELDS}
+        # tag column -> (declared type, row positions, raw values); the type is None if it is not consistent
+        self.tags: dict[str, list] = {}
+
+    def add_trace(self, trace: dict) -> None:
+        processes = trace.get('processes', {})
+        columns = self.columns
+        for span in trace.get('spans', []):
+            process = span.get('process') or processes.get(span.get('processID'), {})
+            references = span.get('references')
+            parent = next((ref for ref in references if ref.get('refType') == 'CHILD_OF'), references[0]) \
+                if references else {}
+            columns['spanID'].append(span.get('spanID'))
+            columns['traceID'].append(span.get('traceID'))
+            columns['parentSpanID'].append(parent.get('spanID'))
+            columns['refType'].append(parent.get('refType'))
+            columns['operationName'].append(span.get('operationName'))
+            columns['serviceName'].append(process.get('serviceName'))
+            columns['processID'].append(span.get('processID'))
+            columns['startTime'].append(span.get('startTime'))
+            columns['duration'].append(span.get('duration'))
+            for tag in span.get('tags', []):
+                name = 'tag_' + tag.get('key')
+                tag_type = tag.get('type', 'string')
+                entry = self.tags.get(name)
+                if entry is None:
+                    entry = self.tags[name] = [tag_type, [], []]
+                elif entry[0] != tag_type:
+                    entry[0] = None
+                if entry[1] and entry[1][-1] == self.num_rows:
+                    # A key repeated within a span keeps its last value, so every row has at most one
+                    entry[2][-1] = tag.get('value')
+                    continue
+                entry[1].append(self.num_rows)
+                entry[2].append(tag.get('value'))
+            self.num_rows += 1
+
+    def build(self) -> pa.RecordBatch:
+        columns = self.columns
+        arrays = [
+            encode_span_ids(pa.array(columns['spanID'], type=pa.string())),
+            *encode_trace_ids(pa.array(columns['traceID'], type=pa.string())),
+            encode_span_ids(pa.array(columns['parentSpanID'], type=pa.string())),
+            *(pa.array(columns[name], type=pa.string()).dictionary_encode()
+              for name in ('refType', 'operationName', 'serviceName', 'processID')),
+            pa.array(columns['startTime'], type=SPAN_SCHEMA.field('startTime').type),
+            pa.array(columns['duration'], type=SPAN_SCHEMA.field('duration').type),
+        ]
+        names = [name for name in SPAN_SCHEMA.names if name not in STRUCTURE_SCHEMA.names]
+        batch = add_trace_structure(pa.RecordBatch.from_arrays(arrays, names=names))
+        arrays, names = batch.columns, batch.schema.names
+        for name, (tag_type, rows, values) in self.tags.items():
+            arrays.append(_scatter(convert_tag_column(values, tag_type), rows, self.num_rows))
+            names.append(name)
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def iter_span_batches(traces: Iterable[dict], batch_size: int = 50_000) -> Iterator[pa.RecordBatch]:
+    """
+    Flatten Jaeger traces into Arrow record batches of about `batch_size` spans.
+
+    Each batch holds the base span columns of `SPAN_SCHEMA` plus one `tag_<key>` column per tag key, in order of
+    first appearance. Span and trace IDs are parsed from hex into integers once per batch. Tag values are gathered
+    per key and converted to the declared Jaeger type with one Arrow cast per column. Traces are never split, so a
+    batch can exceed `batch_size` by the spans of one trace, and the span trees of the whole batch are rebuilt at
+    once into the depth, self-time and critical-path columns (see `add_trace_structure`).
+
+    Args:
+        traces (Iterable[dict]): Jaeger trace objects; may be a generator, it is consumed lazily.
+        batch_size (int, optional): The number of spans per batch. Defaults to 50000.
+
+    Yields:
+        pa.RecordBatch: The flattened spans.
+    """
+    builder = _SpanBatchBuilder()
+    for trace in traces:
+        builder.add_trace(trace)
+        if builder.num_rows >= batch_size:
+            yield builder.build()
+            builder = _SpanBatchBuilder()
+    if builder.num_rows:
+        yield builder.build()
+
+
+def unify_schemas(schemas: Iterable[pa.Schema]) -> pa.Schema:
+    """
+    Merge schemas field by field, keeping the order of first appearance.
+
+    Null-typed fields take the type seen elsewhere, integer and float fields are widened to float64,
+    timestamps of different units become microsecond timestamps, dictionary and string fields become dictionaries,
+    and any other type conflict falls back to string.
+    """
+    fields: dict[str, pa.DataType] = {}
+    for schema in schemas:
+        for field in schema:
+            known = fields.get(field.name)
+            if known is None or pa.types.is_null(known):
+                fields[field.name] = field.type
+            elif pa.types.is_null(field.type) or known.equals(field.type):
+                continue
+            elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (known, field.type)):
+                fields[field.name] = pa.float64()
+            elif pa.types.is_timestamp(known) and pa.types.is_timestamp(field.type):
+                fields[field.name] = pa.timestamp('us')
+            elif any(pa.types.is_dictionary(t) for t in (known, field.type)) \
+                    and all(pa.types.is_dictionary(t) or pa.types.is_string(t) for t in (known, field.type)):
+                fields[field.name] = DICTIONARY_TYPE
+            else:
+                fields[field.name] = pa.string()
+    return pa.schema([pa.field(name, type_) for name, type_ in fields.items()])
+
+
+def conform_batch(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    """Reorder and cast a record batch to `schema`, filling missing columns with nulls."""
+    arrays = []
+    for field in schema:
+        index = batch.schema.get_field_index(field.name)
+        if index == -1:
+            arrays.append(pa.nulls(batch.num_rows, type=field.type))
+        else:
+            arrays.append(batch.column(index).cast(field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_span_batches_parquet(
+        batches: Iterable[pa.RecordBatch],
+        path: Path | str,
+        config: WriterConfig | None = None
+) -> int:
+    """
+    Stream record batches into a single Parquet file through a `TableWriter`.
+
+    Batches with the same schema are appended to the open file, in row groups of `config.row_group_size`
+    rows, and with `config.background` they are compressed on a writer thread while the next batch is fetched.
+    When a batch brings new tag columns or new types, the current part is closed and a new one started.
+    If more than one part was written, the parts are merged into `path` under their unified schema, one row
+    group at a time, so memory use stays bounded by the row group size. `path` only appears once complete.
+
+    Args:
+        batches (Iterable[pa.RecordBatch]): The batches to write.
+        path (Path | str): The Parquet file to write.
+        config (WriterConfig, optional): The compression, row group size and threading. Defaults to WriterConfig().
+
+    Returns:
+        int: The number of rows written.
+    """
+    path = Path(path)
+    parts: list[Path] = []
+    writer = None
+    rows_written = 0
+    try:
+        for batch in batches:
+            if writer is None or not writer.schema.equals(batch.schema):
+                if writer is not None:
+                    writer.close()
+                parts.append(path.with_name(f"{path.name}.part-{len(parts):05d}"))
+                writer = TableWriter(parts[-1], batch.schema, config)
+            writer.write(batch)
+            rows_written += batch.num_rows
+        if writer is not None:
+            writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        for part in parts:
+            part.unlink(missing_ok=True)
+        raise
+
+    if not parts:
+        write_table(SPAN_SCHEMA.empty_table(), path, config)
+    elif len(parts) == 1:
+        parts[0].replace(path)
+    else:
+        logging.info(f"Span schema changed {len(parts) - 1} times, merging {len(parts)} parts into {path}.")
+        part_files = [pq.ParquetFile(part) for part in parts]
+        schema = unify_schemas(part_file.schema_arrow for part_file in part_files)
+        write_batches((conform_batch(batch, schema) for part_file in part_files for batch in part_file.iter_batches()),
+                      path, schema, config)
+        for part in parts:
+            part.unlink()
+    return rows_written
+
+
+def export_parquet_to_csv(parquet_path: Path | str, csv_path: Path | str, config: WriterConfig | None = None) -> int:
+    """Stream a Parquet file into a CSV file, one row group at a time, with IDs written back as hex strings."""
+    parquet_file = pq.ParquetFile(parquet_path)
+    return write_batches(parquet_file.iter_batches(), csv_path, parquet_file.schema_arrow, config, format='csv')
@@ -0,0 +1,227 @@
+import logging
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from catalog.data_catalog import DataCatalog
+from load_traces.utils.compact_schema import compact_table, is_compact, storage_columns, to_pandas
+from load_traces.utils.flatten_spans import conform_batch, unify_schemas
+from load_traces.utils.table_writer import TableWriter, WriterConfig, write_batches, write_table
+
+# Hive partition key of the span dataset: date=YYYY-MM-DD
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+SCHEMA_FILE = '_common_metadata'
+
+
+def read_dataset_schema(dataset_dir: Path | str) -> pa.Schema | None:
+    """Return the unified schema of the span dataset, or None if nothing was written yet."""
+    schema_path = Path(dataset_dir) / SCHEMA_FILE
+    if not schema_path.exists():
+        return None
+    return pq.read_schema(schema_path)
+
+
+def update_dataset_schema(dataset_dir: Path, schema: pa.Schema) -> pa.Schema:
+    """Merge `schema` into the stored dataset schema and write it back atomically."""
+    known = read_dataset_schema(dataset_dir)
+    unified = unify_schemas([known, schema]) if known is not None else schema
+    if known is None or not unified.equals(known):
+        tmp_path = dataset_dir / f"{SCHEMA_FILE}.tmp"
+        pq.write_metadata(unified, tmp_path)
+        tmp_path.replace(dataset_dir / SCHEMA_FILE)
+        logging.info(f"Dataset schema of {dataset_dir} updated, {len(unified)} columns.")
+    return unified
+
+
+def append_spans(parquet_path: Path | str, dataset_dir: Path | str, config: WriterConfig | None = None,
+                 catalog: DataCatalog | None = None, source_query: dict | None = None) -> dict[str, int]:
+    """
+    Append the spans of a Parquet file to the partitioned span dataset.
+
+    Rows are split by the UTC date of their `startTime` and written as a new
+    `date=YYYY-MM-DD/part-<run>.parquet` file per date; existing files are never rewritten.
+    The file is read one row group at a time, and each part is written by a `TableWriter`, which
+    buffers the rows into row groups of `config.row_group_size` and renames the part into place
+    when complete. The dataset-level schema in `_common_metadata` is then extended with any new
+    tag columns. Every new part is recorded in `catalog`, if given.
+
+    Args:
+        parquet_path (Path | str): The Parquet file holding the new spans.
+        dataset_dir (Path | str): The root directory of the partitioned dataset.
+        config (WriterConfig, optional): The compression, row group size and threading. Defaults to WriterConfig().
+        catalog (DataCatalog, optional): The data catalog to record the new parts in. Defaults to None.
+        source_query (dict, optional): The query the spans were fetched with, for the catalog. Defaults to None.
+
+    Returns:
+        dict[str, int]: The number of rows appended per partition date.
+    """
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    parquet_file = pq.ParquetFile(parquet_path)
+    schema = parquet_file.schema_arrow
+    part_name = f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+
+    writers: dict[str, TableWriter] = {}
+    try:
+        for batch in parquet_file.iter_batches():
+            dates = pc.strftime(batch.column('startTime'), format='%Y-%m-%d')
+            for date in pc.unique(dates).to_pylist():
+                mask = pc.is_null(dates) if date is None else pc.equal(dates, date)
+                date = date or 'unknown'
+                if date not in writers:
+                    partition_dir = dataset_dir / f"date={date}"
+                    partition_dir.mkdir(exist_ok=True)
+                    writers[date] = TableWriter(partition_dir / part_name, schema, config)
+                writers[date].write(batch.filter(mask))
+        for writer in writers.values():
+            writer.close()
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    rows_per_date = {date: writer.rows for date, writer in writers.items()}
+    if catalog is not None:
+        for writer in writers.values():
+            catalog.record(writer.path, 'spans', source_query)
+
+    update_dataset_schema(dataset_dir, schema)
+    logging.info(f"Appended {sum(rows_per_date.values())} spans to {dataset_dir} in {len(rows_per_date)} partitions.")
+    return rows_per_date
+
+
+def span_dataset(dataset_dir: Path | str) -> ds.Dataset:
+    """
+    Open the partitioned span dataset under its unified schema.
+
+    Files written before a tag column appeared read it as null; columns whose type changed are cast
+    to the unified type on scan.
+    """
+    dataset_dir = Path(dataset_dir)
+    schema = read_dataset_schema(dataset_dir)
+    if schema is not None:
+        schema = schema.append(pa.field('date', pa.string()))
+    return ds.dataset(dataset_dir, format='parquet', partitioning=PARTITIONING, schema=schema)
+
+
+def read_spans(
+        dataset_dir: Path | str,
+        start_date: str | None = None,
+        end_date: str | None = None,
+        columns: list[str] | None = None
+) -> pd.DataFrame:
+    """
+    Load spans from the partitioned dataset, reading only the partitions of the requested dates.
+
+    Args:
+        dataset_dir (Path | str): The root directory of the partitioned dataset.
+        start_date (str, optional): The first date to load, "YYYY-MM-DD", inclusive. Defaults to None.
+        end_date (str, optional): The last date to load, "YYYY-MM-DD", inclusive. Defaults to None.
+        columns (list[str], optional): The columns to load; "traceID" loads its two halves. Defaults to None, all columns.
+
+    Returns:
+        DataFrame: The spans of the requested date range, with IDs as UInt64 and dictionary columns as categoricals.
+    """
+    if not Path(dataset_dir).exists():
+        logging.warning(f"No span dataset found at {dataset_dir}.")
+        return pd.DataFrame()
+
+    date_filter = None
+    if start_date is not None:
+        date_filter = ds.field('date') >= start_date
+    if end_date is not None:
+        upper = ds.field('date') <= end_date
+        date_filter = upper if date_filter is None else date_filter & upper
+
+    dataset = span_dataset(dataset_dir)
+    if columns is not None:
+        columns = [name for name in storage_columns(columns) if name in dataset.schema.names]
+    return to_pandas(compact_table(dataset.to_table(columns=columns, filter=date_filter)))
+
+
+def import_legacy_spans(parquet_path: Path | str, dataset_dir: Path | str,
+                        config: WriterConfig | None = None) -> dict[str, int]:
+    """
+    Import a cumulative spans file (e.g. full_upload_spans.parquet) into the partitioned dataset.
+
+    The file may have been written by pandas with different column types and hex string IDs; its batches are
+    cast to the schema the flattener produces, compact IDs included, before being appended with `config`.
+    """
+    parquet_path = Path(parquet_path)
+    parquet_file = pq.ParquetFile(parquet_path)
+    schema = unify_schemas([parquet_file.schema_arrow, pa.schema([('startTime', pa.timestamp('us'))])])
+    compact_schema = compact_table(schema.empty_table(), dictionary_threshold=None).schema
+    tmp_path = parquet_path.with_name(f"{parquet_path.name}.import.tmp")
+    try:
+        batches = (compact_table(conform_batch(batch, schema), dictionary_threshold=None)
+                   for batch in parquet_file.iter_batches())
+        write_batches(batches, tmp_path, compact_schema, config)
+        return append_spans(tmp_path, dataset_dir, config)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def move_dataset(source_dir: Path | str, target_dir: Path | str) -> int:
+    """
+    Move the date partitions and the schema file of a dataset from `source_dir` into `target_dir`.
+
+    Used once to move the single-target span store, written directly under data/spans, into the partition
+    of its target. Partitions are renamed, not copied; a partition already present in `target_dir` is merged
+    file by file.
+
+    Returns:
+        int: The number of partitions moved.
+    """
+    source_dir, target_dir = Path(source_dir), Path(target_dir)
+    partitions = sorted(source_dir.glob('date=*'))
+    if not partitions:
+        return 0
+    target_dir.mkdir(parents=True, exist_ok=True)
+    for partition in partitions:
+        destination = target_dir / partition.name
+        if not destination.exists():
+            partition.rename(destination)
+            continue
+        for part in partition.iterdir():
+            part.rename(destination / part.name)
+        partition.rmdir()
+    schema = read_dataset_schema(source_dir)
+    if schema is not None:
+        update_dataset_schema(target_dir, schema)
+        (source_dir / SCHEMA_FILE).unlink()
+    logging.info(f"Moved {len(partitions)} span partitions from {source_dir} to {target_dir}.")
+    return len(partitions)
+
+
+def compact_dataset_files(dataset_dir: Path | str, config: WriterConfig | None = None) -> int:
+    """
+    Rewrite the files of a partitioned dataset that still store hex string IDs with the compact ID columns.
+
+    Each such file is converted with `compact_table` and written with `write_table` and `config`, under a
+    temporary name renamed over the original. The dataset schema in `_common_metadata` is then rebuilt from
+    the files, as the string ID columns it lists are gone. Datasets without such files are left untouched.
+
+    Returns:
+        int: The number of files rewritten.
+    """
+    dataset_dir = Path(dataset_dir)
+    files = sorted(dataset_dir.glob('date=*/*.parquet'))
+    rewritten = 0
+    for path in files:
+        if is_compact(pq.read_schema(path)):
+            continue
+        write_table(compact_table(pq.read_table(path), dictionary_threshold=None), path, config)
+        rewritten += 1
+    if rewritten:
+        schema = unify_schemas(pq.read_schema(path) for path in files)
+        tmp_path = dataset_dir / f"{SCHEMA_FILE}.tmp"
+        pq.write_metadata(schema, tmp_path)
+        tmp_path.replace(dataset_dir / SCHEMA_FILE)
+        logging.info(f"Rewrote {rewritten} files of {dataset_dir} with compact IDs.")
+    return rewritten
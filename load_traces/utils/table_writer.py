@@ -0,0 +1,207 @@
+import json
+import logging
+import queue
+import threading
+from collections.abc import Iterable
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from load_traces.utils.compact_schema import expand_table
+
+FORMATS = ('parquet', 'csv')
+# Rows per Parquet row group: large enough for zstd to find long matches and for the footer to stay small,
+# small enough that a reader of one row group (append_spans, the catalog, the enrichment) stays in memory
+DEFAULT_ROW_GROUP_SIZE = 262_144
+# Sentinel closing the queue of a background writer
+_CLOSE = object()
+# Schema metadata of a file written by `write_merged`: the names of the files it replaces
+MERGED_FROM = b'merged_from'
+
+
+@dataclass(frozen=True)
+class WriterConfig:
+    """How data files are written: the `writer` section of config.yml."""
+    compression: str = 'zstd'
+    compression_level: int | None = None
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE
+    # Serialize on a background thread, so the producer of the batches keeps running meanwhile
+    background: bool = True
+    # Batches queued for the background thread before `write` blocks
+    queue_size: int = 4
+    # Also write the daily spans as CSV next to the Parquet files
+    export_csv: bool = False
+
+    @classmethod
+    def from_config(cls, config: dict) -> "WriterConfig":
+        writer_config = config.get('writer') or {}
+        return cls(**{field.name: writer_config[field.name] for field in fields(cls) if field.name in writer_config})
+
+
+class TableWriter:
+    """
+    Write record batches into one Parquet or CSV file, which appears at `path` only once it is complete.
+
+    Batches are written under a temporary name in the same directory, which `close` renames over `path`; if
+    writing fails, the temporary file is removed and `path` is left as it was. Parquet files are compressed
+    with `config.compression` and batches are buffered into row groups of `config.row_group_size` rows. CSV
+    files get IDs as hex strings (see `expand_table`). With `config.background`, `write` only queues the batch
+    and a writer thread serializes it, so fetching and flattening the next batch overlaps with compressing the
+    last one; an error of the writer thread is raised by the next `write` or by `close`.
+
+    Raises:
+        ValueError: If `format` is not one of `FORMATS`.
+    """
+
+    def __init__(self, path: Path | str, schema: pa.Schema, config: WriterConfig | None = None,
+                 format: str | None = None):
+        self.path = Path(path)
+        self.config = config or WriterConfig()
+        self.format = format or ('csv' if self.path.suffix == '.csv' else 'parquet')
+        if self.format not in FORMATS:
+            raise ValueError(f"Unknown file format {self.format!r}, expected one of {', '.join(FORMATS)}")
+        self.tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self.rows = 0
+        self._pending: list[pa.RecordBatch] = []
+        self._pending_rows = 0
+        self._error: BaseException | None = None
+        if self.format == 'parquet':
+            self.schema = schema
+            self._writer = pq.ParquetWriter(self.tmp_path, schema, compression=self.config.compression,
+                                            compression_level=self.config.compression_level)
+        else:
+            self.schema = expand_table(schema.empty_table()).schema
+            self._writer = pa_csv.CSVWriter(self.tmp_path, self.schema)
+        self._queue = None
+        self._thread = None
+        if self.config.background:
+            self._queue = queue.Queue(maxsize=self.config.queue_size)
+            self._thread = threading.Thread(target=self._run, name=f"writer-{self.path.name}", daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _run(self) -> None:
+        # After an error the queue is still drained, so a producer blocked on a full queue is released
+        while (batch := self._queue.get()) is not _CLOSE:
+            if self._error is None:
+                try:
+                    self._write(batch)
+                except BaseException as error:
+                    self._error = error
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _write(self, batch: pa.RecordBatch | pa.Table) -> None:
+        if self.format == 'csv':
+            self._writer.write(expand_table(batch))
+            return
+        self._pending.extend(batch.to_batches() if isinstance(batch, pa.Table) else [batch])
+        self._pending_rows += batch.num_rows
+        if self._pending_rows >= self.config.row_group_size:
+            self._flush(final=False)
+
+    def _flush(self, final: bool) -> None:
+        """Write the buffered batches as full row groups, and the rest too if `final`."""
+        if not self._pending_rows:
+            return
+        table = pa.Table.from_batches(self._pending, schema=self.schema)
+        size = self.config.row_group_size
+        full_rows = table.num_rows if final else table.num_rows // size * size
+        self._writer.write_table(table.slice(0, full_rows), row_group_size=size)
+        rest = table.slice(full_rows)
+        self._pending, self._pending_rows = rest.to_batches(), rest.num_rows
+
+    def write(self, batch: pa.RecordBatch | pa.Table) -> None:
+        """Write a record batch or table of the writer's schema (before `expand_table` for CSV)."""
+        self._raise_error()
+        self.rows += batch.num_rows
+        if self._queue is None:
+            self._write(batch)
+        else:
+            self._queue.put(batch)
+
+    def _stop(self) -> None:
+        if self._thread is not None:
+            self._queue.put(_CLOSE)
+            self._thread.join()
+            self._thread = None
+
+    def close(self) -> Path:
+        """Write the remaining rows, close the file and rename it to `path`."""
+        try:
+            self._stop()
+            self._raise_error()
+            if self.format == 'parquet':
+                self._flush(final=True)
+            self._writer.close()
+        except BaseException:
+            self.abort()
+            raise
+        self.tmp_path.replace(self.path)
+        return self.path
+
+    def abort(self) -> None:
+        """Stop writing and remove the temporary file; `path` is left as it was."""
+        self._stop()
+        try:
+            self._writer.close()
+        except Exception as error:
+            logging.debug(f"Closing the aborted writer of {self.path} failed: {error}")
+        self.tmp_path.unlink(missing_ok=True)
+
+
+def write_table(table: pa.Table, path: Path | str, config: WriterConfig | None = None,
+                format: str | None = None) -> Path:
+    """Write a whole table to `path` atomically, on the calling thread."""
+    with TableWriter(path, table.schema, replace(config or WriterConfig(), background=False), format) as writer:
+        writer.write(table)
+    return writer.path
+
+
+def write_batches(batches: Iterable[pa.RecordBatch], path: Path | str, schema: pa.Schema,
+                  config: WriterConfig | None = None, format: str | None = None) -> int:
+    """Stream record batches of `schema` to `path` atomically; return the number of rows written."""
+    with TableWriter(path, schema, config, format) as writer:
+        for batch in batches:
+            writer.write(batch)
+    return writer.rows
+
+
+def live_files(paths: Iterable[Path]) -> list[Path]:
+    """Return the `paths` that no merged file among them replaces, and remove the replaced ones."""
+    paths = list(paths)
+    replaced = set()
+    for path in paths:
+        metadata = pq.read_schema(path).metadata or {}
+        replaced.update(json.loads(metadata.get(MERGED_FROM, b'[]')))
+    for path in paths:
+        if path.name in replaced:
+            path.unlink()
+    return [path for path in paths if path.name not in replaced]
+
+
+def write_merged(table: pa.Table, path: Path | str, merged: list[Path], config: WriterConfig | None = None) -> Path:
+    """
+    Write `table`, the merge of the `merged` Parquet files of the directory of `path`, and remove them.
+
+    The new file lists their names in its metadata, and they are removed only once it is in place; if that
+    is interrupted, `live_files` removes them on the next read instead of their rows being read twice.
+    """
+    metadata = {**(table.schema.metadata or {}), MERGED_FROM: json.dumps([part.name for part in merged])}
+    path = write_table(table.replace_schema_metadata(metadata), path, config)
+    for part in merged:
+        part.unlink()
+    return path
@@ -0,0 +1,57 @@
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass(frozen=True)
+class TraceTarget:
+    """One service/operation whose traces are collected, with its own per-request limit and collection interval."""
+    service: str
+    operation: str | None = None
+    limit: int = 1000
+    interval_seconds: int = 300
+
+    @property
+    def name(self) -> str:
+        """A file-name-safe identifier of the target, e.g. sr-api_upload for sr-api /upload."""
+        name = self.service if not self.operation else f"{self.service}_{self.operation}"
+        return re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_")
+
+    def dataset_dir(self, spans_dir: Path) -> Path:
+        """Return the span dataset partition of the target under the span store root."""
+        return spans_dir / self.name
+
+
+# The target collected before targets were configurable; the span store written back then belongs to it
+DEFAULT_TARGET = TraceTarget("sr-api", "/upload")
+
+
+def load_trace_targets(config: dict) -> list[TraceTarget]:
+    """
+    Read the `trace_targets` list of config.yml.
+
+    Each entry has a `service` and optionally an `operation`, a `limit` (traces per request, defaults to
+    `jaeger_fetch.slice_limit`) and an `interval_seconds` (for the ingestion daemon, defaults to
+    `daemon.traces_interval_seconds`). Without the list, only sr-api /upload is collected.
+
+    Raises:
+        ValueError: If two entries have the same name.
+    """
+    fetch_config = config.get("jaeger_fetch") or {}
+    daemon_config = config.get("daemon") or {}
+    entries = config.get("trace_targets") or [{"service": DEFAULT_TARGET.service, "operation": DEFAULT_TARGET.operation}]
+    targets = [
+        TraceTarget(
+            service=entry["service"],
+            operation=entry.get("operation"),
+            limit=entry.get("limit", fetch_config.get("slice_limit", DEFAULT_TARGET.limit)),
+            interval_seconds=entry.get("interval_seconds",
+                                       daemon_config.get("traces_interval_seconds", DEFAULT_TARGET.interval_seconds)),
+        )
+        for entry in entries
+    ]
+    names = [target.name for target in targets]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate trace targets in config.yml: {', '.join(sorted(duplicates))}")
+    return targets
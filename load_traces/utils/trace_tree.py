@@ -0,0 +1,196 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from load_traces.utils.compact_schema import trace_id_columns
+
+# Columns added by `add_trace_structure`, with their Arrow types; selfTime is in microseconds, like duration
+STRUCTURE_SCHEMA = pa.schema([
+    ('depth', pa.int32()),
+    ('selfTime', pa.int64()),
+    ('criticalPath', pa.bool_()),
+])
+
+
+def _to_numpy(column: pa.Array | pa.ChunkedArray, dtype) -> np.ndarray:
+    """Return a numeric or timestamp column as numpy values of `dtype`, with nulls as 0."""
+    if pa.types.is_timestamp(column.type):
+        column = column.cast(pa.int64())
+    return np.asarray(pc.fill_null(column, 0)).astype(dtype)
+
+
+def _keys(groups: np.ndarray, values: np.ndarray, unique_values: np.ndarray) -> np.ndarray:
+    """Combine a group ordinal and the rank of a value among `unique_values` into one int64 sort key."""
+    return groups * (len(unique_values) + 1) + np.searchsorted(unique_values, values)
+
+
+def trace_ordinals(trace_high: np.ndarray, trace_low: np.ndarray) -> np.ndarray:
+    """Number the distinct (high, low) trace IDs 0, 1, ... and return the number of the trace of every span."""
+    high_codes, _ = pd.factorize(trace_high)
+    low_codes, _ = pd.factorize(trace_low)
+    traces, _ = pd.factorize(high_codes.astype(np.int64) * (low_codes.max(initial=0) + 1) + low_codes)
+    return traces.astype(np.int64)
+
+
+def parent_indices(traces: np.ndarray, span_ids: np.ndarray, parent_ids: np.ndarray, valid_spans: np.ndarray,
+                   valid_parents: np.ndarray) -> np.ndarray:
+    """
+    Return the row of the parent of every span, or -1 for roots and spans whose parent is not in the rows.
+
+    Parents are looked up within the trace of the span, given by `trace_ordinals`. Span and parent IDs are
+    numbered together, and each (trace, ID) pair is reduced to one int64 key, the trace ordinal times the
+    number of distinct IDs plus the number of the ID. All parents are then found with one sort of the span
+    keys and one binary search of the sorted parent keys, instead of a dictionary per trace.
+    """
+    count = len(span_ids)
+    codes, unique_ids = pd.factorize(np.concatenate([span_ids, parent_ids]))
+    span_keys = np.where(valid_spans, traces * (len(unique_ids) + 1) + codes[:count], -1)
+    parent_keys = np.where(valid_parents, traces * (len(unique_ids) + 1) + codes[count:], -2)
+    key_order = np.argsort(span_keys, kind='stable')
+    sorted_keys = span_keys[key_order]
+    query_order = np.argsort(parent_keys)
+    positions = np.empty(count, dtype=np.int64)
+    positions[query_order] = np.searchsorted(sorted_keys, parent_keys[query_order])
+    positions = np.minimum(positions, max(count - 1, 0))
+    found = sorted_keys[positions] == parent_keys if count else np.zeros(0, dtype=bool)
+    parents = np.where(found, key_order[positions] if count else positions, -1)
+    parents[parents == np.arange(count)] = -1
+    return parents
+
+
+def span_depths(parents: np.ndarray, max_depth: int) -> np.ndarray:
+    """
+    Return the depth of every span below its root by pointer jumping, one level of all trees per step.
+
+    Spans still unresolved after `max_depth` steps hang below a reference cycle; they are made roots, and
+    `parents` is updated in place.
+    """
+    depths = np.zeros(len(parents), dtype=np.int32)
+    ancestors = parents.copy()
+    active = np.flatnonzero(ancestors >= 0)
+    for _ in range(max_depth):
+        if not len(active):
+            break
+        depths[active] += 1
+        ancestors[active] = parents[ancestors[active]]
+        active = active[ancestors[active] >= 0]
+    if len(active):
+        logging.warning(f"{len(active)} spans are in or below a reference cycle and were made roots.")
+        parents[active] = -1
+        depths[active] = 0
+    return depths
+
+
+def _clipped_children(parents: np.ndarray, start: np.ndarray, end: np.ndarray):
+    """Return the child rows, their parent rows and their intervals clipped to the window of the parent."""
+    children = np.flatnonzero(parents >= 0)
+    child_parents = parents[children]
+    child_start = np.clip(start[children], start[child_parents], end[child_parents])
+    child_end = np.clip(end[children], start[child_parents], end[child_parents])
+    return children, child_parents, child_start, child_end
+
+
+def self_times(parents: np.ndarray, start: np.ndarray, duration: np.ndarray) -> np.ndarray:
+    """
+    Return the duration of every span minus the time covered by its children, clipped to the span.
+
+    The children of all spans are sorted by parent and start once; the union of the intervals of each parent's
+    children is the sum of what each child adds past the latest end of the children before it.
+    """
+    end = start + duration
+    children, child_parents, child_start, child_end = _clipped_children(parents, start, end)
+    order = np.lexsort((child_start, child_parents))
+    child_parents, child_start, child_end = child_parents[order], child_start[order], child_end[order]
+    covered_until = pd.Series(child_end).groupby(child_parents).cummax().to_numpy()
+    previous_end = np.roll(covered_until, 1)
+    first_child = np.ones(len(child_parents), dtype=bool)
+    first_child[1:] = child_parents[1:] != child_parents[:-1]
+    previous_end[first_child] = child_start[first_child]
+    added = np.maximum(child_end - np.maximum(child_start, previous_end), 0)
+    covered = np.rint(np.bincount(child_parents, weights=added, minlength=len(parents))).astype(np.int64)
+    return np.maximum(duration - covered, 0)
+
+
+def critical_path(parents: np.ndarray, depths: np.ndarray, start: np.ndarray, duration: np.ndarray) -> np.ndarray:
+    """
+    Return whether every span is on the critical path of its trace, as Jaeger computes it.
+
+    Roots are on the path. Below a span on the path, the child that ends last is on it, then the child that
+    ends last before that child starts, and so on back to the start of the parent; child intervals are clipped
+    to the parent and children outside it are skipped. The chains of all parents are found at once from one
+    sort of the children by (parent, end), then followed one link per step for every parent together.
+    """
+    count = len(parents)
+    end = start + duration
+    children, child_parents, child_start, child_end = _clipped_children(parents, start, end)
+    overlapping = child_end > child_start
+    children, child_parents = children[overlapping], child_parents[overlapping]
+    child_start, child_end = child_start[overlapping], child_end[overlapping]
+    order = np.lexsort((child_end, child_parents))
+    children, child_parents = children[order], child_parents[order]
+    child_start, child_end = child_start[order], child_end[order]
+
+    # The previous link of each child: the sibling before it that ends last, no later than the child starts
+    unique_ends = np.unique(child_end)
+    end_keys = _keys(child_parents, child_end, unique_ends)
+    start_ranks = np.searchsorted(unique_ends, child_start, side='right')
+    positions = np.searchsorted(end_keys, child_parents * (len(unique_ends) + 1) + start_ranks) - 1
+    positions = np.minimum(positions, np.arange(len(children)) - 1)
+    valid = positions >= 0
+    valid[valid] = child_parents[positions[valid]] == child_parents[valid]
+    previous = np.where(valid, positions, -1)
+
+    on_chain = np.zeros(len(children), dtype=bool)
+    last_child = np.ones(len(children), dtype=bool)
+    last_child[:-1] = child_parents[:-1] != child_parents[1:]
+    links = np.flatnonzero(last_child)
+    while len(links):
+        on_chain[links] = True
+        links = previous[links]
+        links = links[links >= 0]
+    chained = np.zeros(count, dtype=bool)
+    chained[children[on_chain]] = True
+
+    critical = parents < 0
+    by_depth = np.argsort(depths, kind='stable')
+    level_starts = np.searchsorted(depths[by_depth], np.arange(1, depths.max(initial=0) + 1))
+    for rows in np.split(by_depth, level_starts)[1:]:
+        critical[rows] = chained[rows] & critical[parents[rows]]
+    return critical
+
+
+def add_trace_structure(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Rebuild the span trees of a batch of whole traces and add the `STRUCTURE_SCHEMA` columns.
+
+    Each span is linked to its `parentSpanID` within its trace through an array of parent row indexes, and
+    all trees of the batch are processed together with numpy, without recursion or a loop over traces:
+
+    - depth: the number of ancestors; roots, and spans whose parent is not in the batch, are at depth 0.
+    - selfTime: the duration not covered by any child, in microseconds.
+    - criticalPath: whether the span is on the critical path of its trace, see `critical_path`.
+
+    Returns:
+        pa.RecordBatch: The batch with the structure columns appended, or replaced if already present.
+    """
+    high_name, low_name = trace_id_columns()
+    traces = trace_ordinals(_to_numpy(batch.column(high_name), np.uint64), _to_numpy(batch.column(low_name), np.uint64))
+    span_ids, parent_ids = batch.column('spanID'), batch.column('parentSpanID')
+    parents = parent_indices(
+        traces, _to_numpy(span_ids, np.uint64), _to_numpy(parent_ids, np.uint64),
+        np.asarray(pc.is_valid(span_ids)), np.asarray(pc.is_valid(parent_ids)),
+    )
+    start, duration = _to_numpy(batch.column('startTime'), np.int64), _to_numpy(batch.column('duration'), np.int64)
+    # No chain of ancestors is longer than the largest trace, unless it runs into a reference cycle
+    depths = span_depths(parents, int(np.bincount(traces).max(initial=0)))
+    arrays = {
+        'depth': pa.array(depths, type=pa.int32()),
+        'selfTime': pa.array(self_times(parents, start, duration), type=pa.int64()),
+        'criticalPath': pa.array(critical_path(parents, depths, start, duration), type=pa.bool_()),
+    }
+    names = [name for name in batch.schema.names if name not in arrays]
+    return pa.RecordBatch.from_arrays([batch.column(name) for name in names] + list(arrays.values()),
+                                      names=names + list(arrays))
@@ -0,0 +1,270 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+
+import psutil
+import requests
+
+METRIC_PREFIX = "anomalies"
+DEFAULT_TEXTFILE_DIR = "metrics"
+DEFAULT_RUN_LOG = "metrics/runs.jsonl"
+# Exported stage fields: (metric name, help text)
+STAGE_METRICS = {
+    "seconds": ("stage_duration_seconds", "Wall time of the stage in the last run, excluding nested stages."),
+    "rows_in": ("stage_rows_in", "Rows read by the stage in the last run."),
+    "rows_out": ("stage_rows_out", "Rows produced by the stage in the last run."),
+    "bytes": ("stage_bytes", "Response or file bytes handled by the stage in the last run."),
+    "peak_rss_bytes": ("stage_peak_rss_bytes", "Peak resident set size of the process during the stage."),
+    "failed": ("stage_failed", "1 if the stage raised an error in the last run."),
+}
+
+
+@dataclass
+class StageRecord:
+    """The measurements of one stage; repeated calls of a stage within a run are summed."""
+    stage: str
+    seconds: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes: int = 0
+    peak_rss_bytes: int = 0
+    calls: int = 0
+    failed: bool = False
+    _child_seconds: float = field(default=0.0, repr=False)
+
+
+class StageMetrics:
+    """
+    Per-stage wall time, row counts, bytes and peak RSS of one pipeline run.
+
+    Stages are measured with `stage()` (a context manager), `timed()` (a decorator) or `iterate()` (for the
+    steps of a streaming pipeline, which run interleaved). The time of a stage excludes the stages nested in
+    it, so the stage times of a run add up to its wall time. Peak RSS is sampled by one background thread
+    while any stage is open.
+
+    When the run ends (`with StageMetrics(...) as metrics:` or `write()`), the stages are written to a
+    Prometheus textfile-collector file `<textfile_dir>/anomalies_<pipeline>.prom` and appended as one JSON
+    line to `run_log`. Either output is skipped when its path is None.
+    """
+
+    def __init__(
+            self,
+            pipeline: str,
+            textfile_dir: Path | str | None = None,
+            run_log: Path | str | None = None,
+            sample_interval: float = 0.05
+    ):
+        self.pipeline = pipeline
+        self.textfile_dir = Path(textfile_dir) if textfile_dir else None
+        self.run_log = Path(run_log) if run_log else None
+        self.sample_interval = sample_interval
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started_at = datetime.now(timezone.utc)
+        self.stages: dict[str, StageRecord] = {}
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open: list[StageRecord] = []
+        self._process = psutil.Process()
+        self._sampler: threading.Thread | None = None
+
+    @classmethod
+    def from_config(cls, pipeline: str, config: dict, base_dir: Path) -> "StageMetrics":
+        """Create the metrics of a run from the `metrics` section of config.yml, with paths relative to `base_dir`."""
+        metrics_config = config.get("metrics") or {}
+        textfile_dir = metrics_config.get("textfile_dir", DEFAULT_TEXTFILE_DIR)
+        run_log = metrics_config.get("run_log", DEFAULT_RUN_LOG)
+        return cls(
+            pipeline,
+            textfile_dir=base_dir / textfile_dir if textfile_dir else None,
+            run_log=base_dir / run_log if run_log else None,
+        )
+
+    def __enter__(self) -> "StageMetrics":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.write(success=exc_type is None)
+
+    def _sample(self) -> None:
+        while True:
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                rss = self._process.memory_info().rss
+                for record in self._open:
+                    record.peak_rss_bytes = max(record.peak_rss_bytes, rss)
+            time.sleep(self.sample_interval)
+
+    def _begin(self, record: StageRecord) -> None:
+        record.peak_rss_bytes = self._process.memory_info().rss
+        with self._lock:
+            self._open.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+
+    def _end(self, record: StageRecord) -> None:
+        with self._lock:
+            self._open.remove(record)
+            record.peak_rss_bytes = max(record.peak_rss_bytes, self._process.memory_info().rss)
+            total = self.stages.setdefault(record.stage, StageRecord(record.stage))
+            total.seconds += record.seconds
+            total.rows_in += record.rows_in
+            total.rows_out += record.rows_out
+            total.bytes += record.bytes
+            total.peak_rss_bytes = max(total.peak_rss_bytes, record.peak_rss_bytes)
+            total.calls += 1
+            total.failed = total.failed or record.failed
+
+    @contextmanager
+    def _timing(self, record: StageRecord):
+        """Add the time of the block to `record`, minus the time of the stages nested in it."""
+        stack = self._local.__dict__.setdefault("stack", [])
+        child_seconds = record._child_seconds
+        stack.append(record)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - started
+            record.seconds += elapsed - (record._child_seconds - child_seconds)
+            if stack:
+                stack[-1]._child_seconds += elapsed
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = 0) -> Iterator[StageRecord]:
+        """
+        Measure the block as stage `name`; set `rows_out` (and `bytes`) on the yielded record.
+
+        Example:
+            with metrics.stage("parse", rows_in=len(lines)) as record:
+                df = parse_log_lines(lines)
+                record.rows_out = len(df)
+        """
+        record = StageRecord(name, rows_in=rows_in)
+        self._begin(record)
+        try:
+            with self._timing(record):
+                yield record
+        except BaseException:
+            record.failed = True
+            raise
+        finally:
+            self._end(record)
+
+    def timed(self, name: str) -> Callable:
+        """Decorator measuring every call of a function as stage `name`."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, name: str, iterable: Iterable, rows: Callable[[object], int] | None = None) -> Iterator:
+        """
+        Measure the time spent producing the items of `iterable` as stage `name`.
+
+        `rows_out` counts the items, or the sum of `rows(item)` if given (e.g. `lambda batch: batch.num_rows`).
+        """
+        record = StageRecord(name)
+        iterator = iter(iterable)
+        self._begin(record)
+        try:
+            while True:
+                with self._timing(record):
+                    item = next(iterator, StopIteration)
+                if item is StopIteration:
+                    return
+                record.rows_out += rows(item) if rows else 1
+                yield item
+        except GeneratorExit:
+            raise
+        except BaseException:
+            record.failed = True
+            raise
+        finally:
+            self._end(record)
+
+    def add(self, name: str, rows_in: int = 0, rows_out: int = 0, bytes: int = 0) -> None:
+        """Add counts to stage `name` without timing anything."""
+        with self._lock:
+            total = self.stages.setdefault(name, StageRecord(name))
+            total.rows_in += rows_in
+            total.rows_out += rows_out
+            total.bytes += bytes
+
+    @contextmanager
+    def count_response_bytes(self, session: requests.Session, name: str):
+        """Add the body size of every response received over `session` in the block to the bytes of stage `name`."""
+        def hook(response, *args, **kwargs):
+            self.add(name, bytes=len(response.content))
+
+        session.hooks["response"].append(hook)
+        try:
+            yield
+        finally:
+            session.hooks["response"].remove(hook)
+
+    def to_dict(self, success: bool = True) -> dict:
+        """Return the run and its stages as a JSON-serialisable dict."""
+        return {
+            "pipeline": self.pipeline,
+            "run_id": self.run_id,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "seconds": round(time.perf_counter() - self._started, 3),
+            "success": success,
+            "stages": [
+                {key: value for key, value in asdict(record).items() if not key.startswith("_")}
+                for record in self.stages.values()
+            ],
+        }
+
+    def to_prometheus(self, success: bool = True) -> str:
+        """Render the run in the Prometheus text exposition format."""
+        run = self.to_dict(success)
+        pipeline = f'pipeline="{self.pipeline}"'
+        lines = [
+            f"# HELP {METRIC_PREFIX}_run_duration_seconds Wall time of the last run of the pipeline.",
+            f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+            f"{METRIC_PREFIX}_run_duration_seconds{{{pipeline}}} {run['seconds']}",
+            f"# HELP {METRIC_PREFIX}_run_success 1 if the last run of the pipeline completed without error.",
+            f"# TYPE {METRIC_PREFIX}_run_success gauge",
+            f"{METRIC_PREFIX}_run_success{{{pipeline}}} {int(success)}",
+            f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Start time of the last run of the pipeline.",
+            f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+            f"{METRIC_PREFIX}_run_timestamp_seconds{{{pipeline}}} {self.started_at.timestamp():.0f}",
+        ]
+        for field_name, (metric, help_text) in STAGE_METRICS.items():
+            lines += [f"# HELP {METRIC_PREFIX}_{metric} {help_text}", f"# TYPE {METRIC_PREFIX}_{metric} gauge"]
+            for stage in run["stages"]:
+                lines.append(f'{METRIC_PREFIX}_{metric}{{{pipeline},stage="{stage["stage"]}"}} '
+                             f'{float(stage[field_name]):g}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, success: bool = True) -> None:
+        """Write the Prometheus textfile (atomically, temporary file and rename) and append the run to the run log."""
+        if self.textfile_dir is not None:
+            self.textfile_dir.mkdir(parents=True, exist_ok=True)
+            textfile = self.textfile_dir / f"{METRIC_PREFIX}_{self.pipeline}.prom"
+            tmp_path = self.textfile_dir / f".{textfile.name}.tmp"
+            tmp_path.write_text(self.to_prometheus(success))
+            tmp_path.replace(textfile)
+        if self.run_log is not None:
+            self.run_log.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.run_log, "a") as file:
+                file.write(json.dumps(self.to_dict(success)) + "\n")
+        summary = ", ".join(f"{record.stage} {record.seconds:.2f}s" for record in self.stages.values())
+        logging.info(f"Run {self.run_id} of {self.pipeline} {'completed' if success else 'failed'}: {summary}.")
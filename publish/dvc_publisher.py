@@ -0,0 +1,153 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+from yaml import safe_load
+
+STATE_FILE = ".publish_state.json"
+# Rewriting a file this large in place defeats incremental publishing and is worth a warning
+REWRITE_WARNING_BYTES = 64 * 2 ** 20
+
+
+def dvc_and_git_pull() -> None:
+    """Pull the latest git commit and the DVC data it references; errors are logged."""
+    try:
+        subprocess.run(["git", "pull"], check=True)
+        logging.info("Git pull successful.")
+        subprocess.run(["dvc", "pull"], check=True)
+        logging.info("DVC pull successful.")
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Failed to pull data. Error: {e}")
+
+
+class DvcPublisher:
+    """
+    Publish the data directory with DVC, doing work only for the chunk files created since the last push.
+
+    The data directory is tracked by one granular `.dvc` directory output, so DVC stores and uploads every file
+    as its own object. Every writer of the pipelines creates new immutable files instead of rewriting old ones,
+    which keeps each publish proportional to the new data: `dvc add` re-hashes only files whose size or mtime
+    changed, and `dvc push` uploads only the objects missing from the remote. The publisher also remembers the
+    files of the last successful push, so a cycle without new files runs no DVC or git command at all, and
+    commits the updated `.dvc` file to git only every `commit_every` pushes.
+    """
+
+    def __init__(self, base_dir: Path, data_dir: Path, dvc_file: Path, commit_every: int = 6):
+        self.base_dir = base_dir
+        self.data_dir = data_dir
+        self.dvc_file = dvc_file
+        self.commit_every = commit_every
+        self.state_path = base_dir / STATE_FILE
+
+    @classmethod
+    def from_config(cls, config: dict, base_dir: Path) -> "DvcPublisher":
+        """Create the publisher of `<base_dir>/data` from the `publish` section of config.yml."""
+        publish_config = config.get("publish") or {}
+        return cls(base_dir, base_dir / "data", base_dir / "data.dvc", publish_config.get("commit_every", 6))
+
+    def _read_state(self) -> dict:
+        if not self.state_path.exists():
+            return {"files": {}, "pushes_since_commit": 0}
+        with open(self.state_path) as file:
+            return json.load(file)
+
+    def _write_state(self, state: dict) -> None:
+        tmp_path = self.state_path.with_name(f".{self.state_path.name}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        tmp_path.replace(self.state_path)
+
+    def scan(self) -> dict[str, list[int]]:
+        """Return the [size, mtime_ns] of every published file of the data directory, skipping hidden temporary files."""
+        files = {}
+        for root, dirs, names in os.walk(self.data_dir):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in names:
+                if name.startswith(".") or ".part-" in name:
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                files[os.path.relpath(os.path.join(root, name), self.data_dir)] = [stat.st_size, stat.st_mtime_ns]
+        return files
+
+    def changes(self, files: dict[str, list[int]] | None = None) -> tuple[list[str], list[str], list[str]]:
+        """Return the files added, rewritten and removed since the last successful push."""
+        published = self._read_state()["files"]
+        files = self.scan() if files is None else files
+        added = [path for path in files if path not in published]
+        rewritten = [path for path in files if path in published and files[path] != published[path]]
+        removed = [path for path in published if path not in files]
+        return added, rewritten, removed
+
+    def _run(self, *command: str) -> None:
+        subprocess.run(list(command), check=True, cwd=self.base_dir)
+
+    def commit(self, message: str) -> bool:
+        """Commit and push the `.dvc` file if it changed since the last commit."""
+        status = subprocess.run(["git", "status", "--porcelain", str(self.dvc_file)], check=True, cwd=self.base_dir,
+                                capture_output=True, text=True).stdout
+        if status.strip():
+            self._run("git", "add", str(self.dvc_file))
+            self._run("git", "commit", "-m", message)
+            self._run("git", "push")
+            logging.info(f"Committed and pushed {self.dvc_file.name}.")
+        state = self._read_state()
+        state["pushes_since_commit"] = 0
+        self._write_state(state)
+        return bool(status.strip())
+
+    def publish(self, message: str | None = None, force_commit: bool = False) -> int:
+        """
+        Hash and push the files created since the last successful push; commit the `.dvc` file every `commit_every` pushes.
+
+        Errors of the dvc and git commands are logged, and the same files are published again by the next call.
+
+        Args:
+            message (str, optional): The git commit message. Defaults to "Update data <now>".
+            force_commit (bool, optional): Commit the `.dvc` file now, even before `commit_every` pushes. Defaults to False.
+
+        Returns:
+            int: The number of new or rewritten files pushed.
+        """
+        message = message or f"Update data {datetime.now()}"
+        try:
+            files = self.scan()
+            added, rewritten, removed = self.changes(files)
+            for path in rewritten:
+                if files[path][0] >= REWRITE_WARNING_BYTES:
+                    logging.warning(f"{path} was rewritten in place since the last push, it is uploaded again in full.")
+            if added or rewritten or removed:
+                self._run("dvc", "add", str(self.data_dir))
+                self._run("dvc", "push", str(self.dvc_file))
+                state = self._read_state()
+                state["files"] = files
+                state["pushes_since_commit"] += 1
+                self._write_state(state)
+                logging.info(f"Pushed {len(added)} new and {len(rewritten)} rewritten files "
+                             f"({len(removed)} removed) to the DVC remote.")
+            else:
+                logging.info("No new files to publish.")
+                state = self._read_state()
+
+            if state["pushes_since_commit"] and (force_commit or state["pushes_since_commit"] >= self.commit_every):
+                self.commit(message)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Failed to publish {self.data_dir}. Error: {e}")
+            return 0
+        return len(added) + len(rewritten)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Push the new data files with DVC.")
+    parser.add_argument("--commit", action="store_true", help="commit and push the .dvc file now")
+    parser.add_argument("--message", default=None, help="the git commit message")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parent_path = Path(__file__).resolve().parents[1]
+    with open(parent_path / "config.yml") as file:
+        config = safe_load(file)
+    DvcPublisher.from_config(config, parent_path).publish(args.message, force_commit=args.commit)
@@ -0,0 +1,8 @@
+from enrich.arrow_cache import write_arrow_cache
+
+
+def test_no_cache_is_written_without_data_files(tmp_path):
+    assert write_arrow_cache(tmp_path / "missing", tmp_path / "missing.arrow") is None
+    (tmp_path / "empty").mkdir()
+    assert write_arrow_cache(tmp_path / "empty", tmp_path / "empty.arrow") is None
+    assert not list(tmp_path.glob('*.arrow'))
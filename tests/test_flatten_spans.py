@@ -0,0 +1,34 @@
+from load_traces.utils.flatten_spans import iter_span_batches
+
+
+def _span(span_id: str, tags: list[dict]) -> dict:
+    return {"traceID": "00000000000000000000000000000001", "spanID": span_id, "operationName": "op",
+            "references": [], "startTime": 1_714_521_600_000_000, "duration": 10, "tags": tags, "processID": "p1"}
+
+
+def test_repeated_tag_key_keeps_last_value_of_its_span():
+    trace = {
+        "traceID": "00000000000000000000000000000001",
+        "spans": [
+            _span("0000000000000001", [{"key": "k", "type": "string", "value": "A1"},
+                                       {"key": "k", "type": "string", "value": "A2"}]),
+            _span("0000000000000002", []),
+        ],
+        "processes": {"p1": {"serviceName": "svc", "tags": []}},
+    }
+    (batch,) = iter_span_batches([trace])
+    assert batch.column("tag_k").to_pylist() == ["A2", None]
+
+
+def test_tags_are_scattered_to_their_spans():
+    trace = {
+        "traceID": "00000000000000000000000000000001",
+        "spans": [
+            _span("0000000000000001", []),
+            _span("0000000000000002", [{"key": "code", "type": "int64", "value": 500}]),
+            _span("0000000000000003", [{"key": "code", "type": "int64", "value": 200}]),
+        ],
+        "processes": {"p1": {"serviceName": "svc", "tags": []}},
+    }
+    (batch,) = iter_span_batches([trace])
+    assert batch.column("tag_code").to_pylist() == [None, 500, 200]
@@ -0,0 +1,50 @@
+import numpy as np
+import pyarrow as pa
+
+from anomaly.latency_detector import DAY_US, LatencyDetector
+
+DAY = 19_844  # 2024-05-01
+
+
+def _batch(day: int, count: int = 100) -> pa.RecordBatch:
+    return pa.RecordBatch.from_pydict({
+        'spanID': pa.array(np.arange(count), pa.uint64()),
+        'traceID_high': pa.array(np.zeros(count), pa.uint64()),
+        'traceID_low': pa.array(np.arange(count), pa.uint64()),
+        'serviceName': ['svc'] * count,
+        'operationName': ['upload'] * count,
+        'startTime': pa.array(day * DAY_US + np.arange(count) * 1_000_000, pa.timestamp('us')),
+        'duration': pa.array(np.arange(1, count + 1) * 1000, pa.int64()),
+    })
+
+
+def _commit(detector: LatencyDetector, day: int) -> None:
+    list(detector.observe([_batch(day)]))
+    detector.commit()
+
+
+def _counts(detector: LatencyDetector) -> dict[int, int]:
+    return {day: sketches[('svc', 'upload')].count for day, sketches in detector._days.items()}
+
+
+def test_sketch_files_of_past_days_are_merged(tmp_path):
+    detector = LatencyDetector(tmp_path / "sketches", tmp_path / "anomalies")
+    for day in (DAY, DAY, DAY + 1, DAY, DAY + 1):
+        _commit(detector, day)
+    files = {path.name: len(list(path.glob('*.parquet'))) for path in sorted((tmp_path / "sketches").iterdir())}
+    assert files == {'date=2024-05-01': 1, 'date=2024-05-02': 2}
+    assert _counts(LatencyDetector(tmp_path / "sketches", tmp_path / "anomalies")) == {DAY: 300, DAY + 1: 200}
+
+
+def test_interrupted_merge_does_not_count_spans_twice(tmp_path):
+    detector = LatencyDetector(tmp_path / "sketches", tmp_path / "anomalies")
+    for day in (DAY, DAY):
+        _commit(detector, day)
+    partition_dir = tmp_path / "sketches" / "date=2024-05-01"
+    parts = {path: path.read_bytes() for path in partition_dir.glob('*.parquet')}
+    detector._compact(partition_dir)
+    # The merged file is in place but the files it replaces were not removed yet
+    for path, data in parts.items():
+        path.write_bytes(data)
+    assert _counts(LatencyDetector(tmp_path / "sketches", tmp_path / "anomalies")) == {DAY: 200}
+    assert len(list(partition_dir.glob('*.parquet'))) == 1
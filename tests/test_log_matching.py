@@ -0,0 +1,66 @@
+import pandas as pd
+
+from enrich.log_matching import match_logs, match_logs_by_time
+
+
+def _spans(rows: list[tuple]) -> pd.DataFrame:
+    """Spans of (trace, spanID, start in µs, duration in µs)."""
+    traces, span_ids, starts, durations = zip(*rows)
+    return pd.DataFrame({
+        'spanID': pd.array(span_ids, dtype='UInt64'),
+        'traceID_high': pd.array([0] * len(rows), dtype='UInt64'),
+        'traceID_low': pd.array(traces, dtype='UInt64'),
+        'startTime': pd.to_datetime(list(starts), unit='us'),
+        'duration': list(durations),
+    })
+
+
+def _logs(rows: list[tuple]) -> pd.DataFrame:
+    """Logs of (trace, time in µs)."""
+    traces, times = zip(*rows)
+    return pd.DataFrame({
+        'trace_id_high': pd.array([0] * len(rows), dtype='UInt64'),
+        'trace_id_low': pd.array(traces, dtype='UInt64'),
+        'time': pd.to_datetime(list(times), unit='us'),
+    })
+
+
+# Trace 1: a root [0, 100_000] with a child [10_000, 20_000] and a later child [50_000, 60_000]
+# that has a grandchild [52_000, 55_000]. Trace 2: one span [0, 100_000].
+SPANS = _spans([
+    (1, 1, 0, 100_000),
+    (1, 2, 10_000, 10_000),
+    (1, 3, 50_000, 10_000),
+    (1, 4, 52_000, 3_000),
+    (2, 5, 0, 100_000),
+])
+
+
+def test_logs_match_the_innermost_running_span():
+    logs = _logs([(1, 15_000), (1, 53_000), (1, 58_000), (1, 30_000), (1, 90_000)])
+    assert match_logs_by_time(SPANS, logs).tolist() == [1, 3, 2, 0, 0]
+
+
+def test_logs_only_match_spans_of_their_trace():
+    logs = _logs([(2, 15_000), (3, 15_000)])
+    assert match_logs_by_time(SPANS, logs).tolist() == [4, -1]
+
+
+def test_logs_outside_every_span_are_unmatched_beyond_the_tolerance():
+    logs = _logs([(1, -1_000), (1, -1_001), (1, 101_000), (1, 101_001)])
+    assert match_logs_by_time(SPANS, logs).tolist() == [0, -1, 0, -1]
+    assert match_logs_by_time(SPANS, logs, tolerance_us=0).tolist() == [-1, -1, -1, -1]
+
+
+def test_logs_without_trace_or_time_are_unmatched():
+    logs = _logs([(1, 15_000), (1, 15_000)])
+    logs.loc[0, 'trace_id_low'] = pd.NA
+    logs.loc[1, 'time'] = pd.NaT
+    assert match_logs_by_time(SPANS, logs).tolist() == [-1, -1]
+    assert match_logs_by_time(SPANS, logs.drop(columns=['trace_id_high', 'trace_id_low'])).tolist() == [-1, -1]
+
+
+def test_time_mode_matches_logs_whose_span_id_is_unknown():
+    logs = _logs([(1, 15_000), (1, 15_000)]).assign(span_id=pd.array([4, 99], dtype='UInt64'))
+    assert match_logs(SPANS, logs, mode='span_id').tolist() == [3, -1]
+    assert match_logs(SPANS, logs, mode='time').tolist() == [3, 1]
@@ -0,0 +1,24 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from load_traces.utils.span_dataset import append_spans, read_spans
+from load_traces.utils.table_writer import WriterConfig
+
+START_US = 1_714_521_600_000_000  # 2024-05-01 00:00 UTC
+
+
+def test_append_spans_buffers_batches_into_configured_row_groups(tmp_path):
+    table = pa.table({
+        'spanID': pa.array(range(1, 11), pa.uint64()),
+        'startTime': pa.array([START_US + i for i in range(10)], pa.timestamp('us')),
+    })
+    # Ten row groups of one span each, as a daily file of small fetch batches has
+    pq.write_table(table, tmp_path / "daily.parquet", row_group_size=1)
+    config = WriterConfig(compression='snappy', row_group_size=4)
+
+    assert append_spans(tmp_path / "daily.parquet", tmp_path / "dataset", config) == {'2024-05-01': 10}
+    (part,) = (tmp_path / "dataset" / "date=2024-05-01").glob('*.parquet')
+    metadata = pq.ParquetFile(part).metadata
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [4, 4, 2]
+    assert metadata.row_group(0).column(0).compression == 'SNAPPY'
+    assert read_spans(tmp_path / "dataset")['spanID'].tolist() == list(range(1, 11))
@@ -0,0 +1,52 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from enrich.out_of_core import enrich_spans_out_of_core
+from enrich.span_index import SpanIndex, enrich_incremental, index_existing_output
+from load_traces.utils.span_dataset import read_spans
+
+START_US = 1_714_521_600_000_000  # 2024-05-01 00:00 UTC
+
+
+def _write_spans_and_logs(tmp_path):
+    backup_dir = tmp_path / "backups" / "2024-05-01_00-00-00"
+    backup_dir.mkdir(parents=True)
+    pq.write_table(pa.table({
+        'spanID': pa.array([1, 2], pa.uint64()),
+        'operationName': ['upload', 'upload'],
+        'startTime': pa.array([START_US, START_US], pa.timestamp('us')),
+    }), backup_dir / "daily_upload_spans.parquet")
+    parts_dir = tmp_path / "logs" / "parts"
+    parts_dir.mkdir(parents=True)
+    pq.write_table(pa.table({
+        'span_id': pa.array([1], pa.uint64()),
+        'message': ['uploaded'],
+        'time': pa.array([START_US + 10], pa.timestamp('us')),
+    }), parts_dir / "logs-1-2.parquet")
+    # A batch of start-up logs only, none of which has a span
+    pq.write_table(pa.table({
+        'message': ['starting'],
+        'time': pa.array([START_US], pa.timestamp('us')),
+    }), parts_dir / "logs-3-4.parquet")
+
+
+def test_incremental_enrichment_skips_log_batches_without_span_id(tmp_path):
+    _write_spans_and_logs(tmp_path)
+    stats = enrich_incremental(tmp_path / "backups", tmp_path / "logs", tmp_path / "enriched",
+                               tmp_path / "span_index.sqlite")
+    assert stats['log_files'] == 2
+    assert stats['new_spans'] == 2
+    enriched = read_spans(tmp_path / "enriched").sort_values('spanID')
+    assert enriched['message'].tolist() == ['uploaded', None]
+    with SpanIndex(tmp_path / "span_index.sqlite") as index:
+        assert index.new_files('log', sorted((tmp_path / "logs" / "parts").glob('*.parquet'))) == []
+
+
+def test_index_rebuild_skips_log_batches_without_span_id(tmp_path):
+    _write_spans_and_logs(tmp_path)
+    enrich_spans_out_of_core(tmp_path / "backups", tmp_path / "logs", tmp_path / "enriched")
+    index_existing_output(tmp_path / "backups", tmp_path / "logs", tmp_path / "enriched",
+                          tmp_path / "span_index.sqlite")
+    with SpanIndex(tmp_path / "span_index.sqlite") as index:
+        assert index.new_files('log', sorted((tmp_path / "logs" / "parts").glob('*.parquet'))) == []
+        assert index.known_span_ids([1, 2]) == {1, 2}
@@ -0,0 +1,72 @@
+import numpy as np
+import pyarrow as pa
+
+from load_traces.utils.trace_tree import add_trace_structure, critical_path, parent_indices, self_times, span_depths
+
+# One trace, times in microseconds:
+#   0 root   [0, 100]
+#   1 ├ a    [10, 40]
+#   3 │ └ c  [15, 25]
+#   2 ├ b    [30, 80]
+#   4 └ d    [90, 110], runs past the root and is clipped to [90, 100]
+SPAN_IDS = np.array([1, 2, 3, 4, 5], dtype=np.uint64)
+PARENT_IDS = np.array([0, 1, 1, 2, 1], dtype=np.uint64)
+HAS_PARENT = np.array([False, True, True, True, True])
+START = np.array([0, 10, 30, 15, 90], dtype=np.int64)
+DURATION = np.array([100, 30, 50, 10, 20], dtype=np.int64)
+
+
+def _parents() -> np.ndarray:
+    return parent_indices(np.zeros(5, dtype=np.int64), SPAN_IDS, PARENT_IDS, np.ones(5, dtype=bool), HAS_PARENT)
+
+
+def test_parent_indices():
+    assert _parents().tolist() == [-1, 0, 0, 1, 0]
+
+
+def test_parent_indices_stay_within_the_trace():
+    # The second trace reuses span ID 2, whose parent 1 only exists in the first trace
+    traces = np.array([0, 0, 1], dtype=np.int64)
+    span_ids = np.array([1, 2, 2], dtype=np.uint64)
+    parent_ids = np.array([0, 1, 1], dtype=np.uint64)
+    parents = parent_indices(traces, span_ids, parent_ids, np.ones(3, dtype=bool), np.array([False, True, True]))
+    assert parents.tolist() == [-1, 0, -1]
+
+
+def test_span_depths():
+    assert span_depths(_parents(), 5).tolist() == [0, 1, 1, 2, 1]
+
+
+def test_self_times_subtract_the_union_of_clipped_children():
+    # The root is covered by [10, 80] and the clipped [90, 100]
+    assert self_times(_parents(), START, DURATION).tolist() == [20, 20, 50, 10, 20]
+
+
+def test_critical_path():
+    parents = _parents()
+    # d ends last, b ends last before d starts, and a ends after b starts, so it is off the path with its child
+    critical = critical_path(parents, span_depths(parents, 5), START, DURATION)
+    assert critical.tolist() == [True, False, True, False, True]
+
+
+def test_reference_cycle_spans_become_roots():
+    # Rows 0 and 1 are each other's parent, and row 2 hangs below them
+    parents = np.array([1, 0, 0], dtype=np.int64)
+    depths = span_depths(parents, 3)
+    assert depths.tolist() == [0, 0, 0]
+    assert parents.tolist() == [-1, -1, -1]
+
+
+def test_add_trace_structure_breaks_cycles_and_self_references():
+    batch = pa.RecordBatch.from_pydict({
+        'spanID': pa.array([1, 2, 3], type=pa.uint64()),
+        'traceID_high': pa.array([0, 0, 0], type=pa.uint64()),
+        'traceID_low': pa.array([7, 7, 7], type=pa.uint64()),
+        'parentSpanID': pa.array([2, 1, 3], type=pa.uint64()),
+        'startTime': pa.array([0, 0, 0], type=pa.timestamp('us')),
+        'duration': pa.array([10, 10, 10], type=pa.int64()),
+    })
+    result = add_trace_structure(batch)
+    assert result.column('depth').to_pylist() == [0, 0, 0]
+    assert result.column('selfTime').to_pylist() == [10, 10, 10]
+    assert result.column('criticalPath').to_pylist() == [True, True, True]
@@ -0,0 +1,115 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from features.window_features import FeatureStore, Window, read_features
+from load_traces.utils.span_dataset import append_spans
+
+START_US = 1_714_521_600_000_000  # 2024-05-01 00:00 UTC
+
+
+def test_add_logs_counts_logs_of_spans_stored_twice_once(tmp_path):
+    spans_path = tmp_path / "spans.parquet"
+    pq.write_table(pa.table({
+        'spanID': pa.array([1, 2], pa.uint64()),
+        'serviceName': ['svc', 'svc'],
+        'operationName': ['upload', 'download'],
+        'startTime': pa.array([START_US, START_US], pa.timestamp('us')),
+        'duration': pa.array([1000, 1000], pa.int64()),
+    }), spans_path)
+    # An overlapping fetch appends the same spans again
+    append_spans(spans_path, tmp_path / "dataset")
+    append_spans(spans_path, tmp_path / "dataset")
+    logs_path = tmp_path / "logs.parquet"
+    pq.write_table(pa.table({
+        'span_id': pa.array([1, 1, 2, 3], pa.uint64()),
+        'level': ['error', 'info', 'info', 'info'],
+        'time': pa.array([START_US + 10] * 4, pa.timestamp('us')),
+    }), logs_path)
+
+    store = FeatureStore(tmp_path / "features", tmp_path / "dataset", windows=[Window.parse('1m')])
+    assert store.add_logs(logs_path) == 3
+    store.commit()
+    features = read_features(tmp_path / "features", '1m').set_index('operationName')
+    assert features.loc['upload', ['logs', 'log_errors']].tolist() == [2, 1]
+    assert features.loc['download', ['logs', 'log_errors']].tolist() == [1, 0]
+
+
+def _spans(start_us: list[int], operations: list[str]) -> pa.RecordBatch:
+    return pa.RecordBatch.from_pydict({
+        'spanID': pa.array(range(1, len(start_us) + 1), pa.uint64()),
+        'serviceName': ['svc'] * len(start_us),
+        'operationName': operations,
+        'startTime': pa.array(start_us, pa.timestamp('us')),
+        'duration': pa.array([1000] * len(start_us), pa.int64()),
+    })
+
+
+def test_parts_of_past_days_are_merged(tmp_path):
+    hour = 3_600_000_000
+    batches = [_spans([START_US + 23 * hour, START_US + 25 * hour], ['upload', 'download']),
+               _spans([START_US + 23 * hour + 1, START_US + 20 * hour], ['upload', 'upload']),
+               _spans([START_US + 49 * hour], ['download'])]
+    incremental = FeatureStore(tmp_path / "incremental")
+    for batch in batches:
+        incremental.add_spans(batch)
+        incremental.commit()
+    at_once = FeatureStore(tmp_path / "at_once")
+    for batch in batches:
+        at_once.add_spans(batch)
+    at_once.commit()
+
+    for table in ('cells', '1m', '1h_every_5m'):
+        parts = [len(list(path.glob('*.parquet'))) for path in sorted((tmp_path / "incremental" / table).iterdir())]
+        assert parts == [1, 1, 1]
+    for window in ('1m', '5m', '1h', '5m_every_1m', '1h_every_5m'):
+        assert read_features(tmp_path / "incremental", window).equals(read_features(tmp_path / "at_once", window))
+
+
+def test_commit_counts_the_stored_logs_of_the_spans_near_their_time(tmp_path):
+    (tmp_path / "logs" / "parts").mkdir(parents=True)
+    pq.write_table(pa.table({
+        'span_id': pa.array([1, 1, 1], pa.uint64()),
+        'level': ['info', 'error', 'info'],
+        # The last log is a day later, outside the time of the span
+        'time': pa.array([START_US + 10, START_US + 20, START_US + 86_400_000_000], pa.timestamp('us')),
+    }), tmp_path / "logs" / "parts" / "logs-1-2.parquet")
+
+    store = FeatureStore(tmp_path / "features", logs_dir=tmp_path / "logs", windows=[Window.parse('1m')])
+    store.add_spans(_spans([START_US], ['upload']))
+    store.commit()
+    features = read_features(tmp_path / "features", '1m')
+    assert features[['requests', 'logs', 'log_errors']].values.tolist() == [[1, 2, 1]]
+
+
+def test_logs_count_the_same_whether_spans_or_logs_are_stored_first(tmp_path):
+    hour = 3_600_000_000
+    logs = pa.table({
+        'span_id': pa.array([1, 1], pa.uint64()),
+        'level': ['error', 'info'],
+        # The second log is 12 hours after its span
+        'time': pa.array([START_US + 10, START_US + 12 * hour], pa.timestamp('us')),
+    })
+    # The download span makes the logs read for the pending spans reach the late log of the upload span
+    spans = _spans([START_US, START_US + 12 * hour], ['upload', 'download'])
+    window = Window.parse('1m')
+
+    # Logs second: counted by `add_logs` against the stored spans
+    pq.write_table(pa.Table.from_batches([spans]), tmp_path / "spans.parquet")
+    append_spans(tmp_path / "spans.parquet", tmp_path / "dataset")
+    pq.write_table(logs, tmp_path / "logs.parquet")
+    logs_second = FeatureStore(tmp_path / "logs_second", tmp_path / "dataset", windows=[window])
+    logs_second.add_spans(spans)
+    logs_second.commit()
+    assert logs_second.add_logs(tmp_path / "logs.parquet") == 1
+    logs_second.commit()
+
+    # Spans second: the stored logs are counted when the spans are committed
+    (tmp_path / "logs" / "parts").mkdir(parents=True)
+    pq.write_table(logs, tmp_path / "logs" / "parts" / "logs-1-2.parquet")
+    spans_second = FeatureStore(tmp_path / "spans_second", logs_dir=tmp_path / "logs", windows=[window])
+    spans_second.add_spans(spans)
+    spans_second.commit()
+
+    for features_dir in ("logs_second", "spans_second"):
+        features = read_features(tmp_path / features_dir, '1m')
+        assert features[['logs', 'log_errors']].sum().tolist() == [1, 1]